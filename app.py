@@ -1,26 +1,34 @@
 import os
 import uuid
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_file, send_from_directory, g, has_app_context, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import aliased
-from sqlalchemy import or_, func, event, text, inspect, case, cast, String
+from sqlalchemy.orm import aliased, joinedload
+from sqlalchemy import or_, and_, func, event, text, inspect, case, cast, String, select, exists, literal_column, table, bindparam
+from sqlalchemy.exc import IntegrityError
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, date, timedelta
 import pandas as pd
 import io
+import base64
+import copy
 import click
+import socket
+import csv
 import json
 import sqlite3
 import tempfile
 import zipfile
 import schedule
 import threading
+import multiprocessing
+import shutil
 import time
 import pytz
 import re
 import unicodedata
 from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait as wait_futures
 from config import config, get_database_info, is_external_database
 from backup_restore import DatabaseBackup
 
@@ -199,35 +207,6 @@ PERMISSIONS = [
     ('stock_items.delete', 'Xóa mặt hàng và nhóm vật tư'),
 ]
 
-# Register SQLite function last_token for sorting by given name
-def _register_sqlite_functions(dbapi_conn, connection_record):
-    try:
-        def last_token(s):
-            try:
-                s = (s or '').strip()
-                return s.split()[-1].lower() if s else ''
-            except Exception:
-                return ''
-        dbapi_conn.create_function('last_token', 1, last_token)
-    except Exception:
-        pass
-
-try:
-    event.listen(db.engine, 'connect', _register_sqlite_functions)
-except Exception:
-    pass
-
-# Eagerly register UDF on current connection as an extra safeguard (e.g., Gunicorn workers)
-try:
-    with app.app_context():
-        try:
-            with db.engine.connect() as _conn:
-                _register_sqlite_functions(_conn.connection, None)
-        except Exception:
-            pass
-except Exception:
-    pass
-
 # --- Database initialization ---
 def init_db():
     with app.app_context():
@@ -927,6 +906,12 @@ class Department(db.Model):
             current = getattr(current, 'parent', None)
         return level
 
+class DepartmentClosure(db.Model):
+    """Closure table of the department tree: one row per (ancestor, descendant) pair, self included."""
+    ancestor_id = db.Column(db.Integer, db.ForeignKey('department.id', ondelete='CASCADE'), primary_key=True)
+    descendant_id = db.Column(db.Integer, db.ForeignKey('department.id', ondelete='CASCADE'), primary_key=True, index=True)
+    depth = db.Column(db.Integer, nullable=False, default=0)
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
@@ -948,6 +933,8 @@ class User(db.Model):
     status = db.Column(db.String(50), default='Đang làm')
     onboard_date = db.Column(db.Date)
     offboard_date = db.Column(db.Date)
+    search_key = db.Column(db.String(400))  # see SEARCH_KEY_COLUMNS
+    sort_key = db.Column(db.String(300))
     given_handovers = db.relationship('DeviceHandover', foreign_keys='DeviceHandover.giver_id', back_populates='giver', lazy='dynamic')
     received_handovers = db.relationship('DeviceHandover', foreign_keys='DeviceHandover.receiver_id', back_populates='receiver', lazy='dynamic')
 
@@ -960,45 +947,88 @@ class Notification(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     user = db.relationship('User', backref=db.backref('notifications', order_by='Notification.created_at.desc()', lazy='dynamic'))
 
-import urllib.request
 import urllib.parse
+import http.client
 import json
 import threading
 
 def send_telegram_message(chat_id, text):
+    """Queue a Telegram message in the outbox; the outbox worker delivers it once the caller commits."""
     token = os.environ.get('TELEGRAM_BOT_TOKEN')
-    if not token or not chat_id:
+    if not token or not chat_id or not text:
         return
-    url = f"https://api.telegram.org/bot{token}/sendMessage"
-    payload = json.dumps({'chat_id': str(chat_id), 'text': text}).encode('utf-8')
-    req = urllib.request.Request(url, data=payload, headers={'Content-Type': 'application/json'})
-    try:
-        with urllib.request.urlopen(req, timeout=5) as response:
-            pass
-    except Exception as e:
-        print(f"Telegram error: {e}")
+    db.session.add(TelegramOutbox(chat_id=str(chat_id), text=text))
+    db.session.info['telegram_queued'] = True
+
+# Notifications are queued on the current session and written at its next commit: one query
+# resolves the recipients, then one bulk insert each for notification and telegram_outbox rows.
+# Nothing is written if the caller rolls back instead.
+def _queue_notification(message, link, user_ids=(), permissions=(), exclude=()):
+    db.session.info.setdefault('pending_notifications', []).append({
+        'message': message,
+        'link': link or '',
+        'user_ids': {int(user_id) for user_id in user_ids if user_id},
+        'permissions': tuple(sorted(permissions)),
+        'exclude': {int(user_id) for user_id in exclude if user_id},
+    })
 
 def notify_user(user_id, message, link=""):
-    try:
-        user = User.query.get(user_id)
-        if not user: return
-        notif = Notification(user_id=user_id, message=message, link=link)
-        db.session.add(notif)
-        db.session.commit()
-        if user.telegram_chat_id:
-            text_msg = f"THÔNG BÁO\n{message}"
-            threading.Thread(target=send_telegram_message, args=(user.telegram_chat_id, text_msg)).start()
-    except Exception as e:
-        print(f"Notify error: {e}")
+    """Notify one user (in-app, plus Telegram when linked) with the caller's next commit."""
+    _queue_notification(message, link, user_ids=[user_id])
+
+def notify_users(user_ids, message, link=""):
+    _queue_notification(message, link, user_ids=user_ids)
+
+def notify_permission(permission_codes, message, link="", exclude=()):
+    """Notify every user holding any of `permission_codes` through a role, and all admins, once each."""
+    if isinstance(permission_codes, str):
+        permission_codes = [permission_codes]
+    _queue_notification(message, link, permissions=permission_codes, exclude=exclude)
 
 def notify_group(message, link=""):
-    try:
-        group_id = os.environ.get('TELEGRAM_GROUP_CHAT_ID')
-        if not group_id: return
-        text_msg = f"THÔNG BÁO HỆ THỐNG\n{message}"
-        threading.Thread(target=send_telegram_message, args=(group_id, text_msg)).start()
-    except Exception as e:
-        print(f"Notify group error: {e}")
+    group_id = os.environ.get('TELEGRAM_GROUP_CHAT_ID')
+    if group_id:
+        send_telegram_message(group_id, f"THÔNG BÁO HỆ THỐNG\n{message}")
+
+def _permission_holders_condition(permission_codes):
+    role_ids = select(RolePermission.role_id).join(Permission, Permission.id == RolePermission.permission_id)\
+        .where(Permission.code.in_(permission_codes))
+    holder_ids = select(UserRole.user_id).join(Role, Role.id == UserRole.role_id)\
+        .where(or_(Role.id.in_(role_ids), func.lower(Role.name) == 'admin'))
+    return or_(User.role == 'admin', User.id.in_(holder_ids))
+
+@event.listens_for(db.session, 'before_commit')
+def _write_pending_notifications(session):
+    pending = session.info.pop('pending_notifications', None)
+    if not pending:
+        return
+    user_ids = set().union(*(entry['user_ids'] for entry in pending))
+    # One query for every recipient; each permission fan-out becomes a boolean column
+    fan_outs = sorted({entry['permissions'] for entry in pending if entry['permissions']})
+    conditions = ([User.id.in_(user_ids)] if user_ids else []) + [_permission_holders_condition(codes) for codes in fan_outs]
+    columns = [User.id, User.telegram_chat_id] + \
+        [_permission_holders_condition(codes).label(f'p{index}') for index, codes in enumerate(fan_outs)]
+    recipients = session.execute(select(*columns).where(or_(*conditions))).all()
+    chat_ids = {row[0]: row[1] for row in recipients}
+    holders = {codes: {row[0] for row in recipients if row[2 + index]} for index, codes in enumerate(fan_outs)}
+
+    now = datetime.utcnow()
+    notifications, messages = [], []
+    for entry in pending:
+        targets = (entry['user_ids'] | holders.get(entry['permissions'], set())) - entry['exclude']
+        for user_id in sorted(targets & chat_ids.keys()):
+            notifications.append({'user_id': user_id, 'message': entry['message'], 'link': entry['link'],
+                                  'is_read': False, 'created_at': now})
+            if chat_ids[user_id] and os.environ.get('TELEGRAM_BOT_TOKEN'):
+                messages.append({'chat_id': str(chat_ids[user_id]), 'text': f"THÔNG BÁO\n{entry['message']}"})
+    _bulk_insert_rows(Notification, notifications)
+    if messages:
+        _bulk_insert_rows(TelegramOutbox, messages)
+        session.info['telegram_queued'] = True
+
+@event.listens_for(db.session, 'after_rollback')
+def _drop_pending_notifications(session):
+    session.info.pop('pending_notifications', None)
 
 class Device(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -1032,6 +1062,199 @@ class Device(db.Model):
     purchase_price = db.Column(db.Float)
     image_filename = db.Column(db.String(255))
     image_filenames = db.Column(db.Text)
+    search_key = db.Column(db.String(300))  # see SEARCH_KEY_COLUMNS
+
+class DeviceStats(db.Model):
+    """Dashboard rollup: number of devices per (device_type, status, department of the manager)."""
+    id = db.Column(db.Integer, primary_key=True)
+    device_type = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    department_id = db.Column(db.Integer, db.ForeignKey('department.id'), index=True)
+    # department_id with NULL folded to 0, so the key can carry a unique constraint
+    department_key = db.Column(db.Integer, nullable=False, default=0)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.Index('ux_device_stats_key', 'device_type', 'status', 'department_key', unique=True),)
+
+def _device_stats_count_select():
+    device, user = Device.__table__, User.__table__
+    return (
+        select(device.c.device_type, device.c.status, user.c.department_id,
+               func.coalesce(user.c.department_id, 0), func.count(device.c.id))
+        .select_from(device.outerjoin(user, user.c.id == device.c.manager_id))
+        .group_by(device.c.device_type, device.c.status, user.c.department_id)
+    )
+
+def _rebuild_device_stats(connection=None):
+    """Recompute the whole device_stats rollup from the device table."""
+    connection = connection or db.session.connection()
+    stats = DeviceStats.__table__
+    connection.execute(stats.delete())
+    connection.execute(stats.insert().from_select(
+        ['device_type', 'status', 'department_id', 'department_key', 'count'],
+        _device_stats_count_select(),
+    ))
+
+def _device_stats_counts_for(connection, device_ids):
+    """{(device_type, status, department_id): n} for the given devices as they are in the database."""
+    device, user = Device.__table__, User.__table__
+    return {
+        (device_type, status, department_id): total
+        for device_type, status, department_id, total in connection.execute(
+            select(device.c.device_type, device.c.status, user.c.department_id, func.count(device.c.id))
+            .select_from(device.outerjoin(user, user.c.id == device.c.manager_id))
+            .where(device.c.id.in_(device_ids))
+            .group_by(device.c.device_type, device.c.status, user.c.department_id)
+        )
+    }
+
+def _add_device_stats_deltas(deltas, counts, sign=1):
+    for key, total in counts.items():
+        deltas[key] = deltas.get(key, 0) + sign * total
+    return deltas
+
+def _apply_device_stats_deltas(connection, deltas):
+    """Add per-key deltas to device_stats with one upsert per key (count = count + delta).
+
+    Concurrent writers touching the same key serialize on that row only, and nobody
+    recounts the device table.
+    """
+    stats = DeviceStats.__table__
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as upsert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as upsert
+    else:
+        upsert = None
+    emptied = []
+    for (device_type, status, department_id), delta in deltas.items():
+        if device_type is None or status is None or not delta:
+            continue
+        department_key = department_id or 0
+        key_filter = (
+            (stats.c.device_type == device_type)
+            & (stats.c.status == status)
+            & (stats.c.department_key == department_key)
+        )
+        if upsert is not None:
+            statement = upsert(stats).values(
+                device_type=device_type, status=status, department_id=department_id,
+                department_key=department_key, count=delta,
+            )
+            connection.execute(statement.on_conflict_do_update(
+                index_elements=['device_type', 'status', 'department_key'],
+                set_={'count': stats.c.count + statement.excluded.count},
+            ))
+        elif not connection.execute(stats.update().where(key_filter).values(count=stats.c.count + delta)).rowcount:
+            connection.execute(stats.insert().values(
+                device_type=device_type, status=status, department_id=department_id,
+                department_key=department_key, count=delta,
+            ))
+        if delta < 0:
+            emptied.append(key_filter)
+    if emptied:
+        connection.execute(stats.delete().where(or_(*emptied), stats.c.count <= 0))
+
+def _coerce_id(value):
+    """Integer id from a form value ('' and junk become None)."""
+    try:
+        return int(value) if value not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+_DEVICE_STATS_FIELDS = ('device_type', 'status', 'manager_id')
+
+def _device_stats_values(state, old=False, new=False):
+    """Return (device_type, status, manager_id) before/after the flush, or None if unknown.
+
+    For a freshly inserted row (new=True) an attribute that was never set is NULL in the database.
+    """
+    values = []
+    for field in _DEVICE_STATS_FIELDS:
+        if field not in state.dict and new:
+            values.append(None)
+            continue
+        if field not in state.dict and not old:
+            return None
+        history = state.attrs[field].history
+        if old and history.deleted:
+            values.append(history.deleted[0])
+        elif old and history.added:
+            return None
+        elif field in state.dict:
+            values.append(state.dict[field])
+        else:
+            return None
+    return tuple(values)
+
+@event.listens_for(db.session, 'after_flush')
+def _update_device_stats_after_flush(session, flush_context):
+    """Keep device_stats in sync with Device inserts, updates and deletes (and manager department moves)."""
+    changes = []  # (old_values, new_values)
+    dept_moves = {}  # user_id -> (old_department_id, new_department_id)
+    full_rebuild = False
+    for obj in session.new:
+        if isinstance(obj, Device):
+            changes.append((None, _device_stats_values(inspect(obj), new=True)))
+    for obj in session.deleted:
+        if isinstance(obj, Device):
+            values = _device_stats_values(inspect(obj), old=True)
+            full_rebuild = full_rebuild or values is None
+            changes.append((values, None))
+        elif isinstance(obj, User):
+            old_dept = _coerce_id(inspect(obj).dict.get('department_id'))
+            dept_moves[obj.id] = (old_dept, None)
+    for obj in session.dirty:
+        state = inspect(obj)
+        if isinstance(obj, Device):
+            if not any(state.attrs[field].history.has_changes() for field in _DEVICE_STATS_FIELDS):
+                continue
+            old_values, new_values = _device_stats_values(state, old=True), _device_stats_values(state)
+            full_rebuild = full_rebuild or old_values is None or new_values is None
+            changes.append((old_values, new_values))
+        elif isinstance(obj, User):
+            history = state.attrs.department_id.history
+            if history.has_changes():
+                old_dept = _coerce_id(history.deleted[0]) if history.deleted else None
+                dept_moves[obj.id] = (old_dept, _coerce_id(state.dict.get('department_id')))
+    if not changes and not dept_moves:
+        return
+
+    connection = session.connection()
+    if full_rebuild:
+        _rebuild_device_stats(connection)
+        return
+    user = User.__table__
+    manager_ids = {_coerce_id(values[2]) for pair in changes for values in pair if values and values[2]}
+    dept_of = {}
+    if manager_ids:
+        dept_of = dict(connection.execute(
+            select(user.c.id, user.c.department_id).where(user.c.id.in_(manager_ids))
+        ).all())
+    deltas = {}
+    for old_values, new_values in changes:
+        if old_values:
+            manager_id = _coerce_id(old_values[2])
+            old_dept = dept_moves[manager_id][0] if manager_id in dept_moves else dept_of.get(manager_id)
+            _add_device_stats_deltas(deltas, {(old_values[0], old_values[1], old_dept): 1}, -1)
+        if new_values:
+            new_dept = dept_of.get(_coerce_id(new_values[2]))
+            _add_device_stats_deltas(deltas, {(new_values[0], new_values[1], new_dept): 1})
+    dept_moves = {user_id: move for user_id, move in dept_moves.items() if move[0] != move[1]}
+    if dept_moves:
+        # Devices changed in this flush are already counted above with the right departments
+        device = Device.__table__
+        changed_ids = [obj.id for obj in list(session.new) + list(session.dirty) if isinstance(obj, Device)]
+        rows = connection.execute(
+            select(device.c.device_type, device.c.status, device.c.manager_id, func.count(device.c.id))
+            .where(device.c.manager_id.in_(list(dept_moves)), device.c.id.not_in(changed_ids))
+            .group_by(device.c.device_type, device.c.status, device.c.manager_id)
+        ).all()
+        for device_type, status, manager_id, total in rows:
+            old_dept, new_dept = dept_moves[manager_id]
+            _add_device_stats_deltas(deltas, {(device_type, status, old_dept): total}, -1)
+            _add_device_stats_deltas(deltas, {(device_type, status, new_dept): total})
+    _apply_device_stats_deltas(connection, deltas)
 
 DEVICE_PC_SPEC_FIELDS = {
     'cpu': 'CPU',
@@ -1342,6 +1565,33 @@ class UserRole(db.Model):
     role_id = db.Column(db.Integer, db.ForeignKey('role.id'), primary_key=True)
     role = db.relationship('Role')
 
+class CacheVersion(db.Model):
+    """Version counters shared by all workers to invalidate process-local caches."""
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class WorkerLease(db.Model):
+    """Named lease so that only one process at a time runs a singleton background worker."""
+    __tablename__ = 'worker_lease'
+    name = db.Column(db.String(64), primary_key=True)
+    holder = db.Column(db.String(255), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+class CodeSequence(db.Model):
+    """Last number handed out per (entity, prefix) for generated codes such as LT-001."""
+    __tablename__ = 'code_sequence'
+    entity = db.Column(db.String(32), primary_key=True)
+    prefix = db.Column(db.String(64), primary_key=True)
+    last_value = db.Column(db.Integer, nullable=False, default=0)
+
+class SearchToken(db.Model):
+    """One row per word of a user's or device's search_key; the primary key serves typeahead prefix scans."""
+    __tablename__ = 'search_token'
+    entity = db.Column(db.String(16), primary_key=True)  # see SEARCH_TOKEN_ENTITIES
+    token = db.Column(db.String(100), primary_key=True)
+    entity_id = db.Column(db.Integer, primary_key=True)
+
 class DeviceHandover(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     batch_id = db.Column(db.String(64))
@@ -1428,6 +1678,96 @@ class ConsumableHandoverItem(db.Model):
     receiver = db.relationship('User', foreign_keys=[receiver_id])
     giver = db.relationship('User', foreign_keys=[giver_id])
 
+class HandoverBatch(db.Model):
+    """Header row per handover form (batch_id), the unit handover_list pages through.
+
+    Derived from device_handover/consumable_handover_item by _sync_handover_batches; the
+    values come from the batch's first device_handover row (handover_id).
+    """
+    __tablename__ = 'handover_batch'
+    id = db.Column(db.Integer, primary_key=True)
+    batch_id = db.Column(db.String(64), nullable=False, unique=True)
+    handover_id = db.Column(db.Integer, nullable=False)
+    handover_date = db.Column(db.Date, nullable=False)
+    giver_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    location = db.Column(db.String(255))
+    device_count = db.Column(db.Integer, nullable=False, default=0)
+    consumable_count = db.Column(db.Integer, nullable=False, default=0)
+
+    giver = db.relationship('User', foreign_keys=[giver_id])
+    receiver = db.relationship('User', foreign_keys=[receiver_id])
+
+def _sync_handover_batches(batch_ids, connection=None):
+    """Recompute handover_batch headers for the given batch ids (insert, update or drop)."""
+    connection = connection or db.session.connection()
+    handover, items, header = DeviceHandover.__table__, ConsumableHandoverItem.__table__, HandoverBatch.__table__
+    fields = ('handover_id', 'handover_date', 'giver_id', 'receiver_id', 'location', 'device_count', 'consumable_count')
+    update_header = header.update().where(header.c.batch_id == bindparam('b_batch_id')).values(
+        **{field: bindparam(f'b_{field}') for field in fields}
+    )
+    for chunk in _chunked(list(dict.fromkeys(b for b in batch_ids if b))):
+        firsts = (
+            select(handover.c.batch_id, func.min(handover.c.id).label('handover_id'),
+                   func.count(handover.c.device_id).label('device_count'))
+            .where(handover.c.batch_id.in_(chunk))
+            .group_by(handover.c.batch_id)
+            .subquery()
+        )
+        rows = connection.execute(
+            select(firsts, handover.c.handover_date, handover.c.giver_id, handover.c.receiver_id, handover.c.location)
+            .join_from(firsts, handover, handover.c.id == firsts.c.handover_id)
+            .order_by(handover.c.handover_date, firsts.c.handover_id)
+        ).mappings().all()
+        consumable_counts = dict(connection.execute(
+            select(items.c.batch_id, func.count(items.c.id)).where(items.c.batch_id.in_(chunk)).group_by(items.c.batch_id)
+        ).all())
+        existing = {batch_id for (batch_id,) in connection.execute(select(header.c.batch_id).where(header.c.batch_id.in_(chunk)))}
+        values = [{**row, 'consumable_count': consumable_counts.get(row['batch_id'], 0)} for row in rows]
+        updates = [{f'b_{key}': value for key, value in row.items()} for row in values if row['batch_id'] in existing]
+        inserts = [row for row in values if row['batch_id'] not in existing]
+        if updates:
+            connection.execute(update_header, updates)
+        if inserts:
+            connection.execute(header.insert(), inserts)
+        gone = existing - {row['batch_id'] for row in values}
+        if gone:
+            connection.execute(header.delete().where(header.c.batch_id.in_(gone)))
+
+def _rebuild_handover_batches(connection=None):
+    """Give legacy handovers (no batch_id) a batch of their own and rebuild every header."""
+    connection = connection or db.session.connection()
+    handover = DeviceHandover.__table__
+    connection.execute(
+        handover.update().where(handover.c.batch_id.is_(None)).values(batch_id='legacy-' + cast(handover.c.id, String))
+    )
+    connection.execute(HandoverBatch.__table__.delete())
+    # Oldest batches first, so header ids follow the handover history
+    batch_ids = [batch_id for (batch_id,) in connection.execute(
+        select(handover.c.batch_id).group_by(handover.c.batch_id).order_by(func.min(handover.c.handover_date), func.min(handover.c.id))
+    )]
+    _sync_handover_batches(batch_ids, connection)
+
+@event.listens_for(db.session, 'before_flush')
+def _assign_handover_batch_ids(session, flush_context, instances):
+    # Every handover belongs to a batch, even single-device ones (e.g. a device return)
+    for obj in session.new:
+        if isinstance(obj, DeviceHandover) and not obj.batch_id:
+            obj.batch_id = uuid.uuid4().hex
+
+@event.listens_for(db.session, 'after_flush')
+def _sync_handover_batches_after_flush(session, flush_context):
+    """Keep handover_batch in step with ORM writes to handovers and tracked consumable items."""
+    batch_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (DeviceHandover, ConsumableHandoverItem)):
+            state = inspect(obj)
+            batch_ids.add(state.dict.get('batch_id'))
+            batch_ids.update(state.attrs.batch_id.history.deleted or ())
+    batch_ids.discard(None)
+    if batch_ids:
+        _sync_handover_batches(batch_ids, session.connection())
+
 class StockItemCategory(db.Model):
     """A reusable stock category with its own custom specification fields."""
     id = db.Column(db.Integer, primary_key=True)
@@ -1618,6 +1958,41 @@ class BackupLog(db.Model):
     
     user = db.relationship('User', backref='backup_logs')
 
+class BackgroundJob(db.Model):
+    """Queued long-running task (Excel import, backup restore) picked up by a job worker."""
+    __tablename__ = 'background_job'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)  # queued, running, succeeded, failed
+    progress = db.Column(db.Integer, default=0)
+    rows_total = db.Column(db.Integer)
+    rows_done = db.Column(db.Integer, default=0)
+    message = db.Column(db.Text)
+    params = db.Column(db.Text)  # JSON
+    result = db.Column(db.Text)  # JSON
+    input_path = db.Column(db.String(500))
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    claimed_by = db.Column(db.String(200))
+    claim_token = db.Column(db.String(64))
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+class TelegramOutbox(db.Model):
+    """Telegram message waiting for (or done with) delivery by the outbox worker."""
+    __tablename__ = 'telegram_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    chat_id = db.Column(db.String(100), nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    claim_token = db.Column(db.String(64))
+    claimed_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
 
 
 class OrderTracking(db.Model):
@@ -1729,6 +2104,429 @@ class BugReportAttachment(db.Model):
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
     bug_report = db.relationship('BugReport', backref=db.backref('attachments', cascade='all, delete-orphan'))
 
+# --- Filter option cache ---
+# Dropdown/facet values (device types, departments, positions, ...) cached per process with a
+# TTL. Writes queue the touched groups on the session (see the after_flush hook below); once
+# the transaction has committed, the shared 'filter:<group>' counters in cache_version are bumped
+# in a short transaction of their own, so other workers drop their copy on their next request.
+FILTER_CACHE_TTL = 300
+_filter_option_cache = {}
+_filter_option_cache_lock = threading.Lock()  # request, job worker and outbox threads all commit
+
+def _filter_cache_versions():
+    """Current 'filter:*' versions, read once per request."""
+    versions = g.get('_filter_cache_versions') if has_app_context() else None
+    if versions is None:
+        versions = {
+            name[len('filter:'):]: version
+            for name, version in db.session.query(CacheVersion.name, CacheVersion.version)
+            .filter(CacheVersion.name.like('filter:%')).all()
+        }
+        if has_app_context():
+            g._filter_cache_versions = versions
+    return versions
+
+def _cached_filter_options(group, loader, key=None, ttl=FILTER_CACHE_TTL):
+    """Return a copy of loader() from the per-process cache for `group` (and optional key)."""
+    try:
+        version = _filter_cache_versions().get(group, 0)
+    except Exception:
+        return loader()
+    cache_key = (group, key)
+    with _filter_option_cache_lock:
+        entry = _filter_option_cache.get(cache_key)
+    now = time.monotonic()
+    if entry is None or entry[0] != version or entry[1] <= now:
+        entry = (version, now + ttl, loader())
+        with _filter_option_cache_lock:
+            _filter_option_cache[cache_key] = entry
+    return copy.deepcopy(entry[2])
+
+def _drop_local_filter_options(groups):
+    with _filter_option_cache_lock:
+        for cache_key in [k for k in _filter_option_cache if k[0] in groups]:
+            del _filter_option_cache[cache_key]
+
+def _invalidate_filter_options(*groups):
+    """Write-through invalidation: the groups are dropped and their versions bumped after commit.
+
+    Bumping inside the writer's transaction would hold the shared cache_version row lock until
+    commit and serialize unrelated writers on it.
+    """
+    db.session.info.setdefault('pending_filter_invalidations', set()).update(groups)
+
+@event.listens_for(db.session, 'after_commit')
+def _bump_filter_versions_after_commit(session):
+    groups = session.info.pop('pending_filter_invalidations', None)
+    if not groups:
+        return
+    _drop_local_filter_options(groups)
+    try:
+        with db.engine.begin() as connection:
+            # Fixed order, one short transaction: concurrent bumpers cannot deadlock
+            for group in sorted(groups):
+                _bump_cache_version(f'filter:{group}', connection)
+    except Exception as exc:
+        # Other workers fall back to FILTER_CACHE_TTL
+        app.logger.warning(f'Could not bump filter cache versions {sorted(groups)}: {exc}')
+
+@event.listens_for(db.session, 'after_rollback')
+def _drop_pending_filter_invalidations(session):
+    session.info.pop('pending_filter_invalidations', None)
+
+# Model -> (cache group, columns whose change affects it; None = any change)
+_FILTER_CACHE_SOURCES = [
+    (Device, 'device_types', ('device_type',)),
+    (Department, 'departments', None),
+    (User, 'users', ('role', 'position')),
+    (DeviceType, 'device_type_hierarchy', None),
+    (ConsumableItem, 'consumables', ('category', 'group_name')),
+    (ConfigProposal, 'config_proposals', ('proposer_name', 'proposer_unit', 'status', 'created_by')),
+]
+
+@event.listens_for(db.session, 'after_flush')
+def _invalidate_filter_options_after_flush(session, flush_context):
+    groups = set()
+    for model, group, columns in _FILTER_CACHE_SOURCES:
+        for obj in list(session.new) + list(session.deleted):
+            if isinstance(obj, model):
+                groups.add(group)
+                break
+        if group in groups:
+            continue
+        for obj in session.dirty:
+            if not isinstance(obj, model):
+                continue
+            state = inspect(obj)
+            watched = columns or [attr.key for attr in state.mapper.column_attrs]
+            if any(state.attrs[column].history.has_changes() for column in watched):
+                groups.add(group)
+                break
+    if groups:
+        _invalidate_filter_options(*groups)
+
+def _device_type_options():
+    return _cached_filter_options('device_types', lambda: sorted(
+        item[0] for item in db.session.query(Device.device_type).distinct().all()
+    ))
+
+def _department_name_options():
+    return _cached_filter_options('departments', lambda: [
+        row[0] for row in db.session.query(Department.name).order_by(Department.name).all()
+    ])
+
+def _position_options():
+    return _cached_filter_options('users', lambda: [
+        row[0] for row in db.session.query(User.position).filter(User.position.isnot(None)).distinct().order_by(User.position)
+    ], key='positions')
+
+def _primary_admin():
+    admin_id = _cached_filter_options('users', lambda: db.session.query(func.min(User.id)).filter(User.role == 'admin').scalar(), key='primary_admin')
+    return User.query.get(admin_id) if admin_id else None
+
+# --- Search and sort keys ---
+# Pick lists (managers, receivers, devices) are filled incrementally from /api/search/* instead
+# of rendering every row. Those endpoints match against search_key: the columns below, unaccented
+# and casefolded, split into words and stored one per row in search_token so a query word is a
+# prefix range scan on its primary key. Users also carry sort_key (given name first, the Vietnamese
+# reading order) so every user list is ordered straight off an index. All of it is kept in step by
+# the flush hooks and by the bulk insert paths; `flask backfill-user-keys` rebuilds them.
+SEARCH_KEY_COLUMNS = {
+    User: ('full_name', 'username', 'email'),
+    Device: ('device_code', 'name', 'serial_number'),
+}
+SEARCH_TOKEN_ENTITIES = {User: 'user', Device: 'device'}
+SEARCH_TOKEN_LENGTH = 100
+
+def _search_fold(*values):
+    """'Nguyễn Văn Đức' -> 'nguyen van duc': no diacritics, casefolded, single spaces."""
+    joined = ' '.join(str(value) for value in values if value)
+    folded = unicodedata.normalize('NFKD', joined.replace('đ', 'd').replace('Đ', 'D'))
+    return ' '.join(''.join(ch for ch in folded if not unicodedata.combining(ch)).casefold().split())
+
+def _user_sort_key(full_name, username):
+    """'Nguyễn Văn Đức' / 'ducnv' -> 'duc nguyen van ducnv'."""
+    words = _search_fold(full_name).split()
+    return ' '.join(words[-1:] + words[:-1] + [_search_fold(username)]).strip() or None
+
+def _derived_keys(model, values):
+    """search_key (and sort_key for users) from a mapping of the model's source columns."""
+    keys = {'search_key': _search_fold(*(values.get(column) for column in SEARCH_KEY_COLUMNS[model])) or None}
+    if model is User:
+        keys['sort_key'] = _user_sort_key(values.get('full_name'), values.get('username'))
+    return keys
+
+@event.listens_for(db.session, 'before_flush')
+def _assign_derived_keys(session, flush_context, instances):
+    for obj in list(session.new) + list(session.dirty):
+        columns = SEARCH_KEY_COLUMNS.get(type(obj))
+        if not columns:
+            continue
+        for key, value in _derived_keys(type(obj), {column: getattr(obj, column) for column in columns}).items():
+            if getattr(obj, key) != value:
+                setattr(obj, key, value)
+
+def _search_tokens(key):
+    """'lt-001 dell latitude' -> ['001', 'dell', 'latitude', 'lt']: the distinct words of a folded key."""
+    return sorted({word[:SEARCH_TOKEN_LENGTH] for word in re.findall(r'\w+', key or '')})
+
+def _write_search_tokens(connection, model, rows):
+    """Replace the search_token rows of (id, search_key) pairs; a None key just drops the row's tokens."""
+    tokens = SearchToken.__table__
+    entity = SEARCH_TOKEN_ENTITIES[model]
+    rows = list(rows)
+    for chunk in _chunked(rows):
+        connection.execute(tokens.delete().where(
+            tokens.c.entity == entity, tokens.c.entity_id.in_([entity_id for entity_id, _ in chunk])
+        ))
+    inserts = [
+        {'entity': entity, 'token': token, 'entity_id': entity_id}
+        for entity_id, key in rows for token in _search_tokens(key)
+    ]
+    for chunk in _chunked(inserts):
+        connection.execute(tokens.insert(), chunk)
+
+@event.listens_for(db.session, 'after_flush')
+def _maintain_search_tokens_after_flush(session, flush_context):
+    changed = {}
+    for obj in list(session.new) + list(session.dirty):
+        model = type(obj)
+        if model not in SEARCH_TOKEN_ENTITIES:
+            continue
+        if obj in session.new or inspect(obj).attrs.search_key.history.has_changes():
+            changed.setdefault(model, []).append((obj.id, obj.search_key))
+    for obj in session.deleted:
+        if type(obj) in SEARCH_TOKEN_ENTITIES:
+            changed.setdefault(type(obj), []).append((obj.id, None))
+    if changed:
+        connection = session.connection()
+        for model, rows in changed.items():
+            _write_search_tokens(connection, model, rows)
+
+def _rebuild_search_tokens():
+    """Rewrite search_token from the stored search keys (startup backfill and CLI)."""
+    connection = db.session.connection()
+    connection.execute(SearchToken.__table__.delete())
+    for model in SEARCH_TOKEN_ENTITIES:
+        _write_search_tokens(connection, model, db.session.query(model.id, model.search_key)
+                             .filter(model.search_key.isnot(None)).all())
+
+def _backfill_derived_keys(only_missing=True):
+    """Recompute search_key/sort_key for users and devices; returns the number of rows written."""
+    written = 0
+    for model, columns in SEARCH_KEY_COLUMNS.items():
+        model_table = model.__table__
+        key_columns = list(_derived_keys(model, {}))
+        query = db.session.query(model.id, *(getattr(model, column) for column in columns))
+        if only_missing:
+            query = query.filter(or_(*(getattr(model, key).is_(None) for key in key_columns)))
+        updates = [
+            {'b_id': row[0], **{f'b_{key}': value for key, value in _derived_keys(model, dict(zip(columns, row[1:]))).items()}}
+            for row in query.all()
+        ]
+        statement = model_table.update().where(model_table.c.id == bindparam('b_id'))\
+            .values(**{key: bindparam(f'b_{key}') for key in key_columns})
+        for chunk in _chunked(updates):
+            db.session.execute(statement, chunk)
+            _write_search_tokens(db.session.connection(), model, [(row['b_id'], row['b_search_key']) for row in chunk])
+        written += len(updates)
+    return written
+
+def _ensure_derived_keys():
+    """Fill the keys for rows written before the columns existed (or restored from old backups)."""
+    try:
+        written = _backfill_derived_keys()
+        if db.session.query(SearchToken.entity).first() is None:
+            _rebuild_search_tokens()
+        db.session.commit()
+        if written:
+            print(f"[OK] Filled search/sort keys for {written} rows")
+    except Exception as exc:
+        db.session.rollback()
+        print(f"Search key backfill error: {exc}")
+
+# --- Index registry ---
+# Secondary indexes on existing tables, declared next to the models. ensure_model_indexes()
+# creates whatever is missing at startup; `flask index-report` lists each index with the
+# routes whose queries it serves.
+MODEL_INDEXES = [
+    ('ix_device_device_type', Device, ('device_type',),
+     ('device_list', 'home', 'edit_device_type', 'export_devices_excel')),
+    ('ix_device_status', Device, ('status',),
+     ('device_list', 'convert_devices_to_consumables')),
+    ('ix_device_manager_id', Device, ('manager_id',),
+     ('device_list', 'user_detail', 'edit_user', 'quit_user', 'api_device_search', 'api_search_devices')),
+    ('ix_device_handover_batch_id', DeviceHandover, ('batch_id',),
+     ('handover_list', 'handover_detail', 'edit_handover', 'delete_handover')),
+    ('ix_device_handover_device_id', DeviceHandover, ('device_id',),
+     ('device_detail', 'handover_list', 'delete_device')),
+    ('ix_device_handover_giver_id', DeviceHandover, ('giver_id',),
+     ('handover_list', 'user_detail')),
+    ('ix_device_handover_receiver_id', DeviceHandover, ('receiver_id',),
+     ('handover_list', 'user_detail')),
+    ('ix_device_handover_handover_date', DeviceHandover, ('handover_date',),
+     ('export_handovers_excel',)),
+    ('ix_user_sort_key_id', User, ('sort_key', 'id'),
+     ('user_list', 'device_list', 'add_device', 'edit_device', 'add_handover', 'department_users', 'api_search_users', 'export_users_excel')),
+    ('ix_device_search_key', Device, ('search_key',),
+     ('api_search_devices',)),
+    ('ix_handover_batch_date_id', HandoverBatch, ('handover_date DESC', 'id DESC'),
+     ('handover_list',)),
+    ('ix_notification_user_id_is_read', Notification, ('user_id', 'is_read'),
+     ('inject_user (every page)', 'all_notifications', 'read_all_notifications')),
+    ('ix_telegram_outbox_status_next', TelegramOutbox, ('status', 'next_attempt_at'),
+     ('telegram outbox worker',)),
+    ('ix_bug_report_created_by', BugReport, ('created_by',),
+     ('bug_reports', 'bug_report_detail', 'user_detail')),
+    ('ix_bug_report_assigned_to', BugReport, ('assigned_to',),
+     ('bug_reports', 'bug_report_detail')),
+    ('ix_bug_report_status', BugReport, ('status',),
+     ('bug_reports',)),
+    ('ix_bug_report_created_at', BugReport, ('created_at',),
+     ('bug_reports',)),
+    ('ix_bug_report_merged_into', BugReport, ('merged_into',),
+     ('bug_reports', 'merge_bug_reports', 'bug_report_detail')),
+    ('ix_audit_log_entity', AuditLog, ('entity_type', 'entity_id'),
+     ('_log_audit history lookups (no list route yet)',)),
+    ('ix_consumable_transaction_item_date', ConsumableTransaction, ('consumable_id', 'transaction_date'),
+     ('consumable_list', 'delete_consumable', 'export_consumables_excel')),
+    ('ix_stock_item_movement_item_date', StockItemMovement, ('item_id', 'movement_date'),
+     ('stock_item_list', 'stock_item_units_api', 'delete_stock_item')),
+]
+
+def _index_column_sql(column, preparer):
+    """Quote 'col' or 'col DESC' for CREATE INDEX."""
+    name, _, direction = column.partition(' ')
+    return f"{preparer.quote(name)} {direction.upper()}".strip()
+
+def ensure_model_indexes():
+    """Create registry indexes that do not exist yet (CONCURRENTLY on PostgreSQL)."""
+    with app.app_context():
+        try:
+            inspector = inspect(db.engine)
+            existing_tables = set(inspector.get_table_names())
+            preparer = db.engine.dialect.identifier_preparer
+            is_postgres = db.engine.dialect.name == 'postgresql'
+            with db.engine.connect() as conn:
+                if is_postgres:
+                    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+                    conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+                    invalid = {row[0] for row in conn.execute(text(
+                        "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE NOT i.indisvalid"
+                    ))}
+                for name, model, columns, _routes in MODEL_INDEXES:
+                    table_name = model.__tablename__
+                    if table_name not in existing_tables:
+                        continue
+                    existing = {ix['name'] for ix in inspector.get_indexes(table_name)}
+                    if is_postgres and name in invalid:
+                        # Leftover of an interrupted concurrent build
+                        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {preparer.quote(name)}"))
+                        existing.discard(name)
+                    if name in existing:
+                        continue
+                    column_sql = ', '.join(_index_column_sql(column, preparer) for column in columns)
+                    concurrently = 'CONCURRENTLY ' if is_postgres else ''
+                    try:
+                        conn.execute(text(
+                            f"CREATE INDEX {concurrently}IF NOT EXISTS {preparer.quote(name)} "
+                            f"ON {preparer.quote(table_name)} ({column_sql})"
+                        ))
+                        if not is_postgres:
+                            conn.commit()
+                        print(f"[OK] Created index {name}")
+                    except Exception as e:
+                        print(f"[WARN] Could not create index {name}: {e}")
+        except Exception as e:
+            print(f"Index check error: {e}")
+
+def model_index_report():
+    """Rows of (index, table, columns, present, routes) for the registry."""
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    report = []
+    for name, model, columns, routes in MODEL_INDEXES:
+        table_name = model.__tablename__
+        present = table_name in tables and name in {ix['name'] for ix in inspector.get_indexes(table_name)}
+        report.append((name, table_name, columns, present, routes))
+    return report
+
+# --- Process-local RBAC cache ---
+# Each worker keeps user -> permission and role -> permission sets in memory.
+# Writers bump the shared 'rbac' counter in cache_version inside their transaction;
+# readers compare it once per request and drop the local cache when it moved.
+RBAC_CACHE_KEY = 'rbac'
+_rbac_cache = {'version': None, 'users': {}, 'roles': {}, 'all_permissions': None}
+_rbac_cache_lock = threading.Lock()
+
+def _bump_cache_version(name, connection=None):
+    """Increase a shared cache version counter; takes effect at the caller's commit."""
+    connection = connection or db.session.connection()
+    versions = CacheVersion.__table__
+    result = connection.execute(
+        versions.update()
+        .where(versions.c.name == name)
+        .values(version=versions.c.version + 1, updated_at=datetime.utcnow())
+    )
+    if not result.rowcount:
+        connection.execute(versions.insert().values(name=name, version=1, updated_at=datetime.utcnow()))
+
+def _bump_rbac_version():
+    _bump_cache_version(RBAC_CACHE_KEY)
+
+def _rbac_cache_sync(version):
+    """Drop cached permission sets if another worker changed RBAC data."""
+    with _rbac_cache_lock:
+        if _rbac_cache['version'] != version:
+            _rbac_cache['version'] = version
+            _rbac_cache['users'] = {}
+            _rbac_cache['roles'] = {}
+            _rbac_cache['all_permissions'] = None
+
+def _cached_all_permissions():
+    perms = _rbac_cache['all_permissions']
+    if perms is None:
+        perms = frozenset(code for (code,) in db.session.query(Permission.code).all())
+        _rbac_cache['all_permissions'] = perms
+    return perms
+
+def _cached_role_permissions(role_ids):
+    """Return {role_id: frozenset(codes)}, loading missing roles in one query."""
+    roles = _rbac_cache['roles']
+    missing = [rid for rid in role_ids if rid not in roles]
+    if missing:
+        loaded = {rid: set() for rid in missing}
+        rows = (
+            db.session.query(RolePermission.role_id, Permission.code)
+            .join(Permission, Permission.id == RolePermission.permission_id)
+            .filter(RolePermission.role_id.in_(missing))
+            .all()
+        )
+        for role_id, code in rows:
+            loaded[role_id].add(code)
+        for role_id, codes in loaded.items():
+            roles[role_id] = frozenset(codes)
+    return {rid: roles[rid] for rid in role_ids}
+
+def _cached_user_permissions(user_id):
+    """Return (is_admin_role, permission codes) for a user from the local cache."""
+    entry = _rbac_cache['users'].get(user_id)
+    if entry is None:
+        role_rows = (
+            db.session.query(Role.id, Role.name)
+            .join(UserRole, UserRole.role_id == Role.id)
+            .filter(UserRole.user_id == user_id)
+            .all()
+        )
+        role_perms = _cached_role_permissions([rid for rid, _ in role_rows])
+        codes = set()
+        for perm_set in role_perms.values():
+            codes.update(perm_set)
+        is_admin_role = any((name or '').lower() == 'admin' for _, name in role_rows)
+        entry = (is_admin_role, frozenset(codes))
+        _rbac_cache['users'][user_id] = entry
+    return entry
+
 def seed_rbac_data():
     """Seed RBAC permissions and roles after models are defined"""
     with app.app_context():
@@ -1803,6 +2601,8 @@ def seed_rbac_data():
                     db.session.add(UserRole(user_id=admin_user.id, role_id=admin_role.id))
                     db.session.commit()
             
+            _bump_rbac_version()
+            db.session.commit()
             print("RBAC data seeded successfully")
         except Exception as e:
             print(f"RBAC seed error: {e}")
@@ -1833,6 +2633,7 @@ def _assign_admin_role(user):
     admin_role = Role.query.filter_by(name='Admin').first()
     if admin_role and not UserRole.query.filter_by(user_id=user.id, role_id=admin_role.id).first():
         db.session.add(UserRole(user_id=user.id, role_id=admin_role.id))
+        _bump_rbac_version()
 
 def _assign_manager_role(user_id):
     if not user_id:
@@ -1840,6 +2641,7 @@ def _assign_manager_role(user_id):
     manager_role = Role.query.filter_by(name='Manager').first()
     if manager_role and not UserRole.query.filter_by(user_id=int(user_id), role_id=manager_role.id).first():
         db.session.add(UserRole(user_id=int(user_id), role_id=manager_role.id))
+        _bump_rbac_version()
 
 def create_initial_admin(username, password, full_name=None, email=None):
     """Create the first administrator account for a fresh installation."""
@@ -1886,6 +2688,9 @@ def _get_device_type_category_choices():
 
 # Helper to return device hierarchy from database dynamically.
 def _get_device_type_hierarchy():
+    return _cached_filter_options('device_type_hierarchy', _load_device_type_hierarchy)
+
+def _load_device_type_hierarchy():
     hierarchy = {}
     
     # 1. Fetch all DeviceType records
@@ -1941,6 +2746,24 @@ def _log_audit(entity_type, entity_id, old_dict, new_dict):
         # Do not break main flow if logging fails
         pass
 
+def _log_audit_bulk(entity_type, entries):
+    """Write audit rows for [(entity_id, old_dict, new_dict), ...] with a single INSERT."""
+    try:
+        changed_by = session.get('user_id')
+        now = datetime.utcnow()
+        rows = []
+        for entity_id, old_dict, new_dict in entries:
+            changes = _diff_changes(old_dict, new_dict)
+            if changes:
+                rows.append({
+                    'entity_type': entity_type, 'entity_id': entity_id, 'changed_by': changed_by,
+                    'changed_at': now, 'changes': json.dumps(changes, ensure_ascii=False),
+                })
+        if rows:
+            db.session.execute(AuditLog.__table__.insert(), rows)
+    except Exception:
+        pass
+
 def _default_device_type_prefixes():
     return {
         'Laptop': 'LT',
@@ -2090,6 +2913,143 @@ def _stock_item_specifications(item):
     except (TypeError, ValueError, json.JSONDecodeError):
         return {}
 
+def _rebuild_department_closure():
+    """Recompute department_closure from parent_id links (startup backfill and CLI only)."""
+    db.session.flush()
+    parent_of = dict(db.session.query(Department.id, Department.parent_id).all())
+    rows = []
+    for dept_id in parent_of:
+        # Walk up to the root with cycle protection
+        current, depth, seen = dept_id, 0, set()
+        while current is not None and current in parent_of and current not in seen:
+            seen.add(current)
+            rows.append({'ancestor_id': current, 'descendant_id': dept_id, 'depth': depth})
+            current = parent_of[current]
+            depth += 1
+    DepartmentClosure.query.delete(synchronize_session=False)
+    if rows:
+        db.session.execute(DepartmentClosure.__table__.insert(), rows)
+
+def _attach_department_subtree(connection, dept_id, parent_id):
+    """Link every node under dept_id to parent_id and its ancestors (dept_id must be detached)."""
+    if parent_id is None:
+        return
+    closure = DepartmentClosure.__table__
+    up, down = closure.alias('up'), closure.alias('down')
+    cyclic = connection.execute(
+        select(closure.c.ancestor_id)
+        .where(closure.c.ancestor_id == dept_id, closure.c.descendant_id == parent_id)
+    ).first()
+    if cyclic:
+        # The new parent sits inside the subtree: linking would close a cycle, keep it detached
+        return
+    connection.execute(closure.insert().from_select(
+        ['ancestor_id', 'descendant_id', 'depth'],
+        select(up.c.ancestor_id, down.c.descendant_id, up.c.depth + down.c.depth + 1)
+        .select_from(up.join(down, down.c.ancestor_id == dept_id))
+        .where(up.c.descendant_id == parent_id),
+    ))
+
+def _detach_department_subtree(connection, dept_id):
+    """Drop the links between the subtree under dept_id and the ancestors outside it."""
+    closure = DepartmentClosure.__table__
+    subtree = select(closure.c.descendant_id).where(closure.c.ancestor_id == dept_id)
+    connection.execute(closure.delete().where(
+        closure.c.descendant_id.in_(subtree),
+        closure.c.ancestor_id.not_in(subtree),
+    ))
+
+def _link_new_departments(connection, parents):
+    """Add closure rows for freshly inserted departments; parents maps id -> parent_id.
+
+    Departments whose parent is inserted in the same batch are linked after that parent.
+    """
+    closure = DepartmentClosure.__table__
+    pending = dict(parents)
+    if pending:
+        connection.execute(closure.insert(), [
+            {'ancestor_id': dept_id, 'descendant_id': dept_id, 'depth': 0} for dept_id in pending
+        ])
+    while pending:
+        ready = [dept_id for dept_id, parent_id in pending.items() if parent_id not in pending]
+        if not ready:
+            break  # cycle inside the batch: the remaining ones stay roots
+        for dept_id in ready:
+            _attach_department_subtree(connection, dept_id, pending.pop(dept_id))
+
+@event.listens_for(db.session, 'after_flush')
+def _maintain_department_closure_after_flush(session, flush_context):
+    """Keep department_closure in sync with Department inserts, deletes and parent moves."""
+    added, deleted, moved = {}, [], []
+    for obj in session.new:
+        if isinstance(obj, Department):
+            added[obj.id] = _coerce_id(obj.parent_id)
+    for obj in session.deleted:
+        if isinstance(obj, Department):
+            deleted.append(obj.id)
+    for obj in session.dirty:
+        if isinstance(obj, Department):
+            history = inspect(obj).attrs.parent_id.history
+            if not history.has_changes():
+                continue
+            old_parent = _coerce_id(history.deleted[0]) if history.deleted else None
+            new_parent = _coerce_id(obj.parent_id)
+            if old_parent != new_parent:
+                moved.append((obj.id, new_parent))
+    if not (added or deleted or moved):
+        return
+
+    connection = session.connection()
+    closure = DepartmentClosure.__table__
+    if deleted:
+        connection.execute(closure.delete().where(
+            closure.c.ancestor_id.in_(deleted) | closure.c.descendant_id.in_(deleted)
+        ))
+    _link_new_departments(connection, added)
+    for dept_id, parent_id in moved:
+        _detach_department_subtree(connection, dept_id)
+        _attach_department_subtree(connection, dept_id, parent_id)
+
+def _ensure_department_closure():
+    """Backfill department_closure when it is out of sync with the department table."""
+    try:
+        dept_count = db.session.query(func.count(Department.id)).scalar() or 0
+        self_rows = db.session.query(func.count()).select_from(DepartmentClosure).filter(DepartmentClosure.depth == 0).scalar() or 0
+        if dept_count != self_rows:
+            _rebuild_department_closure()
+            db.session.commit()
+            print("[OK] Rebuilt department_closure")
+    except Exception as exc:
+        db.session.rollback()
+        print(f"Department closure backfill error: {exc}")
+
+def _ensure_device_stats():
+    """Backfill device_stats on first start after the rollup table was introduced."""
+    try:
+        stats_indexes = {ix['name'] for ix in inspect(db.engine).get_indexes(DeviceStats.__tablename__)}
+        if 'ux_device_stats_key' not in stats_indexes:
+            # Table from before the unique key: it only holds derived data, so recreate it
+            DeviceStats.__table__.drop(db.engine)
+            DeviceStats.__table__.create(db.engine)
+        if DeviceStats.query.first() is None and Device.query.first() is not None:
+            _rebuild_device_stats()
+            db.session.commit()
+            print("[OK] Built device_stats rollup")
+    except Exception as exc:
+        db.session.rollback()
+        print(f"Device stats backfill error: {exc}")
+
+def _ensure_handover_batches():
+    """Backfill handover_batch on first start after the header table was introduced."""
+    try:
+        if HandoverBatch.query.first() is None and DeviceHandover.query.first() is not None:
+            _rebuild_handover_batches()
+            db.session.commit()
+            print("[OK] Built handover_batch headers")
+    except Exception as exc:
+        db.session.rollback()
+        print(f"Handover batch backfill error: {exc}")
+
 def _seed_stock_item_categories():
     try:
         for name, prefix, fields in STOCK_CATEGORY_DEFAULTS:
@@ -2134,22 +3094,73 @@ def _stock_image_list(image_value):
         return [image_value.strip()]
     return []
 
-def _normalize_stock_prefix(prefix):
-    return re.sub(r'[^A-Z0-9]', '', (prefix or '').upper())[:20] or 'VT'
-
-def _generate_stock_item_code(category):
-    prefix = _normalize_stock_prefix(category.code_prefix if category else '')
+# --- Code sequences ---
+def _max_code_number(column, prefix):
+    """Highest N among existing codes shaped PREFIX-N (used once to seed a sequence)."""
     pattern = re.compile(rf'^{re.escape(prefix)}-(\d+)$', re.IGNORECASE)
     max_number = 0
-    for (code,) in db.session.query(StockItem.code).filter(StockItem.code.ilike(f'{prefix}-%')).all():
+    for (code,) in db.session.query(column).filter(column.ilike(f'{prefix}-%')).all():
         match = pattern.match(code or '')
         if match:
             max_number = max(max_number, int(match.group(1)))
-    for number in range(max_number + 1, max_number + 10000):
-        candidate = f'{prefix}-{number:03d}'
-        if not StockItem.query.filter(func.upper(StockItem.code) == candidate).first():
-            return candidate
-    return f'{prefix}-{datetime.utcnow().strftime("%H%M%S")}'
+    return max_number
+
+def _reserve_code_numbers(entity, prefix, count=1, seed=None):
+    """Atomically reserve `count` consecutive numbers for (entity, prefix) in the current transaction.
+
+    The sequence row stays locked until the caller commits, so concurrent requests for the same
+    prefix are serialized instead of racing on max()+1. `seed` returns the starting value when
+    the row does not exist yet.
+    """
+    connection = db.session.connection()
+    sequence = CodeSequence.__table__
+    key = (sequence.c.entity == entity) & (sequence.c.prefix == prefix)
+    increment = sequence.update().where(key).values(last_value=sequence.c.last_value + count)
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+        last_value = connection.execute(increment.returning(sequence.c.last_value)).scalar()
+        if last_value is None:
+            connection.execute(
+                pg_insert(sequence)
+                .values(entity=entity, prefix=prefix, last_value=seed() if seed else 0)
+                .on_conflict_do_nothing()
+            )
+            last_value = connection.execute(increment.returning(sequence.c.last_value)).scalar()
+    else:
+        if dialect == 'sqlite' and not connection.connection.dbapi_connection.in_transaction:
+            # Take the write lock before reading so the seed scan and the increment cannot interleave
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+        if not connection.execute(increment).rowcount:
+            connection.execute(sequence.insert().values(
+                entity=entity, prefix=prefix, last_value=(seed() if seed else 0) + count,
+            ))
+        last_value = connection.execute(select(sequence.c.last_value).where(key)).scalar()
+    return list(range(last_value - count + 1, last_value + 1))
+
+def _allocate_codes(entity, prefix, count, render, column, seed=None, reserved=None):
+    """Reserve `count` codes rendered from the sequence, skipping any that already exist
+    (e.g. typed in by hand) or are in `reserved`."""
+    reserved = {code.upper() for code in (reserved or ())}
+    codes = []
+    while len(codes) < count:
+        candidates = [render(number) for number in _reserve_code_numbers(entity, prefix, count - len(codes), seed)]
+        taken = {
+            (row[0] or '').upper()
+            for row in db.session.query(column).filter(func.upper(column).in_([c.upper() for c in candidates])).all()
+        }
+        codes.extend(c for c in candidates if c.upper() not in taken and c.upper() not in reserved)
+    return codes
+
+def _normalize_stock_prefix(prefix):
+    return re.sub(r'[^A-Z0-9]', '', (prefix or '').upper())[:20] or 'VT'
+
+def _generate_stock_item_code(category):
+    prefix = _normalize_stock_prefix(category.code_prefix if category else '')
+    return _allocate_codes(
+        'stock_item', prefix, 1, lambda number: f'{prefix}-{number:03d}', StockItem.code,
+        seed=lambda: _max_code_number(StockItem.code, prefix),
+    )[0]
 
 def _parse_stock_specifications(raw, category):
     try:
@@ -2167,19 +3178,60 @@ def _parse_stock_specifications(raw, category):
 
 def _generate_unit_codes(item, count=1):
     prefix = f"QLTB-{item.code}"
-    pattern = re.compile(rf'^{re.escape(prefix)}-(\d+)$', re.IGNORECASE)
-    existing_codes = db.session.query(StockItemUnit.unit_code).filter(StockItemUnit.unit_code.ilike(f'{prefix}-%')).all()
-    max_num = 0
-    for (code,) in existing_codes:
-        match = pattern.match(code or '')
-        if match:
-            max_num = max(max_num, int(match.group(1)))
-    
-    codes = []
-    for i in range(1, count + 1):
-        num = max_num + i
-        codes.append(f"{prefix}-{num:03d}")
-    return codes
+    return _allocate_codes(
+        'stock_unit', prefix, count, lambda number: f"{prefix}-{number:03d}", StockItemUnit.unit_code,
+        seed=lambda: _max_code_number(StockItemUnit.unit_code, prefix),
+    )
+
+def _bulk_create_stock_units(item, quantity, serials):
+    """Insert `quantity` tracked units for a stock-in in one statement and return their ids."""
+    if quantity <= 0:
+        return []
+    codes = _generate_unit_codes(item, quantity)
+    rows = []
+    for i, code in enumerate(codes):
+        serial = serials[i] if i < len(serials) else None
+        rows.append({
+            'item_id': item.id,
+            'unit_code': code,
+            'serial_number': str(serial).strip() if serial and str(serial).strip() else None,
+            'status': 'Trong kho',
+            'location': item.location,
+        })
+    units = StockItemUnit.__table__
+    connection = db.session.connection()
+    if connection.dialect.insert_executemany_returning_sort_by_parameter_order:
+        result = connection.execute(units.insert().returning(units.c.id, sort_by_parameter_order=True), rows)
+        return [row.id for row in result]
+    connection.execute(units.insert(), rows)
+    id_by_code = {}
+    for chunk in _chunked(codes):
+        id_by_code.update(connection.execute(
+            select(units.c.unit_code, units.c.id).where(units.c.unit_code.in_(chunk))
+        ).all())
+    return [id_by_code[code] for code in codes]
+
+def _bulk_issue_stock_units(item, unit_ids, receiver_id):
+    """Mark the selected units as issued with one conditional UPDATE; all must still be in stock."""
+    units = StockItemUnit.__table__
+    result = db.session.connection().execute(
+        units.update()
+        .where(units.c.id.in_(unit_ids), units.c.item_id == item.id, units.c.status == 'Trong kho')
+        .values(status='Đã xuất', assigned_to_id=receiver_id, updated_at=datetime.utcnow())
+    )
+    if result.rowcount != len(unit_ids):
+        # The caller rolls back, so no unit is left half-issued
+        missing = len(unit_ids) - result.rowcount
+        raise ValueError(f'Có {missing} thiết bị được chọn không ở trạng thái Trong kho.')
+    return unit_ids
+
+def _bulk_link_unit_movements(movement_id, unit_ids, action):
+    if unit_ids:
+        now = datetime.utcnow()
+        db.session.execute(StockItemUnitMovement.__table__.insert(), [
+            {'movement_id': movement_id, 'unit_id': unit_id, 'action': action, 'created_at': now}
+            for unit_id in unit_ids
+        ])
 
 def _record_stock_item_movement(item, movement_type, quantity, *, movement_date=None,
                                 receiver_id=None, supplier='', reference_code='', reason='', notes='',
@@ -2189,6 +3241,7 @@ def _record_stock_item_movement(item, movement_type, quantity, *, movement_date=
         after_quantity = before_quantity + quantity
     elif movement_type == 'Xuất':
         if item.track_units and selected_unit_ids:
+            selected_unit_ids = list(dict.fromkeys(int(uid) for uid in selected_unit_ids))
             quantity = len(selected_unit_ids)
         if quantity > before_quantity:
             raise ValueError('Số lượng xuất lớn hơn tồn kho hiện tại.')
@@ -2222,43 +3275,12 @@ def _record_stock_item_movement(item, movement_type, quantity, *, movement_date=
 
     if item.track_units:
         if movement_type == 'Nhập':
-            codes = _generate_unit_codes(item, quantity)
-            serials = unit_serials or []
-            for i in range(quantity):
-                sn = serials[i].strip() if i < len(serials) and serials[i] and str(serials[i]).strip() else None
-                unit = StockItemUnit(
-                    item_id=item.id,
-                    unit_code=codes[i],
-                    serial_number=sn,
-                    status='Trong kho',
-                    location=item.location,
-                )
-                db.session.add(unit)
-                db.session.flush()
-                um = StockItemUnitMovement(
-                    movement_id=movement.id,
-                    unit_id=unit.id,
-                    action='Nhập'
-                )
-                db.session.add(um)
+            unit_ids = _bulk_create_stock_units(item, quantity, unit_serials or [])
+            _bulk_link_unit_movements(movement.id, unit_ids, 'Nhập')
         elif movement_type == 'Xuất':
             if selected_unit_ids:
-                units = StockItemUnit.query.filter(
-                    StockItemUnit.id.in_(selected_unit_ids),
-                    StockItemUnit.item_id == item.id
-                ).all()
-                for unit in units:
-                    if unit.status != 'Trong kho':
-                        raise ValueError(f'Thiết bị {unit.unit_code} không ở trạng thái Trong kho.')
-                    unit.status = 'Đã xuất'
-                    unit.assigned_to_id = receiver_id
-                    unit.updated_at = datetime.utcnow()
-                    um = StockItemUnitMovement(
-                        movement_id=movement.id,
-                        unit_id=unit.id,
-                        action='Xuất'
-                    )
-                    db.session.add(um)
+                unit_ids = _bulk_issue_stock_units(item, selected_unit_ids, receiver_id)
+                _bulk_link_unit_movements(movement.id, unit_ids, 'Xuất')
 
     return movement
 
@@ -2272,26 +3294,15 @@ def _get_device_type_code_prefix(device_type_name):
         prefix = _default_device_type_prefixes().get(name, '')
     return prefix if _is_valid_device_type_prefix(prefix) else None
 
-def generate_device_code_for_type(device_type_name, reserved_codes=None):
+def generate_device_codes_for_type(device_type_name, count, reserved_codes=None):
+    """Reserve `count` new device codes for a type in one call; None if the type has no prefix."""
     prefix = _get_device_type_code_prefix(device_type_name)
     if not prefix:
         return None
-
-    pattern = re.compile(rf'^{re.escape(prefix)}-(\d+)$', re.IGNORECASE)
-    max_num = 0
-    existing_codes = db.session.query(Device.device_code).filter(Device.device_code.ilike(f'{prefix}-%')).all()
-    for row in existing_codes:
-        match = pattern.match(row[0] or '')
-        if match:
-            max_num = max(max_num, int(match.group(1)))
-
-    reserved = set(reserved_codes or [])
-    next_num = max_num + 1
-    while True:
-        code = f'{prefix}-{next_num:03d}'
-        if code not in reserved and not Device.query.filter_by(device_code=code).first():
-            return code
-        next_num += 1
+    return _allocate_codes(
+        'device', prefix, count, lambda number: f'{prefix}-{number:03d}', Device.device_code,
+        seed=lambda: _max_code_number(Device.device_code, prefix), reserved=reserved_codes,
+    )
 
 # --- Ensure tables exist and run lightweight schema migrations ---
 _tables_initialized = False
@@ -2351,6 +3362,126 @@ def ensure_missing_model_columns():
         except Exception as e:
             print(f"Schema check error: {e}")
 
+# --- Device full-text search ---
+# Every backend matches the query as a case-insensitive substring of a column, like the original
+# ILIKE search ('123' finds 'PC-0123').
+# SQLite: FTS5 trigram external-content table kept in sync by triggers, ranked with bm25().
+# Queries under 3 characters have no trigram to look up and use the ILIKE fallback.
+# PostgreSQL: pg_trgm GIN index over the concatenated search document, ranked with similarity().
+# Anything else (or a failed setup) falls back to ILIKE over the same columns.
+DEVICE_SEARCH_COLUMNS = [
+    'device_code', 'name', 'serial_number', 'configuration',
+    'cpu', 'mainboard', 'ram_gb', 'ssd', 'hdd', 'vga', 'wifi_card', 'network_card',
+]
+DEVICE_SEARCH_TRGM_INDEX = 'ix_device_search_trgm_v2'  # bump the suffix when the column list changes
+DEVICE_FTS_TOKENIZE = "tokenize='trigram'"
+_device_search_backend = 'like'
+
+def _device_search_column(column):
+    """Device column as text (ram_gb is an integer)."""
+    attribute = getattr(Device, column)
+    if isinstance(attribute.type, db.Integer):
+        return cast(attribute, String)
+    return attribute
+
+def _device_search_document():
+    """Immutable text expression over DEVICE_SEARCH_COLUMNS (matches the PG trigram index)."""
+    parts = [func.coalesce(_device_search_column(column), '') for column in DEVICE_SEARCH_COLUMNS]
+    document = parts[0]
+    for part in parts[1:]:
+        document = document + ' ' + part
+    return document
+
+def ensure_device_search_index():
+    """Create the device search index for the current database and pick the search backend."""
+    global _device_search_backend
+    columns = ', '.join(DEVICE_SEARCH_COLUMNS)
+    new_values = ', '.join(f'new.{column}' for column in DEVICE_SEARCH_COLUMNS)
+    old_values = ', '.join(f'old.{column}' for column in DEVICE_SEARCH_COLUMNS)
+    try:
+        with db.engine.connect() as conn:
+            if db.engine.dialect.name == 'sqlite':
+                existing = {row[0] for row in conn.execute(text(
+                    "SELECT name FROM sqlite_master WHERE name IN "
+                    "('device_fts', 'device_fts_ai', 'device_fts_ad', 'device_fts_au')"
+                ))}
+                if 'device_fts' in existing:
+                    indexed = [row[1] for row in conn.execute(text("PRAGMA table_info(device_fts)"))]
+                    definition = conn.execute(text("SELECT sql FROM sqlite_master WHERE name = 'device_fts'")).scalar() or ''
+                    if indexed != DEVICE_SEARCH_COLUMNS or DEVICE_FTS_TOKENIZE not in definition:
+                        existing.discard('device_fts')
+                if len(existing) < 4:
+                    for trigger in ('device_fts_ai', 'device_fts_ad', 'device_fts_au'):
+                        conn.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+                    conn.execute(text("DROP TABLE IF EXISTS device_fts"))
+                    conn.execute(text(
+                        f"CREATE VIRTUAL TABLE device_fts USING fts5({columns}, "
+                        f"content='device', content_rowid='id', {DEVICE_FTS_TOKENIZE})"
+                    ))
+                    conn.execute(text(
+                        f"CREATE TRIGGER device_fts_ai AFTER INSERT ON device BEGIN "
+                        f"INSERT INTO device_fts(rowid, {columns}) VALUES (new.id, {new_values}); END"
+                    ))
+                    conn.execute(text(
+                        f"CREATE TRIGGER device_fts_ad AFTER DELETE ON device BEGIN "
+                        f"INSERT INTO device_fts(device_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values}); END"
+                    ))
+                    conn.execute(text(
+                        f"CREATE TRIGGER device_fts_au AFTER UPDATE ON device BEGIN "
+                        f"INSERT INTO device_fts(device_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values}); "
+                        f"INSERT INTO device_fts(rowid, {columns}) VALUES (new.id, {new_values}); END"
+                    ))
+                    conn.execute(text("INSERT INTO device_fts(device_fts) VALUES ('rebuild')"))
+                    conn.commit()
+                    print("[OK] Built device_fts search index")
+                _device_search_backend = 'fts5'
+            elif db.engine.dialect.name == 'postgresql':
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                document = _device_search_document().compile(
+                    dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}
+                )
+                conn.execute(text("DROP INDEX IF EXISTS ix_device_search_trgm"))
+                conn.execute(text(
+                    f"CREATE INDEX IF NOT EXISTS {DEVICE_SEARCH_TRGM_INDEX} ON device "
+                    f"USING gin (({document}) gin_trgm_ops)"
+                ))
+                conn.commit()
+                _device_search_backend = 'trgm'
+    except Exception as e:
+        _device_search_backend = 'like'
+        print(f"Migration note (device search index): {e}")
+
+def _fts5_match_query(q):
+    """Turn free text into an FTS5 trigram phrase (a substring match); None under 3 characters."""
+    if len(q) < 3:
+        return None
+    return '"' + q.replace('"', '""') + '"'
+
+def _apply_device_search(query, q, extra_conditions=()):
+    """Filter a Device query by free text; returns (query, rank expression or None, lower = better)."""
+    q = (q or '').strip()
+    if not q:
+        return query, None
+    if _device_search_backend == 'fts5':
+        match = _fts5_match_query(q)
+        if match:
+            ranked = (
+                select(literal_column('rowid').label('device_id'), literal_column('bm25(device_fts)').label('rank'))
+                .select_from(table('device_fts'))
+                .where(text('device_fts MATCH :device_search').bindparams(device_search=match))
+                .subquery()
+            )
+            query = query.outerjoin(ranked, ranked.c.device_id == Device.id)
+            query = query.filter(or_(ranked.c.device_id.isnot(None), *extra_conditions))
+            return query, func.coalesce(ranked.c.rank, 0.0)
+    if _device_search_backend == 'trgm':
+        document = _device_search_document()
+        query = query.filter(or_(document.ilike(f'%{q}%'), *extra_conditions))
+        return query, -func.similarity(document, q)
+    like_q = f'%{q}%'
+    conditions = [_device_search_column(column).ilike(like_q) for column in DEVICE_SEARCH_COLUMNS]
+    return query.filter(or_(*conditions, *extra_conditions)), None
+
 @app.before_request
 def ensure_tables_once():
     global _tables_initialized
@@ -2358,8 +3489,14 @@ def ensure_tables_once():
         try:
             db.create_all()
             ensure_missing_model_columns()
+            ensure_model_indexes()
+            ensure_device_search_index()
             sync_device_type_prefixes()
             _seed_stock_item_categories()
+            _ensure_department_closure()
+            _ensure_device_stats()
+            _ensure_handover_batches()
+            _ensure_derived_keys()
             # Skip SQLite-specific migrations when using external DBs (e.g., PostgreSQL)
             if is_external_database():
                 _tables_initialized = True
@@ -2509,30 +3646,13 @@ def ensure_tables_once():
 # --- (Các hàm context_processor, home, auth, device routes giữ nguyên) ---
 @app.context_processor
 def inject_user():
-    if 'user_id' in session:
-        current_user = User.query.get(session['user_id'])
-        # Admin always has all permissions
-        if current_user and current_user.role == 'admin':
-            try:
-                perm_codes = {p.code for p in Permission.query.all()}
-            except Exception:
-                perm_codes = set()
-        else:
-            # derive permission codes for template checks
-            role_ids = [ur.role_id for ur in UserRole.query.filter_by(user_id=current_user.id).all()] if current_user else []
-            perm_codes = set()
-            if role_ids:
-                try:
-                    for rp in RolePermission.query.filter(RolePermission.role_id.in_(role_ids)).all():
-                        perm = Permission.query.get(rp.permission_id)
-                        if perm:
-                            perm_codes.add(perm.code)
-                except Exception:
-                    pass
-        unread_notifications = current_user.notifications.filter_by(is_read=False).all() if current_user else []
+    principal = _principal_for() if 'user_id' in session else None
+    if principal:
+        current_user = principal['user']
+        unread_notifications = current_user.notifications.filter_by(is_read=False).all()
         return dict(
             current_user=current_user,
-            current_permissions=perm_codes,
+            current_permissions=set(principal['permissions']),
             unread_notifications=unread_notifications,
             device_image_list=_device_image_list,
         )
@@ -2618,6 +3738,7 @@ def roles_permissions():
                 perm = Permission.query.filter_by(code=code).first()
                 if perm:
                     db.session.add(RolePermission(role_id=role.id, permission_id=perm.id))
+            _bump_rbac_version()
             db.session.commit()
             flash('Cập nhật quyền của vai trò thành công.', 'success')
             return redirect(url_for('roles_permissions'))
@@ -2633,6 +3754,7 @@ def roles_permissions():
             UserRole.query.filter_by(role_id=role.id).delete()
             RolePermission.query.filter_by(role_id=role.id).delete()
             db.session.delete(role)
+            _bump_rbac_version()
             db.session.commit()
             flash('Đã xóa vai trò.', 'success')
             return redirect(url_for('roles_permissions'))
@@ -2645,6 +3767,7 @@ def roles_permissions():
                 flash('Quyền đã tồn tại.', 'warning')
             else:
                 db.session.add(Permission(code=code, name=name))
+                _bump_rbac_version()
                 db.session.commit()
                 flash('Đã thêm quyền mới.', 'success')
             return redirect(url_for('roles_permissions'))
@@ -2654,6 +3777,7 @@ def roles_permissions():
             # Also remove role links
             RolePermission.query.filter_by(permission_id=perm.id).delete()
             db.session.delete(perm)
+            _bump_rbac_version()
             db.session.commit()
             flash('Đã xóa quyền.', 'success')
             return redirect(url_for('roles_permissions'))
@@ -2735,6 +3859,7 @@ def add_role():
             try:
                 new_role = Role(name=name, description=description)
                 db.session.add(new_role)
+                _bump_rbac_version()
                 db.session.commit()
                 flash('Đã thêm vai trò mới thành công.', 'success')
                 return redirect(url_for('roles_list'))
@@ -2767,6 +3892,7 @@ def role_detail(role_id):
                 perm = Permission.query.filter_by(code=code).first()
                 if perm:
                     db.session.add(RolePermission(role_id=role.id, permission_id=perm.id))
+            _bump_rbac_version()
             db.session.commit()
             flash('Cập nhật quyền của vai trò thành công.', 'success')
             return redirect(url_for('role_detail', role_id=role_id, tab='permissions'))
@@ -2783,6 +3909,7 @@ def role_detail(role_id):
                 else:
                     role.name = name
             role.description = description
+            _bump_rbac_version()
             db.session.commit()
             flash('Cập nhật quyền thành công.', 'success')
             return redirect(url_for('role_detail', role_id=role_id, tab='permissions'))
@@ -2794,6 +3921,7 @@ def role_detail(role_id):
                 existing = UserRole.query.filter_by(user_id=user_id, role_id=role.id).first()
                 if not existing:
                     db.session.add(UserRole(user_id=user_id, role_id=role.id))
+                    _bump_rbac_version()
                     db.session.commit()
                     flash('Đã thêm người dùng vào quyền.', 'success')
                 else:
@@ -2805,6 +3933,7 @@ def role_detail(role_id):
             user_id = request.form.get('user_id', type=int)
             if user_id:
                 UserRole.query.filter_by(user_id=user_id, role_id=role.id).delete()
+                _bump_rbac_version()
                 db.session.commit()
                 flash('Đã xóa người dùng khỏi quyền.', 'success')
             return redirect(url_for('role_detail', role_id=role_id, tab='users'))
@@ -2914,43 +4043,39 @@ def home():
     filter_department = request.args.get('department', '')
     filter_device_type = request.args.get('device_type', '')
     
-    # Base queries
-    device_query = Device.query
-    user_query = User.query
-    
-    # Apply filters
+    # All counters come from the device_stats rollup
+    stats_query = db.session.query(DeviceStats.status, func.sum(DeviceStats.count))
     if filter_department:
         dept_query = Department.query.filter(Department.name == filter_department).first()
         if dept_query:
-            device_query = device_query.join(User, Device.manager_id == User.id).filter(User.department_id == dept_query.id)
-    
+            stats_query = stats_query.filter(DeviceStats.department_id == dept_query.id)
     if filter_device_type:
-        device_query = device_query.filter(Device.device_type == filter_device_type)
-    
+        stats_query = stats_query.filter(DeviceStats.device_type == filter_device_type)
+    status_counts = {row[0]: int(row[1] or 0) for row in stats_query.group_by(DeviceStats.status).all()}
+
     # Get statistics
-    total_devices = device_query.count()
-    in_use_devices = device_query.filter_by(status='Đã cấp phát').count()
-    maintenance_devices = device_query.filter_by(status='Bảo trì').count()
+    total_devices = sum(status_counts.values())
+    in_use_devices = status_counts.get('Đã cấp phát', 0)
+    maintenance_devices = status_counts.get('Bảo trì', 0)
     
     # Get device type statistics (convert to plain list for JSON serialization)
     _device_type_rows = db.session.query(
-        Device.device_type, 
-        db.func.count(Device.id).label('count')
-    ).group_by(Device.device_type).all()
+        DeviceStats.device_type,
+        func.sum(DeviceStats.count).label('count')
+    ).group_by(DeviceStats.device_type).all()
     device_type_stats = [(row[0], int(row[1] or 0)) for row in _device_type_rows]
     
     # Get department statistics (convert to plain list for JSON serialization)
     _department_rows = db.session.query(
         Department.name,
-        db.func.count(Device.id).label('count')
-    ).join(User, Department.id == User.department_id)\
-     .join(Device, User.id == Device.manager_id)\
+        func.sum(DeviceStats.count).label('count')
+    ).join(DeviceStats, DeviceStats.department_id == Department.id)\
      .group_by(Department.name).all()
     department_stats = [(row[0], int(row[1] or 0)) for row in _department_rows]
     
     # Get all departments and device types for filters
     departments = [d[0] for d in db.session.query(Department.name).all()]
-    device_types = [dt[0] for dt in db.session.query(Device.device_type).distinct().all()]
+    device_types = [row[0] for row in _device_type_rows]
     
     # Get saved chart preferences
     selected_device_types = session.get('dashboard_device_types', device_types)
@@ -3105,13 +4230,11 @@ def list_departments():
     
     departments = Department.query.all()
     all_departments = Department.query.order_by(Department.order_index).all()
-    users = User.query.filter_by(status='Đang làm').all()
     current_permissions = _get_current_permissions()
     
     return render_template('departments/list.html', 
                          departments=departments,
                          all_departments=all_departments,
-                         users=users,
                          current_permissions=current_permissions)
 
 @app.route('/departments/<int:id>/users')
@@ -3126,10 +4249,6 @@ def department_users(id):
         return redirect(url_for('list_departments'))
         
     department = Department.query.get_or_404(id)
-    available_users = User.query.filter(
-        User.status.in_(['Đang làm', 'Thực tập']),
-        User.department_id.is_(None)
-    ).all()
     
     # Sort and Paginate department users
     page = request.args.get('page', 1, type=int)
@@ -3158,14 +4277,12 @@ def department_users(id):
         User.status.in_(['Đang làm', 'Thực tập', 'Thử việc'])
     ).order_by(
         order_case,
-        db.func.lower(User.last_name_token),
-        db.func.lower(User.full_name),
-        db.func.lower(User.username)
+        User.sort_key,
+        User.id
     ).paginate(page=page, per_page=20, error_out=False)
     
     return render_template('departments/users.html',
                          department=department,
-                         available_users=available_users,
                          department_users=pagination.items,
                          pagination=pagination,
                          current_permissions=current_permissions)
@@ -3257,9 +4374,8 @@ def department_users_partial(id):
         User.status.in_(['Đang làm', 'Thực tập', 'Thử việc'])
     ).order_by(
         order_case,
-        db.func.lower(User.last_name_token),
-        db.func.lower(User.full_name),
-        db.func.lower(User.username)
+        User.sort_key,
+        User.id
     ).paginate(page=page, per_page=20, error_out=False)
     
     return render_template('departments/_user_list_partial.html',
@@ -3373,33 +4489,217 @@ def delete_department(id):
             'message': 'Có lỗi xảy ra khi xóa phòng ban'
         })
 
+# --- Streaming export engine ---
+# Each entity declares its sheets as (title, query factory, [(header, value getter), ...]).
+# Rows are read with yield_per and written straight into a write-only workbook (or CSV), so
+# memory stays flat regardless of table size.
+EXPORT_BATCH_SIZE = 500
+EXPORT_STREAM_CHUNK = 64 * 1024
+
+def _fmt_date(value):
+    return value.strftime('%d-%m-%Y') if value else ''
+
+def _fmt_local_datetime(value):
+    local = _to_vietnam_time(value)
+    return local.strftime('%d-%m-%Y %H:%M:%S') if local else ''
+
+EXPORT_SPECS = {
+    'devices': {
+        'filename': 'devices_list',
+        'sheets': [('Devices', lambda: Device.query.options(joinedload(Device.manager)).order_by(Device.device_code), [
+            ('Mã thiết bị', lambda d: d.device_code),
+            ('Tên thiết bị', lambda d: d.name),
+            ('Loại thiết bị', lambda d: d.device_type),
+            ('Số serial', lambda d: d.serial_number or ''),
+            ('Ngày mua', lambda d: _fmt_date(d.purchase_date)),
+            ('Giá mua', lambda d: d.purchase_price),
+            ('Người mua', lambda d: d.buyer or ''),
+            ('Ngày nhập', lambda d: _fmt_date(d.import_date)),
+            ('Tình trạng', lambda d: d.condition),
+            ('Trạng thái', lambda d: d.status),
+            ('Người quản lý', lambda d: d.manager.full_name if d.manager else ''),
+            ('Ngày cấp phát', lambda d: _fmt_date(d.assign_date)),
+            ('Cấu hình', lambda d: d.configuration or ''),
+            ('Ghi chú', lambda d: d.notes or ''),
+            ('CPU', lambda d: d.cpu or ''),
+            ('Main', lambda d: d.mainboard or ''),
+            ('RAM (GB)', lambda d: d.ram_gb or ''),
+            ('SSD', lambda d: d.ssd or ''),
+            ('HDD', lambda d: d.hdd or ''),
+            ('VGA', lambda d: d.vga or ''),
+            ('Card mạng', lambda d: d.network_card or d.wifi_card or ''),
+            ('Người nhập', lambda d: d.importer or ''),
+            ('Thương hiệu', lambda d: d.brand or ''),
+            ('Nhà cung cấp', lambda d: d.supplier or ''),
+            ('Bảo hành', lambda d: d.warranty or ''),
+        ])],
+    },
+    'users': {
+        'filename': 'users_list',
+        'sheets': [('Users', lambda: User.query.options(joinedload(User.department_info)).order_by(
+            User.sort_key, User.id), [
+            ('ID', lambda u: u.id),
+            ('Tên đăng nhập', lambda u: u.username),
+            ('Mật khẩu', lambda u: ''),
+            ('Họ và tên', lambda u: u.full_name),
+            ('Email', lambda u: u.email),
+            ('Phòng ban', lambda u: u.department_info.name if u.department_info else None),
+            ('Chức vụ', lambda u: u.position),
+            ('Trạng thái', lambda u: u.status),
+            ('Ngày Onboard', lambda u: _fmt_date(u.onboard_date)),
+            ('Ngày Offboard', lambda u: _fmt_date(u.offboard_date)),
+            ('SĐT', lambda u: u.phone_number),
+            ('Ngày sinh', lambda u: _fmt_date(u.date_of_birth)),
+            ('Vai trò', lambda u: u.role),
+            ('Ngày tạo', lambda u: _fmt_local_datetime(u.created_at)),
+            ('Đăng nhập lần cuối', lambda u: _fmt_local_datetime(u.last_login)),
+        ])],
+    },
+    'handovers': {
+        'filename': 'handover_history',
+        'sheets': [('Handovers', lambda: DeviceHandover.query.options(
+            joinedload(DeviceHandover.device),
+            joinedload(DeviceHandover.giver),
+            joinedload(DeviceHandover.receiver).joinedload(User.department_info),
+        ).order_by(DeviceHandover.handover_date.desc(), DeviceHandover.id.desc()), [
+            ('Mã thiết bị', lambda h: h.device.device_code if h.device else ''),
+            ('Tên đăng nhập người giao', lambda h: h.giver.username if h.giver else ''),
+            ('Tên đăng nhập người nhận', lambda h: h.receiver.username if h.receiver else ''),
+            ('Ngày bàn giao', lambda h: _fmt_date(h.handover_date)),
+            ('Tình trạng thiết bị', lambda h: h.device_condition),
+            ('Lý do bàn giao', lambda h: h.reason),
+            ('Nơi đặt thiết bị', lambda h: h.location),
+            ('Ghi chú', lambda h: h.notes),
+            ('Tên thiết bị', lambda h: h.device.name if h.device else ''),
+            ('Loại thiết bị', lambda h: h.device.device_type if h.device else ''),
+            ('Người giao', lambda h: h.giver.full_name if h.giver else ''),
+            ('Người nhận', lambda h: h.receiver.full_name if h.receiver else ''),
+            ('Phòng ban người nhận', lambda h: h.receiver.department_info.name if h.receiver and h.receiver.department_info else ''),
+        ])],
+    },
+    'departments': {
+        'filename': 'departments_list',
+        'sheets': [('Departments', lambda: Department.query.options(
+            joinedload(Department.manager), joinedload(Department.parent),
+        ).order_by(Department.id), [
+            ('ID', lambda d: d.id),
+            ('Tên phòng ban', lambda d: d.name),
+            ('Mô tả', lambda d: d.description),
+            ('Phòng ban cha', lambda d: d.parent.name if d.parent else ''),
+            ('Quản lý', lambda d: d.manager.full_name if d.manager else ''),
+        ])],
+    },
+    'consumables': {
+        'filename': 'consumables',
+        'sheets': [
+            ('Ton_kho', lambda: ConsumableItem.query.order_by(ConsumableItem.name), [
+                ('Mã', lambda i: i.code),
+                ('Tên thiết bị tiêu hao', lambda i: i.name),
+                ('Loại vật tư', lambda i: i.category),
+                ('Đơn vị', lambda i: i.unit),
+                ('Tồn kho', lambda i: i.current_quantity),
+                ('Tồn tối thiểu', lambda i: i.min_quantity),
+                ('Vị trí', lambda i: i.location or ''),
+                ('Ghi chú', lambda i: i.notes or ''),
+            ]),
+            ('Nhat_ky', lambda: ConsumableTransaction.query.options(
+                joinedload(ConsumableTransaction.item),
+                joinedload(ConsumableTransaction.issued_to),
+                joinedload(ConsumableTransaction.actor),
+            ).order_by(ConsumableTransaction.transaction_date.desc()), [
+                ('Thời gian', lambda tx: _format_vietnam_datetime(tx.transaction_date)),
+                ('Mã', lambda tx: tx.item.code if tx.item else ''),
+                ('Tên thiết bị tiêu hao', lambda tx: tx.item.name if tx.item else ''),
+                ('Loại giao dịch', lambda tx: tx.transaction_type),
+                ('Số lượng', lambda tx: tx.quantity),
+                ('Tồn trước', lambda tx: tx.before_quantity),
+                ('Tồn sau', lambda tx: tx.after_quantity),
+                ('Người nhận', lambda tx: tx.issued_to.full_name if tx.issued_to else ''),
+                ('Người thao tác', lambda tx: tx.actor.full_name if tx.actor else ''),
+                ('Lý do', lambda tx: tx.reason or ''),
+                ('Ghi chú', lambda tx: tx.notes or ''),
+            ]),
+        ],
+    },
+}
+
+def _export_rows(query_factory, columns):
+    for obj in query_factory().yield_per(EXPORT_BATCH_SIZE):
+        yield [getter(obj) for _, getter in columns]
+
+def _stream_file_and_remove(path):
+    try:
+        with open(path, 'rb') as fh:
+            while True:
+                chunk = fh.read(EXPORT_STREAM_CHUNK)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _stream_export(entity, fmt=None):
+    """Chunked download for EXPORT_SPECS[entity]; `fmt` is 'xlsx' (default) or 'csv' (one sheet)."""
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+
+    spec = EXPORT_SPECS[entity]
+    stamp = datetime.now(VIETNAM_TZ).strftime("%Y%m%d")
+    if (fmt or request.args.get('format', 'xlsx')).lower() == 'csv':
+        sheet_index = min(max(request.args.get('sheet', 0, type=int), 0), len(spec['sheets']) - 1)
+        title, query_factory, columns = spec['sheets'][sheet_index]
+
+        def generate():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            buffer.write('\ufeff')  # BOM so Excel opens UTF-8 Vietnamese text correctly
+            writer.writerow([header for header, _ in columns])
+            for row in _export_rows(query_factory, columns):
+                writer.writerow(row)
+                if buffer.tell() >= EXPORT_STREAM_CHUNK:
+                    yield buffer.getvalue().encode('utf-8')
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue().encode('utf-8')
+
+        suffix = f'_{title}' if len(spec['sheets']) > 1 else ''
+        return Response(stream_with_context(generate()), mimetype='text/csv', headers={
+            'Content-Disposition': f'attachment; filename={spec["filename"]}{suffix}_{stamp}.csv',
+        })
+
+    workbook = Workbook(write_only=True)
+    header_font = Font(bold=True)
+    for title, query_factory, columns in spec['sheets']:
+        sheet = workbook.create_sheet(title)
+        header = []
+        for name, _ in columns:
+            cell = WriteOnlyCell(sheet, value=name)
+            cell.font = header_font
+            header.append(cell)
+        sheet.append(header)
+        for row in _export_rows(query_factory, columns):
+            sheet.append(row)
+    handle, path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(handle)
+    try:
+        workbook.save(path)
+    except Exception:
+        os.remove(path)
+        raise
+    return Response(_stream_file_and_remove(path), headers={
+        'Content-Type': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        'Content-Disposition': f'attachment; filename={spec["filename"]}_{stamp}.xlsx',
+        'Content-Length': str(os.path.getsize(path)),
+    })
+
 @app.route('/departments/export_excel')
 def export_departments_excel():
     if 'user_id' not in session: return redirect(url_for('login'))
-    
-    departments = Department.query.order_by(Department.id).all()
-    data = []
-    for dept in departments:
-        manager_name = dept.manager.full_name if dept.manager else ''
-        parent_name = dept.parent.name if dept.parent else ''
-        data.append({
-            'ID': dept.id,
-            'Tên phòng ban': dept.name,
-            'Mô tả': dept.description,
-            'Phòng ban cha': parent_name,
-            'Quản lý': manager_name
-        })
-    
-    df = pd.DataFrame(data)
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Departments')
-    output.seek(0)
-    
-    return send_file(output, 
-                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 
-                     as_attachment=True, 
-                     download_name=f'departments_list_{datetime.now(VIETNAM_TZ).strftime("%Y%m%d")}.xlsx')
+    return _stream_export('departments')
 
 @app.route('/departments/import', methods=['GET', 'POST'])
 def import_departments():
@@ -3415,8 +4715,15 @@ def import_departments():
             df = pd.read_excel(file, engine='openpyxl')
             
             errors = []
-            added_count = 0
-            
+            existing = dict(db.session.query(Department.name, Department.id))
+            user_ids = dict(db.session.query(User.username, User.id))
+            next_order = {
+                parent_id: (max_order or 0)
+                for parent_id, max_order in db.session.query(Department.parent_id, func.max(Department.order_index)).group_by(Department.parent_id)
+            }
+            pending = []  # (name, row values, parent name)
+            seen = set()
+
             for index, row in df.iterrows():
                 # Safe header access
                 name = str(row.get('Tên phòng ban', '')).strip()
@@ -3427,36 +4734,40 @@ def import_departments():
                 if not name or name.lower() == 'nan':
                     continue
                 
-                if Department.query.filter_by(name=name).first():
+                if name in existing or name in seen:
                     errors.append(f'Dòng {index + 2}: Phòng ban "{name}" đã tồn tại.')
                     continue
+                seen.add(name)
                 
                 manager_id = None
                 if manager_username:
-                    manager = User.query.filter_by(username=manager_username).first()
-                    if manager:
-                        manager_id = manager.id
-                    else:
+                    manager_id = user_ids.get(manager_username)
+                    if manager_id is None:
                         errors.append(f'Dòng {index + 2}: User quản lý "{manager_username}" không tồn tại.')
                 
-                parent_id = None
-                if parent_name:
-                    parent = Department.query.filter_by(name=parent_name).first()
-                    if parent:
-                        parent_id = parent.id
-                
-                # Max order logic
-                max_order = db.session.query(func.max(Department.order_index)).filter_by(parent_id=parent_id).scalar() or 0
-                
-                new_dept = Department(
-                    name=name,
-                    description=description,
-                    manager_id=manager_id,
-                    parent_id=parent_id,
-                    order_index=max_order + 1
-                )
-                db.session.add(new_dept)
-                added_count += 1
+                pending.append((name, {'name': name, 'description': description, 'manager_id': manager_id}, parent_name))
+
+            # Insert level by level so a parent listed in the same file gets its id first
+            added_count = 0
+            while pending:
+                ready = [item for item in pending if not item[2] or item[2] in existing or item[2] not in seen]
+                if not ready:
+                    ready = pending  # cyclic parents inside the file: insert them as roots
+                rows = []
+                for name, values, parent_name in ready:
+                    parent_id = existing.get(parent_name) if parent_name else None
+                    next_order[parent_id] = next_order.get(parent_id, 0) + 1
+                    rows.append({**values, 'parent_id': parent_id, 'order_index': next_order[parent_id]})
+                new_ids = _bulk_insert_rows(Department, rows)
+                existing.update(zip([item[0] for item in ready], new_ids))
+                _link_new_departments(db.session.connection(), {
+                    dept_id: row['parent_id'] for dept_id, row in zip(new_ids, rows)
+                })
+                ready_names = {item[0] for item in ready}
+                pending = [item for item in pending if item[0] not in ready_names]
+                added_count += len(rows)
+            if added_count:
+                _invalidate_filter_options('departments')
                 
             if errors:
                 for error in errors[:10]:
@@ -3545,6 +4856,7 @@ def register():
         default_role = Role.query.filter_by(name='Người dùng').first()
         if default_role:
             db.session.add(UserRole(user_id=new_user.id, role_id=default_role.id))
+            _bump_rbac_version()
             db.session.commit()
             
         session['user_id'] = new_user.id; session.permanent = True
@@ -3597,15 +4909,10 @@ def forgot_password():
 
 # ... (Device routes) ...
 def get_subordinate_department_ids(dept_id):
-    """Get all subordinate department IDs recursively"""
-    dept = Department.query.get(dept_id)
-    if not dept:
-        return []
-    
-    result = [dept_id]
-    for child in dept.children:
-        result.extend(get_subordinate_department_ids(child.id))
-    return result
+    """Get the department and all of its subordinate department IDs from department_closure."""
+    return [row[0] for row in db.session.query(DepartmentClosure.descendant_id)
+            .filter(DepartmentClosure.ancestor_id == dept_id)
+            .order_by(DepartmentClosure.depth, DepartmentClosure.descendant_id).all()]
 
 
 @app.route('/devices')
@@ -3700,16 +5007,15 @@ def device_list():
         query = query.filter(Device.device_code.ilike(f'%{filter_device_code}%'))
     if filter_name:
         query = query.filter(Device.name.ilike(f'%{filter_name}%'))
+    search_rank = None
     if filter_q:
         like_q = f'%{filter_q}%'
-        query = query.filter(or_(
-            Device.device_code.ilike(like_q),
-            Device.name.ilike(like_q),
+        query, search_rank = _apply_device_search(query, filter_q, [
             Device.manager.has(or_(
                 User.full_name.ilike(like_q),
                 User.username.ilike(like_q)
             ))
-        ))
+        ])
     # filter_device_type handled above
     if filter_status:
         query = query.filter_by(status=filter_status)
@@ -3729,17 +5035,20 @@ def device_list():
         if dept:
             query = query.join(User, Device.manager_id == User.id).filter(User.department_id == dept.id)
     
-    devices_pagination = query.order_by(Device.id.desc()).paginate(page=page, per_page=per_page, error_out=False)
-    device_types = sorted([item[0] for item in db.session.query(Device.device_type).distinct().all()])
+    order_keys = [(Device.id, True)]
+    if search_rank is not None:
+        order_keys.insert(0, (search_rank, False))
+    devices_pagination = _paginate_list(query, order_keys, page, per_page)
+    device_types = _device_type_options()
     statuses = ['Sẵn sàng', 'Đã cấp phát', 'Bảo trì', 'Hỏng', 'Thanh lý', 'Test', 'Mượn', CONVERTED_CONSUMABLE_STATUS]
     users = _visible_users_query_for(user).all()
     if manager_filter_id is not None and all(u.id != manager_filter_id for u in users):
         extra_user = User.query.get(manager_filter_id)
         if extra_user:
             users.append(extra_user)
-            users = sorted(users, key=lambda u: ((u.last_name_token or '') if hasattr(u, 'last_name_token') else '', u.full_name or u.username or ''))
-    departments = [d.name for d in Department.query.order_by(Department.name).all()]
-    primary_admin = User.query.filter_by(role='admin').order_by(User.id).first()
+            users = sorted(users, key=lambda u: (u.sort_key or '', u.id))
+    departments = _department_name_options()
+    primary_admin = _primary_admin()
 
     return render_template(
         'devices.html',
@@ -3761,6 +5070,122 @@ def device_list():
         primary_admin=primary_admin
     )
 
+@app.route('/api/devices/search')
+def api_device_search():
+    """Ranked full-text device search (code, name, serial, configuration, PC specs) as JSON."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    q = (request.args.get('q') or '').strip()
+    limit = min(max(request.args.get('limit', 20, type=int) or 20, 1), 100)
+    if not q:
+        return jsonify({'query': q, 'results': []})
+    query, rank = _apply_device_search(_visible_devices_query_for(_get_current_user()), q)
+    ordering = [rank.asc(), Device.id.desc()] if rank is not None else [Device.id.desc()]
+    devices = query.order_by(*ordering).limit(limit).all()
+    return jsonify({
+        'query': q,
+        'results': [{
+            'id': device.id,
+            'device_code': device.device_code,
+            'name': device.name,
+            'device_type': device.device_type,
+            'status': device.status,
+            'serial_number': device.serial_number,
+            'url': url_for('device_detail', device_id=device.id),
+        } for device in devices],
+    })
+
+# Typeahead pickers. Pages that used to list every user (or device) in their <select>s keep
+# that reach for callers holding one of these permissions; everyone else gets their visible scope.
+USER_DIRECTORY_PERMISSIONS = ('departments.view', 'departments.edit', 'devices.view', 'handovers.view', 'stock_items.view')
+DEVICE_DIRECTORY_PERMISSIONS = ('resources.view', 'resources.edit')
+TYPEAHEAD_LIMIT = 20
+TYPEAHEAD_MAX_LIMIT = 50
+
+def _typeahead_args():
+    q = _search_fold(request.args.get('q') or '')
+    limit = min(max(request.args.get('limit', TYPEAHEAD_LIMIT, type=int) or TYPEAHEAD_LIMIT, 1), TYPEAHEAD_MAX_LIMIT)
+    return q, limit
+
+def _apply_typeahead(query, model, q):
+    """Every word of the folded query must start a word of the key: 'ng an' finds 'nguyen van an'.
+
+    Each word is a range scan on the search_token primary key ('ng' <= token < 'nh'), so no LIKE
+    pattern has to be matched against every row.
+    """
+    tokens = SearchToken.__table__
+    for word in _search_tokens(q):
+        upper = word[:-1] + chr(ord(word[-1]) + 1)
+        query = query.filter(model.id.in_(select(tokens.c.entity_id).where(
+            tokens.c.entity == SEARCH_TOKEN_ENTITIES[model], tokens.c.token >= word, tokens.c.token < upper,
+        )))
+    return query
+
+def _has_any_permission(permissions, user=None):
+    return _is_admin_user(user) or bool(_get_current_permissions() & set(permissions))
+
+@app.route('/api/search/users')
+def api_search_users():
+    """Typeahead for user pickers: ?q=&limit=&active=1&unassigned=1&status=..."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    user = _get_current_user()
+    q, limit = _typeahead_args()
+    if _has_any_permission(USER_DIRECTORY_PERMISSIONS, user):
+        query = User.query
+    else:
+        query = _visible_users_query_for(user).order_by(None)
+    if request.args.get('active') == '1':
+        query = query.filter(User.status.notin_(['Nghỉ việc', 'Nghỉ không lương']))
+    statuses = [value for value in request.args.getlist('status') if value]
+    if statuses:
+        query = query.filter(User.status.in_(statuses))
+    if request.args.get('unassigned') == '1':
+        query = query.filter(User.department_id.is_(None))
+    users = _apply_typeahead(query, User, q)\
+        .options(joinedload(User.department_info))\
+        .order_by(User.sort_key, User.id).limit(limit).all()
+    return jsonify({
+        'query': q,
+        'results': [{
+            'id': item.id,
+            'text': item.full_name or item.username,
+            'username': item.username,
+            'department': item.department_info.name if item.department_info else None,
+        } for item in users],
+    })
+
+@app.route('/api/search/devices')
+def api_search_devices():
+    """Typeahead for device pickers: ?q=&limit=&status=...&device_type=..."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    user = _get_current_user()
+    q, limit = _typeahead_args()
+    if _has_any_permission(DEVICE_DIRECTORY_PERMISSIONS, user):
+        query = Device.query
+    else:
+        query = _visible_devices_query_for(user)
+    statuses = [value for value in request.args.getlist('status') if value]
+    if statuses:
+        query = query.filter(Device.status.in_(statuses))
+    device_types = [value for value in request.args.getlist('device_type') if value]
+    if device_types:
+        query = query.filter(Device.device_type.in_(device_types))
+    devices = _apply_typeahead(query, Device, q).order_by(Device.search_key, Device.id).limit(limit).all()
+    return jsonify({
+        'query': q,
+        'results': [{
+            'id': device.id,
+            'text': f'{device.device_code} - {device.name}',
+            'device_code': device.device_code,
+            'name': device.name,
+            'device_type': device.device_type,
+            'status': device.status,
+            'serial_number': device.serial_number,
+        } for device in devices],
+    })
+
 @app.route('/devices/default_status', methods=['POST'])
 def set_devices_default_status():
     if 'user_id' not in session: return redirect(url_for('login'))
@@ -3792,30 +5217,91 @@ def save_device_filters():
     # Redirect back with filters as query so UI reflects saved state
     return redirect(url_for('device_list', **{k: v for k, v in filters.items() if v}))
 
+# --- Set-based bulk device operations ---
+# Selections are processed in chunks so "WHERE id IN (...)" stays below SQLite's bound-parameter limit.
+BULK_CHUNK_SIZE = 500
+
+def _chunked(items, size=BULK_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def _parse_id_list(values):
+    ids = []
+    for value in values:
+        try:
+            ids.append(int(value))
+        except (TypeError, ValueError):
+            continue
+    return list(dict.fromkeys(ids))
+
+def _bulk_result_response(affected, skipped_ids, message, warning_message):
+    """JSON for XHR callers, otherwise flash and go back to the device list."""
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify({'success': True, 'affected': affected, 'skipped_ids': skipped_ids})
+    if affected:
+        if skipped_ids:
+            preview = ', '.join(str(i) for i in skipped_ids[:20]) + ('…' if len(skipped_ids) > 20 else '')
+            message += f' Bỏ qua {len(skipped_ids)} thiết bị (ID: {preview}).'
+        flash(message, 'success')
+    else:
+        flash(warning_message, 'warning')
+    return redirect(url_for('device_list'))
+
 @app.route('/devices/bulk_update', methods=['POST'])
 def devices_bulk_update():
     if 'user_id' not in session: return redirect(url_for('login'))
-    device_ids = request.form.getlist('device_ids')
+    device_ids = _parse_id_list(request.form.getlist('device_ids'))
     if not device_ids:
         flash('Vui lòng chọn ít nhất một thiết bị.', 'warning')
         return redirect(url_for('device_list'))
+    values = {}
     new_status = request.form.get('new_status')
+    if new_status:
+        values['status'] = new_status
     new_manager_id = request.form.get('new_manager_id')
-    updated = 0
-    for did in device_ids:
-        device = Device.query.get(did)
-        if not device: continue
-        if new_status:
-            device.status = new_status
-        if new_manager_id:
-            try:
-                device.manager_id = int(new_manager_id)
-            except ValueError:
-                pass
-        updated += 1
+    if new_manager_id:
+        try:
+            values['manager_id'] = int(new_manager_id)
+        except ValueError:
+            pass
+    if not values:
+        flash('Vui lòng chọn thông tin cần cập nhật.', 'warning')
+        return redirect(url_for('device_list'))
+
+    device = Device.__table__
+    connection = db.session.connection()
+    visible = _visible_user_ids_select(_get_current_user())
+    fields = list(values)
+    affected_ids = []
+    audit_entries = []
+    stats_deltas = {}
+    for chunk in _chunked(device_ids):
+        condition = device.c.id.in_(chunk)
+        if visible is not None:
+            condition = condition & device.c.manager_id.in_(visible)
+        old_rows = connection.execute(
+            select(device.c.id, *[device.c[f] for f in fields]).where(condition)
+        ).all()
+        if not old_rows:
+            continue
+        ids = [row.id for row in old_rows]
+        _add_device_stats_deltas(stats_deltas, _device_stats_counts_for(connection, ids), -1)
+        connection.execute(device.update().where(device.c.id.in_(ids)).values(**values))
+        _add_device_stats_deltas(stats_deltas, _device_stats_counts_for(connection, ids))
+        affected_ids.extend(ids)
+        audit_entries.extend(
+            (row.id, {f: getattr(row, f) for f in fields}, values) for row in old_rows
+        )
+    _log_audit_bulk('device', audit_entries)
+    _apply_device_stats_deltas(connection, stats_deltas)
     db.session.commit()
-    flash(f'Đã cập nhật {updated} thiết bị.', 'success')
-    return redirect(url_for('device_list'))
+    affected = set(affected_ids)
+    skipped_ids = [did for did in device_ids if did not in affected]
+    return _bulk_result_response(
+        len(affected_ids), skipped_ids,
+        f'Đã cập nhật {len(affected_ids)} thiết bị.',
+        'Không có thiết bị nào được cập nhật.',
+    )
 
 @app.route('/devices/<int:device_id>/return', methods=['POST'])
 def return_device(device_id):
@@ -3986,6 +5472,14 @@ def add_device():
                 row_condition = (conditions[index] if index < len(conditions) and conditions[index] else None) or 'Sử dụng bình thường'
                 row_image_files = request.files.getlist(f'device_images_{index}[]')[:5]
 
+                generated_codes = None
+                if not base_device_code:
+                    generated_codes = generate_device_codes_for_type(device_type, quantity, reserved_codes)
+                    if not generated_codes:
+                        db.session.rollback()
+                        flash(f'Vui lòng cấu hình mã loại thiết bị cho "{device_type}" trước khi để trống mã thiết bị.', 'danger')
+                        return redirect(url_for('add_device'))
+
                 for item_offset in range(quantity):
                     if base_device_code:
                         if item_offset == 0:
@@ -3995,11 +5489,7 @@ def add_device():
                         else:
                             device_code = f'{base_device_code}_{item_offset + 1}'
                     else:
-                        device_code = generate_device_code_for_type(device_type, reserved_codes)
-                        if not device_code:
-                            db.session.rollback()
-                            flash(f'Vui lòng cấu hình mã loại thiết bị cho "{device_type}" trước khi để trống mã thiết bị.', 'danger')
-                            return redirect(url_for('add_device'))
+                        device_code = generated_codes[item_offset]
 
                     if device_code in reserved_codes or Device.query.filter_by(device_code=device_code).first():
                         db.session.rollback()
@@ -4058,7 +5548,7 @@ def add_device():
         flash(f'Thêm thành công {len(created_devices)} thiết bị!', 'success')
         return redirect(url_for('device_list'))
         
-    managers = User.query.order_by(func.lower(User.last_name_token), func.lower(User.full_name), func.lower(User.username)).all()
+    managers = User.query.order_by(User.sort_key, User.id).all()
     
     # Fetch device types for dropdown
     types = DeviceType.query.order_by(DeviceType.category, DeviceType.name).all()
@@ -4180,7 +5670,7 @@ def edit_device(device_id):
         flash('Cập nhật thông tin thiết bị thành công!', 'success')
         return redirect(url_for('device_list'))
         
-    managers = User.query.order_by(func.lower(User.last_name_token), func.lower(User.full_name), func.lower(User.username)).all()
+    managers = User.query.order_by(User.sort_key, User.id).all()
     statuses = ['Sẵn sàng', 'Đã cấp phát', 'Bảo trì', 'Hỏng']
     
     # Fetch device types for dropdown
@@ -4210,40 +5700,71 @@ def delete_device(device_id):
 @app.route('/devices/bulk_delete', methods=['POST'])
 def bulk_delete_devices():
     if 'user_id' not in session: return redirect(url_for('login'))
-    device_ids = request.form.getlist('device_ids')
+    device_ids = _parse_id_list(request.form.getlist('device_ids'))
     if not device_ids:
         flash('Vui lòng chọn ít nhất một thiết bị.', 'warning')
         return redirect(url_for('device_list'))
 
-    deleted_count = 0
-    skipped_count = 0
-
-    for device_id in device_ids:
-        device = Device.query.get(device_id)
-        if not device: continue
-
-        # Kiểm tra điều kiện xóa: thiết bị không được có lịch sử bàn giao và không được có người quản lý
-        if device.handovers or device.manager_id is not None:
-            skipped_count += 1
+    device, handover = Device.__table__, DeviceHandover.__table__
+    logs, attachments = DeviceMaintenanceLog.__table__, DeviceMaintenanceAttachment.__table__
+    connection = db.session.connection()
+    deleted_ids = []
+    audit_entries = []
+    image_values = []
+    attachment_paths = []
+    stats_deltas = {}
+    for chunk in _chunked(device_ids):
+        # Điều kiện xóa: thiết bị không được có lịch sử bàn giao và không được có người quản lý
+        condition = (
+            device.c.id.in_(chunk)
+            & device.c.manager_id.is_(None)
+            & ~exists().where(handover.c.device_id == device.c.id)
+        )
+        rows = connection.execute(
+            select(device.c.id, device.c.device_code, device.c.name, device.c.device_type, device.c.status,
+                   device.c.image_filename, device.c.image_filenames).where(condition)
+        ).all()
+        if not rows:
             continue
-
-        # Removed InventoryReceiptItem deletion
-        _delete_device_image_files(device.image_filenames or device.image_filename)
-
-        db.session.delete(device)
-        deleted_count += 1
-
+        ids = [row.id for row in rows]
+        _add_device_stats_deltas(stats_deltas, _device_stats_counts_for(connection, ids), -1)
+        # Attachments first: log_id is NOT NULL and the ORM cascade does not run for Core deletes
+        device_logs = select(logs.c.id).where(logs.c.device_id.in_(ids))
+        attachment_paths.extend(connection.execute(
+            select(attachments.c.file_path).where(attachments.c.log_id.in_(device_logs))
+        ).scalars())
+        connection.execute(attachments.delete().where(attachments.c.log_id.in_(device_logs)))
+        connection.execute(logs.delete().where(logs.c.device_id.in_(ids)))
+        connection.execute(Resource.__table__.update().where(Resource.device_id.in_(ids)).values(device_id=None))
+        connection.execute(device.delete().where(device.c.id.in_(ids)))
+        _write_search_tokens(connection, Device, [(device_id, None) for device_id in ids])
+        deleted_ids.extend(ids)
+        for row in rows:
+            image_values.append(row.image_filenames or row.image_filename)
+            old = {'device_code': row.device_code, 'name': row.name, 'device_type': row.device_type, 'status': row.status}
+            audit_entries.append((row.id, old, dict.fromkeys(old)))
+    _log_audit_bulk('device', audit_entries)
+    _apply_device_stats_deltas(connection, stats_deltas)
+    if deleted_ids:
+        _invalidate_filter_options('device_types')
     db.session.commit()
+    # Files go only after the rows are gone for good
+    for images in image_values:
+        _delete_device_image_files(images)
+    for path in attachment_paths:
+        try:
+            if path and os.path.exists(path):
+                os.remove(path)
+        except OSError:
+            pass
 
-    if deleted_count > 0:
-        message = f'Đã xóa thành công {deleted_count} thiết bị.'
-        if skipped_count > 0:
-            message += f' {skipped_count} thiết bị không thể xóa do đã được gán cho người dùng hoặc có lịch sử bàn giao.'
-        flash(message, 'success')
-    else:
-        flash('Không có thiết bị nào được xóa. Tất cả thiết bị đã được gán hoặc có lịch sử bàn giao.', 'warning')
-
-    return redirect(url_for('device_list'))
+    deleted = set(deleted_ids)
+    skipped_ids = [did for did in device_ids if did not in deleted]
+    return _bulk_result_response(
+        len(deleted_ids), skipped_ids,
+        f'Đã xóa thành công {len(deleted_ids)} thiết bị.',
+        'Không có thiết bị nào được xóa. Tất cả thiết bị đã được gán hoặc có lịch sử bàn giao.',
+    )
 
 @app.route('/device/<int:device_id>')
 def device_detail(device_id):
@@ -4265,10 +5786,8 @@ def add_devices_bulk():
 # --- Handover Routes ---
 @app.route('/handover_report', methods=['GET'])
 def handover_report():
-    # Get a list of all devices and users for the form
-    devices = Device.query.all()
-    users = User.query.all()
-    return render_template('handover_report.html', devices=devices, users=users)
+    # The form is free text; device and user pickers, when needed, use /api/search/*
+    return render_template('handover_report.html')
 
 @app.route('/handover_list')
 def handover_list():
@@ -4282,53 +5801,56 @@ def handover_list():
     filter_start_date = request.args.get('filter_start_date', '')
     filter_end_date = request.args.get('filter_end_date', '')
     
-    query = DeviceHandover.query.outerjoin(Device)
+    query = HandoverBatch.query
 
-    if filter_device_code:
-        query = query.filter(Device.device_code.ilike(f'%{filter_device_code}%'))
     if filter_giver_id:
-        query = query.filter(DeviceHandover.giver_id == filter_giver_id)
+        query = query.filter(HandoverBatch.giver_id == filter_giver_id)
     if filter_receiver_id:
-        query = query.filter(DeviceHandover.receiver_id == filter_receiver_id)
-    if filter_device_type:
-        query = query.filter(Device.device_type == filter_device_type)
+        query = query.filter(HandoverBatch.receiver_id == filter_receiver_id)
     if filter_start_date:
-        query = query.filter(DeviceHandover.handover_date >= datetime.strptime(filter_start_date, '%Y-%m-%d').date())
+        query = query.filter(HandoverBatch.handover_date >= datetime.strptime(filter_start_date, '%Y-%m-%d').date())
     if filter_end_date:
-        query = query.filter(DeviceHandover.handover_date <= datetime.strptime(filter_end_date, '%Y-%m-%d').date())
-
-    batch_key = func.coalesce(DeviceHandover.batch_id, cast(DeviceHandover.id, String))
-    representative_ids = query.with_entities(func.min(DeviceHandover.id).label('id')).group_by(batch_key).subquery()
-    handovers_pagination = DeviceHandover.query\
-        .join(representative_ids, DeviceHandover.id == representative_ids.c.id)\
-        .order_by(DeviceHandover.handover_date.desc(), DeviceHandover.id.desc())\
-        .paginate(page=page, per_page=per_page, error_out=False)
+        query = query.filter(HandoverBatch.handover_date <= datetime.strptime(filter_end_date, '%Y-%m-%d').date())
+    if filter_device_code or filter_device_type:
+        device_match = exists().where(DeviceHandover.batch_id == HandoverBatch.batch_id, Device.id == DeviceHandover.device_id)
+        if filter_device_code:
+            device_match = device_match.where(Device.device_code.ilike(f'%{filter_device_code}%'))
+        if filter_device_type:
+            device_match = device_match.where(Device.device_type == filter_device_type)
+        query = query.filter(device_match)
+
+    handovers_pagination = _paginate_list(
+        query.options(joinedload(HandoverBatch.giver), joinedload(HandoverBatch.receiver)),
+        [(HandoverBatch.handover_date, True), (HandoverBatch.id, True)],
+        page, per_page,
+    )
 
-    visible_batch_ids = [handover.batch_id for handover in handovers_pagination.items if handover.batch_id]
+    # Line items only for the batches on this page
+    visible_batch_ids = [batch.batch_id for batch in handovers_pagination.items]
     batch_items = {}
+    consumable_batch_items = {}
     if visible_batch_ids:
         rows = DeviceHandover.query\
+            .options(joinedload(DeviceHandover.device))\
             .filter(DeviceHandover.batch_id.in_(visible_batch_ids))\
             .order_by(DeviceHandover.batch_id, DeviceHandover.id)\
             .all()
         for row in rows:
             batch_items.setdefault(row.batch_id, []).append(row)
-    for handover in handovers_pagination.items:
-        handover.display_items = batch_items.get(handover.batch_id, [handover]) if handover.batch_id else [handover]
-    consumable_batch_items = {}
-    if visible_batch_ids:
         consumable_rows = ConsumableHandoverItem.query\
+            .options(joinedload(ConsumableHandoverItem.item))\
             .filter(ConsumableHandoverItem.batch_id.in_(visible_batch_ids))\
             .order_by(ConsumableHandoverItem.batch_id, ConsumableHandoverItem.id)\
             .all()
         for row in consumable_rows:
             consumable_batch_items.setdefault(row.batch_id, []).append(row)
-    for handover in handovers_pagination.items:
-        handover.consumable_items = consumable_batch_items.get(handover.batch_id, []) if handover.batch_id else []
+    for batch in handovers_pagination.items:
+        batch.display_items = batch_items.get(batch.batch_id, [])
+        batch.consumable_items = consumable_batch_items.get(batch.batch_id, [])
 
-    users = User.query.order_by(func.lower(User.last_name_token), func.lower(User.full_name), func.lower(User.username)).all()
-    device_types = sorted([item[0] for item in db.session.query(Device.device_type).distinct().all()])
-    return render_template('handovers.html', handovers=handovers_pagination, users=users, device_types=device_types, filter_device_code=filter_device_code, filter_giver_id=filter_giver_id, filter_receiver_id=filter_receiver_id, filter_device_type=filter_device_type, filter_start_date=filter_start_date, filter_end_date=filter_end_date)
+    filter_receiver = User.query.get(int(filter_receiver_id)) if str(filter_receiver_id or '').isdigit() else None
+    device_types = _device_type_options()
+    return render_template('handovers.html', handovers=handovers_pagination, filter_receiver=filter_receiver, device_types=device_types, filter_device_code=filter_device_code, filter_giver_id=filter_giver_id, filter_receiver_id=filter_receiver_id, filter_device_type=filter_device_type, filter_start_date=filter_start_date, filter_end_date=filter_end_date)
 
 # Thêm route mới này vào file app.py (trong khu vực Handover Routes)
 
@@ -4401,12 +5923,41 @@ def add_handover():
             return redirect(url_for('add_handover'))
         condition_images_json = json.dumps(condition_images, ensure_ascii=False) if condition_images else None
         
-        handovers_created_count = 0
-        consumables_created_count = 0
-        for index, device_id in enumerate(device_ids):
-            if not device_id: continue # Bỏ qua các giá trị rỗng
-
-            device_to_update = Device.query.get(device_id)
+        giver_id = int(request.form['giver_id'])
+        receiver_id = int(receiver_id)
+        reason = request.form.get('reason', '')
+        location_text = request.form.get('location', '')
+        notes = request.form.get('notes', '')
+
+        # One query per table; rows are locked until commit on PostgreSQL (FOR UPDATE is a no-op on SQLite)
+        wanted_device_ids = []
+        for device_id in device_ids:
+            try:
+                wanted_device_ids.append(int(device_id))
+            except (TypeError, ValueError):
+                wanted_device_ids.append(None)
+        devices_by_id = {
+            device.id: device
+            for device in Device.query.filter(Device.id.in_([d for d in wanted_device_ids if d]))
+                .order_by(Device.id).with_for_update().populate_existing()
+        }
+        wanted_consumable_ids = []
+        for consumable_id in consumable_ids:
+            try:
+                wanted_consumable_ids.append(int(consumable_id))
+            except (TypeError, ValueError):
+                wanted_consumable_ids.append(None)
+        consumables_by_id = {
+            item.id: item
+            for item in ConsumableItem.query.filter(ConsumableItem.id.in_([c for c in wanted_consumable_ids if c]))
+                .order_by(ConsumableItem.id).with_for_update().populate_existing()
+        } if wanted_consumable_ids else {}
+
+        # --- Validation, in memory ---
+        handover_rows = []
+        handed_devices = []
+        for index, device_id in enumerate(wanted_device_ids):
+            device_to_update = devices_by_id.get(device_id)
             if not device_to_update:
                 flash('Thiết bị không hợp lệ.', 'warning')
                 continue
@@ -4416,82 +5967,97 @@ def add_handover():
             if can_manage_all_devices and device_to_update.status == CONVERTED_CONSUMABLE_STATUS:
                 flash(f'Thiết bị {device_to_update.device_code} không hợp lệ để bàn giao.', 'warning')
                 continue
-
-            new_handover = DeviceHandover(
+            handover_rows.append(dict(
                 batch_id=batch_id,
-                handover_date=handover_date, 
-                device_id=device_id, 
-                giver_id=request.form['giver_id'], 
-                receiver_id=receiver_id, 
+                handover_date=handover_date,
+                device_id=device_to_update.id,
+                giver_id=giver_id,
+                receiver_id=receiver_id,
                 device_condition=(device_conditions[index] if index < len(device_conditions) and device_conditions[index] else (device_to_update.condition or 'Sử dụng bình thường')),
-                reason=request.form.get('reason', ''), 
-                location=request.form.get('location', ''), 
-                notes=request.form.get('notes', ''),
-                condition_images=condition_images_json
-            )
-            db.session.add(new_handover)
-            
-            # Cập nhật trạng thái thiết bị
-            device_to_update.manager_id = int(receiver_id)
-            device_to_update.assign_date = new_handover.handover_date
-            device_to_update.status = 'Đã cấp phát'
-            
-            handovers_created_count += 1
+                reason=reason,
+                location=location_text,
+                notes=notes,
+                condition_images=condition_images_json,
+            ))
+            handed_devices.append(device_to_update)
 
+        consumable_lines = []  # (item, quantity, location, before, after)
         try:
-            for index, consumable_id in enumerate(consumable_ids):
-                item = ConsumableItem.query.get(consumable_id)
+            remaining = {}
+            for index, consumable_id in enumerate(wanted_consumable_ids):
+                item = consumables_by_id.get(consumable_id)
                 if not item or item.is_active is False:
                     raise ValueError('Vật tư không hợp lệ hoặc đã ngừng sử dụng.')
                 quantity = _parse_positive_int(consumable_quantities[index] if index < len(consumable_quantities) else None)
                 location = (consumable_locations[index] if index < len(consumable_locations) else '').strip() or item.location
-                tx = _record_consumable_transaction(
-                    item,
-                    'Xuất',
-                    quantity,
-                    issued_to_id=int(receiver_id),
-                    reason='Xuất theo phiếu bàn giao',
-                    notes=request.form.get('notes', ''),
-                    batch_id=batch_id,
-                    location=location,
-                )
-                if item.track_after_handover:
-                    db.session.add(ConsumableHandoverItem(
-                        batch_id=batch_id,
-                        consumable_id=item.id,
-                        receiver_id=int(receiver_id),
-                        giver_id=int(request.form['giver_id']) if request.form.get('giver_id') else None,
-                        quantity=quantity,
-                        location=location,
-                        handover_date=handover_date,
-                        notes=f'Tạo từ nhật ký xuất kho #{tx.id}' if tx.id else ''
-                    ))
-                consumables_created_count += 1
+                before_quantity = remaining.get(item.id, item.current_quantity or 0)
+                if quantity > before_quantity:
+                    raise ValueError('Số lượng xuất lớn hơn tồn kho hiện tại.')
+                remaining[item.id] = before_quantity - quantity
+                consumable_lines.append((item, quantity, location, before_quantity, remaining[item.id]))
         except ValueError as e:
             db.session.rollback()
             _delete_handover_condition_images(condition_images)
             flash(str(e), 'danger')
             return redirect(url_for('add_handover'))
 
+        handovers_created_count = len(handover_rows)
+        consumables_created_count = len(consumable_lines)
         if handovers_created_count == 0 and consumables_created_count > 0:
-            db.session.add(DeviceHandover(
+            handover_rows.append(dict(
                 batch_id=batch_id,
                 handover_date=handover_date,
                 device_id=None,
-                giver_id=request.form['giver_id'],
+                giver_id=giver_id,
                 receiver_id=receiver_id,
                 device_condition='Không áp dụng',
-                reason=request.form.get('reason', ''),
-                location=request.form.get('location', ''),
-                notes=request.form.get('notes', ''),
-                condition_images=condition_images_json
+                reason=reason,
+                location=location_text,
+                notes=notes,
+                condition_images=condition_images_json,
             ))
 
         if handovers_created_count > 0 or consumables_created_count > 0:
+            # Cập nhật trạng thái thiết bị và tồn kho (one executemany per table at flush)
+            for device_to_update in handed_devices:
+                device_to_update.manager_id = receiver_id
+                device_to_update.assign_date = handover_date
+                device_to_update.status = 'Đã cấp phát'
+            now = get_now()
+            for item, _, _, _, after_quantity in consumable_lines:
+                item.current_quantity = after_quantity
+                item.updated_at = now
+
+            _bulk_insert_rows(DeviceHandover, handover_rows)
+            transaction_ids = _bulk_insert_rows(ConsumableTransaction, [dict(
+                consumable_id=item.id,
+                transaction_type='Xuất',
+                quantity=quantity,
+                before_quantity=before_quantity,
+                after_quantity=after_quantity,
+                transaction_date=datetime.utcnow(),
+                issued_to_id=receiver_id,
+                actor_id=session.get('user_id'),
+                batch_id=batch_id,
+                location=location,
+                reason='Xuất theo phiếu bàn giao',
+                notes=notes,
+            ) for item, quantity, location, before_quantity, after_quantity in consumable_lines])
+            _bulk_insert_rows(ConsumableHandoverItem, [dict(
+                batch_id=batch_id,
+                consumable_id=item.id,
+                receiver_id=receiver_id,
+                giver_id=giver_id,
+                quantity=quantity,
+                location=location,
+                handover_date=handover_date,
+                notes=f'Tạo từ nhật ký xuất kho #{transaction_id}',
+            ) for (item, quantity, location, _, _), transaction_id in zip(consumable_lines, transaction_ids) if item.track_after_handover])
+            _sync_handover_batches([batch_id])
+            notify_user(receiver_id, f"Bạn vừa nhận bàn giao {handovers_created_count} thiết bị và {consumables_created_count} vật tư.", url_for('handover_list'))
+            notify_group(f"Thực hiện bàn giao {handovers_created_count} thiết bị và {consumables_created_count} vật tư thành công.", url_for('handover_list'))
             db.session.commit()
             flash(f'Tạo thành công phiếu bàn giao gồm {handovers_created_count} thiết bị và {consumables_created_count} vật tư.', 'success')
-            notify_user(int(receiver_id), f"Bạn vừa nhận bàn giao {handovers_created_count} thiết bị và {consumables_created_count} vật tư.", url_for('handover_list'))
-            notify_group(f"Thực hiện bàn giao {handovers_created_count} thiết bị và {consumables_created_count} vật tư thành công.", url_for('handover_list'))
         else:
             db.session.rollback() # Hoàn tác nếu không có phiếu nào được tạo
             _delete_handover_condition_images(condition_images)
@@ -4506,7 +6072,7 @@ def add_handover():
         devices_query = devices_query.filter(Device.manager_id == current_user.id)
     devices = devices_query.order_by(Device.device_code).all()
     users = User.query.filter(User.status.notin_(['Nghỉ việc', 'Nghỉ không lương']))\
-        .order_by(func.lower(User.last_name_token), func.lower(User.full_name), func.lower(User.username)).all()
+        .order_by(User.sort_key, User.id).all()
     device_options = [{
         'id': device.id,
         'code': device.device_code,
@@ -4707,6 +6273,131 @@ def handover_detail(handover_id):
 
 # Thêm route mới này vào file app.py (trong khu vực Handover Routes)
 
+def _name_lookup_key(value):
+    """Match key for people's names typed in spreadsheets: NFC, single spaces, case-insensitive."""
+    return ' '.join(unicodedata.normalize('NFC', value or '').split()).casefold()
+
+def _handover_user_lookup():
+    """username -> id, then normalized full name -> id for names that are not also a username."""
+    by_username, by_name = {}, {}
+    for user_id, username, full_name in db.session.query(User.id, User.username, User.full_name).order_by(User.id):
+        if username:
+            by_username.setdefault(username.strip(), user_id)
+        if full_name:
+            by_name.setdefault(_name_lookup_key(full_name), user_id)
+    return lambda value: by_username.get(value) or by_name.get(_name_lookup_key(value))
+
+def _import_handovers_job(job, reporter):
+    reporter.update(progress=5, message='Đang đọc file Excel...')
+    sheet = ExcelChunks(job.input_path, aliases={
+        'Mã thiết bị': ['Mã Thiết Bị'],
+        'Tên đăng nhập người giao': ['Người Giao', 'Người giao'],
+        'Tên đăng nhập người nhận': ['Người Nhận', 'Người nhận'],
+        'Ngày bàn giao': ['Ngày Bàn Giao', 'Ngày Bàn giao'],
+        'Tình trạng thiết bị': ['Tình Trạng Thiết Bị', 'Tình trạng'],
+        'Lý do bàn giao': ['Lý Do', 'Lý do'],
+        'Nơi đặt thiết bị': ['Nơi Đặt', 'Nơi đặt'],
+        'Ghi chú': ['Ghi Chú']
+    })
+    required_columns = ['Mã thiết bị', 'Tên đăng nhập người giao', 'Tên đăng nhập người nhận', 'Ngày bàn giao', 'Tình trạng thiết bị']
+    if not all(col in sheet.columns for col in required_columns):
+        sheet.close()
+        return {'failed': True, 'message': f'File Excel phải chứa các cột bắt buộc: {", ".join(required_columns)}.'}
+
+    reporter.update(progress=10, rows_total=sheet.rows_estimate, message='Đang kiểm tra dữ liệu...')
+    # Everything the rows refer to is loaded once
+    device_ids = dict(db.session.query(Device.device_code, Device.id))
+    find_user = _handover_user_lookup()
+    batch_ids = {}      # (giver, receiver, date) -> batch_id, like one add_handover form per group
+    final_state = {}    # device id -> (date, row, receiver): the device ends with its latest handover
+    errors = []
+    imported = 0
+    rows_done = 0
+
+    for df in sheet:
+        codes = _text_column(df, 'Mã thiết bị')
+        givers = _text_column(df, 'Tên đăng nhập người giao')
+        receivers = _text_column(df, 'Tên đăng nhập người nhận')
+        raw_dates = _text_column(df, 'Ngày bàn giao')
+        dates, bad_dates = _date_column(df, 'Ngày bàn giao')
+        conditions = _optional_text_column(df, 'Tình trạng thiết bị')
+        reasons = _optional_text_column(df, 'Lý do bàn giao')
+        locations = _optional_text_column(df, 'Nơi đặt thiết bị')
+        notes = _optional_text_column(df, 'Ghi chú')
+
+        handovers_to_add = []
+        for index in df.index:
+            device_id = device_ids.get(codes[index])
+            giver_id = find_user(givers[index])
+            receiver_id = find_user(receivers[index])
+
+            # --- Validation ---
+            current_row_errors = []
+            if not device_id:
+                current_row_errors.append(f'Mã thiết bị "{codes[index]}" không tồn tại.')
+            if not giver_id:
+                current_row_errors.append(f'Người giao "{givers[index]}" không tồn tại.')
+            if not receiver_id:
+                current_row_errors.append(f'Người nhận "{receivers[index]}" không tồn tại.')
+            if current_row_errors:
+                errors.append(f"Dòng {index + 2}: " + ", ".join(current_row_errors))
+                continue
+            handover_date = dates[index]
+            if bad_dates[index] or handover_date is None:
+                errors.append(f'Dòng {index + 2}: Định dạng ngày "{raw_dates[index]}" không hợp lệ.')
+                continue
+            if not conditions[index]:
+                errors.append(f'Dòng {index + 2}: Thiếu tình trạng thiết bị.')
+                continue
+
+            batch_key = (giver_id, receiver_id, handover_date)
+            if batch_key not in batch_ids:
+                batch_ids[batch_key] = uuid.uuid4().hex
+            handovers_to_add.append(dict(
+                batch_id=batch_ids[batch_key],
+                device_id=device_id,
+                giver_id=giver_id,
+                receiver_id=receiver_id,
+                handover_date=handover_date,
+                device_condition=conditions[index],
+                reason=reasons[index],
+                location=locations[index],
+                notes=notes[index],
+            ))
+            state = (handover_date, index, receiver_id)
+            if device_id not in final_state or state[:2] > final_state[device_id][:2]:
+                final_state[device_id] = state
+
+        # Write each clean chunk right away so memory stays bounded; any error rolls everything back
+        if not errors:
+            _bulk_insert_rows(DeviceHandover, handovers_to_add)
+            imported += len(handovers_to_add)
+        rows_done += len(df)
+        reporter.row(rows_done)
+
+    if errors:
+        db.session.rollback() # Hoàn tác tất cả nếu có lỗi
+        return _import_error_result(f'Có {len(errors)} dòng lỗi, chưa nhập phiếu bàn giao nào.', errors)
+
+    # Cập nhật trạng thái của thiết bị: one row per device, with its latest handover
+    reporter.update(progress=92, message='Đang cập nhật trạng thái thiết bị...')
+    device = Device.__table__
+    connection = db.session.connection()
+    update_device = device.update().where(device.c.id == bindparam('b_id')).values(
+        status='Đã cấp phát', manager_id=bindparam('b_manager_id'), assign_date=bindparam('b_assign_date'),
+    )
+    stats_deltas = {}
+    for chunk in _chunked(list(final_state)):
+        _add_device_stats_deltas(stats_deltas, _device_stats_counts_for(connection, chunk), -1)
+        connection.execute(update_device, [
+            {'b_id': device_id, 'b_manager_id': final_state[device_id][2], 'b_assign_date': final_state[device_id][0]}
+            for device_id in chunk
+        ])
+        _add_device_stats_deltas(stats_deltas, _device_stats_counts_for(connection, chunk))
+    _apply_device_stats_deltas(connection, stats_deltas)
+    _sync_handover_batches(batch_ids.values(), connection)
+    return {'message': f'Đã nhập thành công {imported} phiếu bàn giao!', 'next': 'handover_list'}
+
 @app.route('/import_handovers', methods=['GET', 'POST'])
 def import_handovers():
     if 'user_id' not in session: return redirect(url_for('login'))
@@ -4717,92 +6408,8 @@ def import_handovers():
         if not file or not (file.filename.endswith('.xls') or file.filename.endswith('.xlsx')):
             flash('Vui lòng chọn một file Excel hợp lệ (.xls, .xlsx).', 'danger')
             return redirect(url_for('import_handovers'))
-
-        try:
-            df = pd.read_excel(file, engine='openpyxl')
-            df = _normalize_excel_columns(df, {
-                'Mã thiết bị': ['Mã Thiết Bị'],
-                'Tên đăng nhập người giao': ['Người Giao', 'Người giao'],
-                'Tên đăng nhập người nhận': ['Người Nhận', 'Người nhận'],
-                'Ngày bàn giao': ['Ngày Bàn Giao', 'Ngày Bàn giao'],
-                'Tình trạng thiết bị': ['Tình Trạng Thiết Bị', 'Tình trạng'],
-                'Lý do bàn giao': ['Lý Do', 'Lý do'],
-                'Nơi đặt thiết bị': ['Nơi Đặt', 'Nơi đặt'],
-                'Ghi chú': ['Ghi Chú']
-            })
-            required_columns = ['Mã thiết bị', 'Tên đăng nhập người giao', 'Tên đăng nhập người nhận', 'Ngày bàn giao', 'Tình trạng thiết bị']
-            if not all(col in df.columns for col in required_columns):
-                flash(f'File Excel phải chứa các cột bắt buộc: {", ".join(required_columns)}.', 'danger')
-                return redirect(url_for('import_handovers'))
-
-            errors = []
-            handovers_to_add = []
-            
-            for index, row in df.iterrows():
-                device_code = _cell_text(row['Mã thiết bị'])
-                giver_username = _cell_text(row['Tên đăng nhập người giao'])
-                receiver_username = _cell_text(row['Tên đăng nhập người nhận'])
-                handover_date_str = _cell_text(row['Ngày bàn giao'])
-
-                device = Device.query.filter_by(device_code=device_code).first()
-                giver = User.query.filter_by(username=giver_username).first() or User.query.filter_by(full_name=giver_username).first()
-                receiver = User.query.filter_by(username=receiver_username).first() or User.query.filter_by(full_name=receiver_username).first()
-
-                # --- Validation ---
-                current_row_errors = []
-                if not device:
-                    current_row_errors.append(f'Mã thiết bị "{device_code}" không tồn tại.')
-                if not giver:
-                    current_row_errors.append(f'Người giao "{giver_username}" không tồn tại.')
-                if not receiver:
-                    current_row_errors.append(f'Người nhận "{receiver_username}" không tồn tại.')
-                
-                if current_row_errors:
-                    errors.append(f"Dòng {index + 2}: " + ", ".join(current_row_errors))
-                    continue 
-
-                try:
-                    handover_date = pd.to_datetime(handover_date_str).date()
-                except (ValueError, TypeError):
-                    errors.append(f'Dòng {index + 2}: Định dạng ngày "{handover_date_str}" không hợp lệ.')
-                    continue
-
-                # Coerce possibly numeric-parsed text cells back to strings
-                def _s(v):
-                    if pd.isna(v):
-                        return None
-                    return str(v)
-                new_handover = DeviceHandover(
-                    device_id=device.id,
-                    giver_id=giver.id,
-                    receiver_id=receiver.id,
-                    handover_date=handover_date,
-                    device_condition=_s(row['Tình trạng thiết bị']),
-                    reason=_s(row.get('Lý do bàn giao')),
-                    location=_s(row.get('Nơi đặt thiết bị')),
-                    notes=_s(row.get('Ghi chú'))
-                )
-                # Insert row-by-row to avoid PG executemany casts
-                db.session.add(new_handover)
-                handovers_to_add.append(new_handover)
-                
-                # Cập nhật trạng thái của thiết bị
-                device.status = 'Đã cấp phát'
-                device.manager_id = receiver.id
-                device.assign_date = handover_date
-                
-            if errors:
-                for error in errors:
-                    flash(error, 'danger')
-                db.session.rollback() # Hoàn tác tất cả nếu có lỗi
-            else:
-                db.session.commit()
-                flash(f'Đã nhập thành công {len(handovers_to_add)} phiếu bàn giao!', 'success')
-                return redirect(url_for('handover_list'))
-
-        except Exception as e:
-            db.session.rollback()
-            flash(f'Đã xảy ra lỗi trong quá trình xử lý file: {str(e)}', 'danger')
+        job = _enqueue_job('import_handovers', upload=file)
+        return redirect(url_for('job_status', job_id=job.id))
 
     return render_template('import_handovers.html')
 
@@ -4843,13 +6450,10 @@ def user_list():
         query = query.filter(User.status == filter_status)
 
     # Sắp xếp danh sách người dùng theo token tên cuối (tên gọi) để đúng ABC theo tên
-    users_pagination = query.order_by(
-        func.lower(User.last_name_token),
-        func.lower(User.username)
-    ).paginate(page=page, per_page=per_page, error_out=False)
+    users_pagination = query.order_by(User.sort_key, User.id).paginate(page=page, per_page=per_page, error_out=False)
     
-    departments = [d.name for d in Department.query.order_by(Department.name).all()]
-    positions = [p[0] for p in db.session.query(User.position).filter(User.position.isnot(None)).distinct().order_by(User.position)]
+    departments = _department_name_options()
+    positions = _position_options()
     statuses = ['Đang làm', 'Thử việc', 'Nghỉ không lương', 'Nghỉ việc', 'Khác']
     current_permissions = _get_current_permissions()
 
@@ -4959,6 +6563,7 @@ def add_user():
             default_role = Role.query.filter_by(name='Người dùng').first()
             if default_role:
                 db.session.add(UserRole(user_id=new_user.id, role_id=default_role.id))
+                _bump_rbac_version()
                 db.session.commit()
         flash('Thêm người dùng mới thành công!', 'success')
         return redirect(url_for('user_list'))
@@ -5093,6 +6698,7 @@ def edit_user(user_id):
         
         # Xóa TẤT CẢ các quyền UserRole cũ để tránh xung đột quyền lẻ
         UserRole.query.filter_by(user_id=user_id).delete()
+        _bump_rbac_version()
         
         # Xử lý nghỉ việc - tự động tạo phiếu trả thiết bị
         
@@ -5180,8 +6786,1075 @@ def device_info(device_id):
         })
     return jsonify({'error': 'Device not found'}), 404
 
-# --- Import/Export Routes ---
-# ... (Các hàm import/export giữ nguyên) ...
+# --- Import/Export Routes ---
+# ... (Các hàm import/export giữ nguyên) ...
+# --- Background jobs ---
+# Long imports and restores are queued in background_job and executed by worker threads
+# (INVENTORY_JOB_WORKERS per web process, default 1) or a dedicated `flask jobs-worker`.
+# A job is claimed with a guarded UPDATE, so one worker at a time runs it. A job whose worker
+# died is requeued and may run again, so handlers never commit: their writes and the job's
+# final status commit together, guarded by the run's claim token, and a superseded run rolls
+# its data back. Restores replace the whole database and record their outcome on their own
+# (JOB_SELF_COMMITTING). Live progress goes to instance/jobs/<id>/progress.json: the job's own
+# transaction may hold the SQLite write lock, and the file mtime doubles as the heartbeat used
+# to requeue jobs of workers on other hosts (same-host claims are checked by pid). A side
+# thread keeps the heartbeat going while a handler sits in one long step.
+JOB_POLL_SECONDS = 2
+JOB_STALE_SECONDS = 600
+JOB_HEARTBEAT_SECONDS = 60
+JOB_MAX_ATTEMPTS = 3
+JOB_FINISHED_STATES = ('succeeded', 'failed')
+JOB_SELF_COMMITTING = ('backup_import',)
+JOB_FILES_RETENTION_SECONDS = 7 * 24 * 3600
+# Plaintext initial passwords: served once, and never kept longer than the TTL
+GENERATED_PASSWORDS_FILE = 'mat_khau_khoi_tao.xlsx'
+GENERATED_PASSWORDS_TTL = 3600
+_job_workers_started = False
+_job_workers_lock = threading.Lock()
+
+def _job_dir(job_id):
+    path = os.path.join(instance_path, 'jobs', str(int(job_id)))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def _job_progress_path(job_id):
+    return os.path.join(_job_dir(job_id), 'progress.json')
+
+def _job_file_path(job_id, filename):
+    """Path of a job file without creating the directory (it may have been pruned)."""
+    return os.path.join(instance_path, 'jobs', str(int(job_id)), filename)
+
+def _prune_job_files():
+    """Drop expired password files and the directories of jobs finished long ago."""
+    root = os.path.join(instance_path, 'jobs')
+    try:
+        job_ids = [int(name) for name in os.listdir(root) if name.isdigit()]
+    except OSError:
+        return
+    now = time.time()
+    for job_id in job_ids:
+        path = _job_file_path(job_id, GENERATED_PASSWORDS_FILE)
+        try:
+            if now - os.path.getmtime(path) > GENERATED_PASSWORDS_TTL:
+                os.remove(path)
+        except OSError:
+            pass
+    cutoff = datetime.utcnow() - timedelta(seconds=JOB_FILES_RETENTION_SECONDS)
+    expired = set()
+    for chunk in _chunked(job_ids):
+        expired.update(row[0] for row in db.session.query(BackgroundJob.id).filter(
+            BackgroundJob.id.in_(chunk),
+            BackgroundJob.status.in_(JOB_FINISHED_STATES),
+            BackgroundJob.finished_at < cutoff,
+        ))
+    for job_id in expired:
+        shutil.rmtree(os.path.join(root, str(job_id)), ignore_errors=True)
+
+def _job_params(job):
+    try:
+        return json.loads(job.params) if job.params else {}
+    except (TypeError, ValueError):
+        return {}
+
+def _worker_identity():
+    pid = os.getpid()
+    return f'{socket.gethostname()}:{pid}:{_process_start_time(pid) or ""}:{threading.get_ident()}'
+
+class JobReporter:
+    """Progress sink handed to job handlers; writes throttled snapshots to progress.json."""
+
+    def __init__(self, job_id, rows_total=None):
+        self.job_id = job_id
+        self.state = {'status': 'running', 'progress': 0, 'rows_total': rows_total, 'rows_done': 0, 'message': ''}
+        self._last_write = 0.0
+        self.update()
+
+    def update(self, progress=None, rows_total=None, rows_done=None, message=None, force=True):
+        for key, value in (('progress', progress), ('rows_total', rows_total), ('rows_done', rows_done), ('message', message)):
+            if value is not None:
+                self.state[key] = value
+        now = time.monotonic()
+        if force or now - self._last_write >= 0.5:
+            self._last_write = now
+            _write_job_progress(self.job_id, self.state)
+
+    def row(self, rows_done, start=10, end=90):
+        """Per-row counter for loops: maps rows_done onto the [start, end] progress band."""
+        total = self.state.get('rows_total') or 0
+        progress = start + int((end - start) * min(rows_done / total, 1)) if total else start
+        self.update(progress=progress, rows_done=rows_done, force=False)
+
+def _write_job_progress(job_id, state):
+    path = _job_progress_path(job_id)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+def _read_job_progress(job_id):
+    path = _job_progress_path(job_id)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}, os.path.getmtime(path)
+    except Exception:
+        return {}, None
+
+def _enqueue_job(kind, upload=None, suffix=None, user_id=None, params=None):
+    """Store the uploaded file under instance/jobs/<id>/ and queue a job for it."""
+    job = BackgroundJob(kind=kind, status='queued', created_by=user_id or session.get('user_id'),
+                        params=json.dumps(params, ensure_ascii=False) if params else None)
+    db.session.add(job)
+    db.session.flush()
+    if upload is not None:
+        if suffix is None:
+            suffix = os.path.splitext(secure_filename(upload.filename or ''))[1] or '.xlsx'
+        job.input_path = os.path.join(_job_dir(job.id), f'input{suffix}')
+        upload.save(job.input_path)
+    db.session.commit()
+    _start_job_workers()
+    return job
+
+def _claim_next_job(worker_id):
+    """Atomically move the oldest queued job to running for this worker.
+
+    Returns (job id, claim token), or (None, None) when nothing was claimed.
+    """
+    jobs = BackgroundJob.__table__
+    candidate = select(jobs.c.id).where(jobs.c.status == 'queued').order_by(jobs.c.id).limit(1)
+    if db.engine.dialect.name == 'postgresql':
+        candidate = candidate.with_for_update(skip_locked=True)
+    token = uuid.uuid4().hex
+    with db.engine.begin() as connection:
+        job_id = connection.execute(candidate).scalar()
+        if job_id is None:
+            return None, None
+        claimed = connection.execute(
+            jobs.update()
+            .where(jobs.c.id == job_id, jobs.c.status == 'queued')
+            .values(status='running', claimed_by=worker_id, claim_token=token,
+                    started_at=datetime.utcnow(), attempts=jobs.c.attempts + 1)
+        ).rowcount
+    return (job_id, token) if claimed else (None, None)
+
+def _job_owner_alive(job):
+    """True when the claiming worker still runs.
+
+    Same host: the claiming process (pid + start time) decides, however long a step takes.
+    Other hosts: the progress-file heartbeat must be fresh.
+    """
+    host, pid, start_time = ((job.claimed_by or '').split(':') + ['', '', ''])[:3]
+    if host == socket.gethostname() and pid.isdigit():
+        return _pid_is_running(int(pid)) and (not start_time or _process_start_time(int(pid)) == start_time)
+    _, heartbeat = _read_job_progress(job.id)
+    last_seen = heartbeat or (job.started_at.replace(tzinfo=pytz.utc).timestamp() if job.started_at else 0)
+    return time.time() - last_seen <= JOB_STALE_SECONDS
+
+def _requeue_orphaned_jobs():
+    """Return running jobs whose worker died to the queue (or fail them after JOB_MAX_ATTEMPTS)."""
+    jobs = BackgroundJob.__table__
+    for job in BackgroundJob.query.filter_by(status='running').all():
+        if _job_owner_alive(job):
+            continue
+        if job.attempts >= JOB_MAX_ATTEMPTS:
+            values = dict(status='failed', finished_at=datetime.utcnow(),
+                          message='Tiến trình xử lý bị gián đoạn nhiều lần, công việc đã bị hủy.')
+        else:
+            values = dict(status='queued', claimed_by=None, claim_token=None)
+        # Guard on the claim token so a job re-claimed (or finished) meanwhile is left alone
+        db.session.execute(jobs.update().where(
+            jobs.c.id == job.id, jobs.c.status == 'running', jobs.c.claim_token == job.claim_token,
+        ).values(**values))
+    db.session.commit()
+
+def _finish_job(connection, job_id, token, status, result, rows_done=None, rows_total=None):
+    """Store the outcome of the run holding `token` on `connection`; False for a superseded run.
+
+    The caller commits: for ordinary jobs this is the handler's own transaction.
+    """
+    jobs = BackgroundJob.__table__
+    values = dict(
+        status=status,
+        progress=100 if status == 'succeeded' else None,
+        message=result.get('message'),
+        result=json.dumps(result, ensure_ascii=False),
+        finished_at=datetime.utcnow(),
+    )
+    if rows_done is not None:
+        values['rows_done'] = rows_done
+    if rows_total is not None:
+        values['rows_total'] = rows_total
+    values = {k: v for k, v in values.items() if v is not None}
+    updated = connection.execute(
+        jobs.update().where(jobs.c.id == job_id, jobs.c.claim_token == token).values(**values)
+    ).rowcount
+    if updated:
+        return True
+    if connection.execute(select(jobs.c.id).where(jobs.c.id == job_id)).first() is not None:
+        return False
+    # The row is gone when a restore replaced the database underneath the job
+    connection.execute(jobs.insert().values(id=job_id, kind=result.get('kind', 'backup_import'), **values))
+    return True
+
+def _job_heartbeat(job_id, reporter, stop_event):
+    """Refresh progress.json while the handler is busy, so the job never looks abandoned."""
+    while not stop_event.wait(JOB_HEARTBEAT_SECONDS):
+        _write_job_progress(job_id, dict(reporter.state))
+
+def _run_job(job_id, token):
+    job = BackgroundJob.query.get(job_id)
+    if job is None:
+        return
+    kind, input_path = job.kind, job.input_path
+    reporter = JobReporter(job_id)
+    handler = JOB_HANDLERS.get(kind)
+    heartbeat_stop = threading.Event()
+    heartbeat = threading.Thread(target=_job_heartbeat, args=(job_id, reporter, heartbeat_stop), daemon=True)
+    heartbeat.start()
+    try:
+        if handler is None:
+            raise ValueError(f'Không hỗ trợ loại công việc "{kind}".')
+        result = handler(job, reporter) or {}
+        status = 'failed' if result.pop('failed', False) else 'succeeded'
+    except Exception as e:
+        db.session.rollback()
+        print(f"Background job {job_id} ({kind}) failed: {e}")
+        result, status = {'message': f'Đã xảy ra lỗi trong quá trình xử lý: {str(e)}'}, 'failed'
+    finally:
+        heartbeat_stop.set()
+        heartbeat.join()
+    after_commit = result.pop('after_commit', None)  # e.g. files that may only exist for committed data
+    result['kind'] = kind
+    counts = dict(rows_done=reporter.state.get('rows_done'), rows_total=reporter.state.get('rows_total'))
+    if kind in JOB_SELF_COMMITTING:
+        db.session.remove()
+        with db.engine.begin() as connection:
+            finished = _finish_job(connection, job_id, token, status, result, **counts)
+    else:
+        try:
+            db.session.flush()
+            finished = _finish_job(db.session.connection(), job_id, token, status, result, **counts)
+            if finished:
+                db.session.commit()
+            else:
+                db.session.rollback()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Background job {job_id} ({kind}) failed: {e}")
+            status, after_commit = 'failed', None
+            result = {'message': f'Đã xảy ra lỗi trong quá trình xử lý: {str(e)}', 'kind': kind}
+            finished = _finish_job(db.session.connection(), job_id, token, status, result, **counts)
+            db.session.commit()
+    db.session.remove()
+    if not finished:
+        print(f"Background job {job_id} ({kind}) was re-claimed by another worker; its changes were rolled back")
+        return
+    if after_commit is not None:
+        try:
+            after_commit()
+        except Exception as e:
+            print(f"Background job {job_id} ({kind}) post-commit step failed: {e}")
+    _write_job_progress(job_id, {**reporter.state, 'status': status, 'progress': 100 if status == 'succeeded' else reporter.state.get('progress'), 'message': result.get('message')})
+    if input_path and os.path.exists(input_path):
+        try:
+            os.remove(input_path)
+        except OSError:
+            pass
+
+def _job_worker_loop(stop_event=None, once=False):
+    worker_id = _worker_identity()
+    last_recovery = 0.0
+    while not (stop_event and stop_event.is_set()):
+        job_id = None
+        with app.app_context():
+            try:
+                if time.monotonic() - last_recovery > JOB_STALE_SECONDS / 2:
+                    last_recovery = time.monotonic()
+                    _requeue_orphaned_jobs()
+                    _prune_job_files()
+                job_id, token = _claim_next_job(worker_id)
+                if job_id is not None:
+                    _run_job(job_id, token)
+            except Exception as e:
+                print(f"Job worker error: {e}")
+            finally:
+                db.session.remove()
+        if once and job_id is None:
+            return
+        if job_id is None:
+            time.sleep(JOB_POLL_SECONDS)
+
+def _start_job_workers():
+    global _job_workers_started
+    if _job_workers_started:
+        return
+    with _job_workers_lock:
+        if _job_workers_started:
+            return
+        _job_workers_started = True
+        try:
+            count = int(os.environ.get('INVENTORY_JOB_WORKERS', '1'))
+        except ValueError:
+            count = 1
+        for _ in range(max(0, count)):
+            threading.Thread(target=_job_worker_loop, daemon=True).start()
+
+@app.before_request
+def start_job_workers_once():
+    # Started on the first request so queued/orphaned jobs resume after a restart
+    _start_job_workers()
+
+JOB_HANDLERS = {
+    'import_devices': lambda job, reporter: _import_devices_job(job, reporter),
+    'import_users': lambda job, reporter: _import_users_job(job, reporter),
+    'import_handovers': lambda job, reporter: _import_handovers_job(job, reporter),
+    'backup_import': lambda job, reporter: _backup_import_job(job, reporter),
+}
+
+JOB_TITLES = {
+    'import_devices': 'Nhập thiết bị từ Excel',
+    'import_users': 'Nhập người dùng từ Excel',
+    'import_handovers': 'Nhập phiếu bàn giao từ Excel',
+    'backup_import': 'Khôi phục dữ liệu từ file backup',
+}
+
+def _job_payload(job):
+    """Job state for the status page/JSON, overlaying live progress while it runs."""
+    result = {}
+    if job.result:
+        try:
+            result = json.loads(job.result)
+        except (TypeError, ValueError):
+            result = {}
+    payload = {
+        'id': job.id,
+        'kind': job.kind,
+        'title': JOB_TITLES.get(job.kind, job.kind),
+        'status': job.status,
+        'progress': job.progress or 0,
+        'rows_total': job.rows_total,
+        'rows_done': job.rows_done or 0,
+        'message': job.message or '',
+        'finished': job.status in JOB_FINISHED_STATES,
+    }
+    if job.status == 'running':
+        live, _ = _read_job_progress(job.id)
+        for key in ('progress', 'rows_total', 'rows_done', 'message'):
+            if live.get(key) is not None:
+                payload[key] = live[key]
+    if payload['finished']:
+        payload['errors'] = result.get('errors') or []
+        payload['error_total'] = result.get('error_total') or 0
+        if result.get('artifact'):
+            payload['artifact_url'] = url_for('job_artifact', job_id=job.id, filename=result['artifact'])
+        payload['downloads'] = [
+            {'label': label, 'url': url_for('job_artifact', job_id=job.id, filename=filename)}
+            for filename, label in result.get('downloads') or []
+            if os.path.exists(_job_file_path(job.id, filename))
+        ]
+        if result.get('next'):
+            payload['next_url'] = url_for(result['next'])
+    return payload
+
+def _get_job_for_current_user(job_id):
+    job = BackgroundJob.query.get(job_id)
+    if job is None:
+        return None
+    if job.created_by != session.get('user_id') and not _is_admin_user():
+        return None
+    return job
+
+@app.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    if 'user_id' not in session: return redirect(url_for('login'))
+    job = _get_job_for_current_user(job_id)
+    if not job:
+        flash('Không tìm thấy công việc.', 'danger')
+        return redirect(url_for('home'))
+    return render_template('jobs/status.html', job=_job_payload(job))
+
+@app.route('/jobs/<int:job_id>.json')
+def job_status_json(job_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    job = _get_job_for_current_user(job_id)
+    if not job:
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify(_job_payload(job))
+
+@app.route('/jobs/<int:job_id>/files/<path:filename>')
+def job_artifact(job_id, filename):
+    if 'user_id' not in session: return redirect(url_for('login'))
+    job = _get_job_for_current_user(job_id)
+    if not job or secure_filename(filename) != filename or filename.startswith('input'):
+        flash('Không tìm thấy file.', 'danger')
+        return redirect(url_for('home'))
+    path = _job_file_path(job.id, filename)
+    if filename == GENERATED_PASSWORDS_FILE:
+        # One-time download: the plaintext passwords leave the server with this response
+        try:
+            with open(path, 'rb') as f:
+                data = io.BytesIO(f.read())
+            os.remove(path)
+        except OSError:
+            flash('File mật khẩu đã được tải về hoặc đã hết hạn.', 'warning')
+            return redirect(url_for('job_status', job_id=job.id))
+        return send_file(data, as_attachment=True, download_name=filename)
+    if not os.path.exists(path):
+        flash('File đã hết hạn lưu trữ.', 'warning')
+        return redirect(url_for('job_status', job_id=job.id))
+    return send_from_directory(os.path.dirname(path), filename, as_attachment=True)
+
+@app.cli.command("jobs-worker")
+@click.option('--once', is_flag=True, help='Xử lý hết hàng đợi rồi thoát.')
+def jobs_worker_command(once):
+    """Chạy tiến trình xử lý công việc nền (nhập Excel, khôi phục backup)."""
+    with app.app_context():
+        db.create_all()
+    click.echo('Job worker started.' if not once else 'Processing queued jobs...')
+    _job_worker_loop(once=once)
+
+# --- Telegram outbox ---
+# send_telegram_message() only writes a telegram_outbox row in the caller's transaction. Each web
+# process (and `flask telegram-worker`) runs a dispatcher thread, but only the holder of the
+# 'telegram-dispatcher' worker_lease sends; the others stand by and take over once the lease
+# expires, so the rate limits below hold for the whole deployment. The dispatcher claims due rows
+# with a guarded UPDATE, merges the messages queued for the same chat, and hands each chat to a
+# fixed pool of senders. Every sender keeps one HTTP connection to the Bot API alive. A shared
+# limiter keeps under the API limits: about 30 messages/s overall, 1/s per chat, 20/min per
+# group. Failed sends are retried with backoff (or after the API's retry_after); 400/403/404
+# answers (chat not found, bot blocked) are not. TELEGRAM_API_BASE points the worker at
+# another server, e.g. a local stub in tests.
+TELEGRAM_API_BASE = os.environ.get('TELEGRAM_API_BASE', 'https://api.telegram.org')
+TELEGRAM_POLL_SECONDS = 5
+TELEGRAM_BATCH_SIZE = 200
+TELEGRAM_RATE_PER_SECOND = 25
+TELEGRAM_CHAT_INTERVAL = 1.0
+TELEGRAM_GROUP_INTERVAL = 3.0
+TELEGRAM_MAX_TEXT = 4096
+TELEGRAM_MAX_ATTEMPTS = 6
+TELEGRAM_BACKOFF_SECONDS = (5, 30, 120, 600, 1800)
+TELEGRAM_CLAIM_SECONDS = 300
+TELEGRAM_KEEP_SENT_DAYS = 7
+TELEGRAM_LEASE_NAME = 'telegram-dispatcher'
+TELEGRAM_LEASE_SECONDS = 60
+TELEGRAM_LEASE_RENEW_SECONDS = 10
+_telegram_wakeup = threading.Event()
+_telegram_worker_started = False
+_telegram_worker_lock = threading.Lock()
+
+@event.listens_for(db.session, 'after_commit')
+def _wake_telegram_worker(session):
+    if session.info.pop('telegram_queued', False):
+        _telegram_wakeup.set()
+
+class TelegramClient:
+    """Bot API sender holding one keep-alive connection; not thread-safe, one per pool thread."""
+
+    def __init__(self, token, base_url=None, timeout=10):
+        parts = urllib.parse.urlsplit(base_url or TELEGRAM_API_BASE)
+        self._connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self._host = parts.netloc
+        self._path = f"{parts.path.rstrip('/')}/bot{token}/sendMessage"
+        self._timeout = timeout
+        self._connection = None
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def send(self, chat_id, text):
+        """POST sendMessage; returns ('sent' | 'retry' | 'failed', retry_after seconds or None, error)."""
+        body = json.dumps({'chat_id': chat_id, 'text': text}).encode('utf-8')
+        headers = {'Content-Type': 'application/json', 'Connection': 'keep-alive'}
+        while True:
+            reused = self._connection is not None
+            if not reused:
+                self._connection = self._connection_class(self._host, timeout=self._timeout)
+            try:
+                self._connection.request('POST', self._path, body, headers)
+                response = self._connection.getresponse()
+                raw = response.read()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as exc:
+                # The server closed an idle kept-alive socket before reading the request: resend once
+                self.close()
+                if not reused:
+                    return 'retry', None, str(exc)
+            except (http.client.HTTPException, OSError) as exc:
+                self.close()
+                return 'retry', None, str(exc)
+        if response.getheader('Connection', '').lower() == 'close':
+            self.close()
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            data = {}
+        if response.status == 200 and data.get('ok'):
+            return 'sent', None, None
+        error = f"HTTP {response.status}: {data.get('description') or raw[:200].decode('utf-8', 'replace')}"
+        if response.status in (400, 401, 403, 404):
+            return 'failed', None, error
+        return 'retry', (data.get('parameters') or {}).get('retry_after'), error
+
+class TelegramRateLimiter:
+    """Global token bucket plus a minimum interval between two messages to the same chat."""
+
+    def __init__(self, per_second=TELEGRAM_RATE_PER_SECOND, chat_interval=TELEGRAM_CHAT_INTERVAL,
+                 group_interval=TELEGRAM_GROUP_INTERVAL):
+        self._lock = threading.Lock()
+        self._rate = float(per_second)
+        self._tokens = float(per_second)
+        self._updated = time.monotonic()
+        self._chat_interval = chat_interval
+        self._group_interval = group_interval
+        self._chat_ready = {}
+
+    def wait(self, chat_id):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._rate, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                ready_at = self._chat_ready.get(chat_id, now)
+                if self._tokens < 1:
+                    ready_at = max(ready_at, now + (1 - self._tokens) / self._rate)
+                if ready_at <= now:
+                    self._tokens -= 1
+                    # Group and channel ids are negative
+                    interval = self._group_interval if str(chat_id).startswith('-') else self._chat_interval
+                    self._chat_ready[chat_id] = now + interval
+                    if len(self._chat_ready) > 10000:
+                        self._chat_ready = {key: value for key, value in self._chat_ready.items() if value > now}
+                    return
+            time.sleep(ready_at - now)
+
+    def defer(self, chat_id, seconds):
+        """Hold a chat back after the API answered 429 with retry_after."""
+        with self._lock:
+            self._chat_ready[chat_id] = max(self._chat_ready.get(chat_id, 0), time.monotonic() + seconds)
+
+def _acquire_lease(name, holder, seconds):
+    """Take the named lease, or extend it if `holder` already has it; False while someone else does."""
+    leases = WorkerLease.__table__
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=seconds)
+    with db.engine.begin() as connection:
+        taken = connection.execute(
+            leases.update().where(leases.c.name == name, or_(leases.c.holder == holder, leases.c.expires_at < now))
+            .values(holder=holder, expires_at=expires_at)
+        ).rowcount
+        if taken:
+            return True
+        if connection.execute(select(leases.c.name).where(leases.c.name == name)).first() is not None:
+            return False
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(leases.insert().values(name=name, holder=holder, expires_at=expires_at))
+        return True
+    except IntegrityError:
+        return False  # another process created it first
+
+def _release_lease(name, holder):
+    leases = WorkerLease.__table__
+    with db.engine.begin() as connection:
+        connection.execute(leases.delete().where(leases.c.name == name, leases.c.holder == holder))
+
+def _coalesce_telegram_rows(rows):
+    """Group claimed rows by chat, oldest first, merging texts up to Telegram's message size."""
+    chats = {}
+    for row in rows:
+        messages = chats.setdefault(row.chat_id, [])
+        text_value = row.text[:TELEGRAM_MAX_TEXT]
+        if messages and len(messages[-1]['text']) + 2 + len(text_value) <= TELEGRAM_MAX_TEXT:
+            messages[-1]['text'] += '\n\n' + text_value
+            messages[-1]['rows'].append(row)
+        else:
+            messages.append({'text': text_value, 'rows': [row]})
+    return chats
+
+def _claim_telegram_rows(limit=TELEGRAM_BATCH_SIZE):
+    """Claim due messages (and ones left 'sending' by a dead worker); returns (token, rows)."""
+    outbox = TelegramOutbox.__table__
+    now = datetime.utcnow()
+    due = or_(
+        and_(outbox.c.status == 'pending', outbox.c.next_attempt_at <= now),
+        and_(outbox.c.status == 'sending', outbox.c.claimed_at < now - timedelta(seconds=TELEGRAM_CLAIM_SECONDS)),
+    )
+    candidates = select(outbox.c.id).where(due).order_by(outbox.c.id).limit(limit)
+    if db.engine.dialect.name == 'postgresql':
+        candidates = candidates.with_for_update(skip_locked=True)
+    token = uuid.uuid4().hex
+    with db.engine.begin() as connection:
+        ids = connection.execute(candidates).scalars().all()
+        if not ids:
+            return token, []
+        connection.execute(
+            outbox.update().where(outbox.c.id.in_(ids), due)
+            .values(status='sending', claim_token=token, claimed_at=now)
+        )
+        rows = connection.execute(
+            select(outbox.c.id, outbox.c.chat_id, outbox.c.text, outbox.c.attempts)
+            .where(outbox.c.claim_token == token).order_by(outbox.c.id)
+        ).all()
+    return token, rows
+
+def _telegram_backoff(attempts, retry_after=None):
+    if retry_after:
+        return float(retry_after)
+    return TELEGRAM_BACKOFF_SECONDS[min(attempts, len(TELEGRAM_BACKOFF_SECONDS)) - 1]
+
+def _deliver_telegram_chat(chat_id, messages, limiter, client_for):
+    """Send one chat's messages in order; stop at the first failure so later ones keep their place."""
+    client = client_for()
+    outcomes = []
+    for index, message in enumerate(messages):
+        limiter.wait(chat_id)
+        status, retry_after, error = client.send(chat_id, message['text'])
+        outcomes.append((message['rows'], status, retry_after, error))
+        if status == 'retry':
+            if retry_after:
+                limiter.defer(chat_id, float(retry_after))
+            outcomes.extend((later['rows'], 'pending', None, None) for later in messages[index + 1:])
+            break
+    return outcomes
+
+def _record_telegram_outcomes(token, outcomes):
+    outbox = TelegramOutbox.__table__
+    now = datetime.utcnow()
+    updates = []
+    for rows, status, retry_after, error in outcomes:
+        for row in rows:
+            values = {'b_id': row.id, 'b_status': status, 'b_attempts': row.attempts, 'b_next': now,
+                      'b_error': error, 'b_sent_at': None}
+            if status == 'sent':
+                values.update(b_attempts=row.attempts + 1, b_sent_at=now)
+            elif status == 'pending':
+                pass  # not tried this round
+            elif status == 'failed' or row.attempts + 1 >= TELEGRAM_MAX_ATTEMPTS:
+                values.update(b_status='failed', b_attempts=row.attempts + 1)
+            else:
+                values.update(b_status='pending', b_attempts=row.attempts + 1,
+                              b_next=now + timedelta(seconds=_telegram_backoff(row.attempts + 1, retry_after)))
+            updates.append(values)
+    statement = outbox.update().where(outbox.c.id == bindparam('b_id'), outbox.c.claim_token == token).values(
+        status=bindparam('b_status'), attempts=bindparam('b_attempts'), next_attempt_at=bindparam('b_next'),
+        last_error=bindparam('b_error'), sent_at=bindparam('b_sent_at'), claim_token=None,
+    )
+    with db.engine.begin() as connection:
+        for chunk in _chunked(updates):
+            connection.execute(statement, chunk)
+    return sum(1 for value in updates if value['b_status'] == 'sent')
+
+def _prune_telegram_outbox():
+    cutoff = datetime.utcnow() - timedelta(days=TELEGRAM_KEEP_SENT_DAYS)
+    with db.engine.begin() as connection:
+        connection.execute(TelegramOutbox.__table__.delete().where(
+            TelegramOutbox.status == 'sent', TelegramOutbox.sent_at < cutoff))
+
+def _telegram_outbox_loop(stop_event=None, once=False, pool_size=None, base_url=None):
+    """Deliver the outbox until stopped; with once=True, return when nothing is due."""
+    token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    if not token:
+        return
+    if pool_size is None:
+        pool_size = _telegram_pool_size() or 1
+    limiter = TelegramRateLimiter()
+    local = threading.local()
+
+    def client_for():
+        if getattr(local, 'client', None) is None:
+            local.client = TelegramClient(token, base_url)
+        return local.client
+
+    holder = _worker_identity()
+    last_prune = 0.0
+    leader = False
+    with ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='telegram') as pool:
+        try:
+            while not (stop_event and stop_event.is_set()):
+                claimed = []
+                with app.app_context():
+                    try:
+                        leader = _acquire_lease(TELEGRAM_LEASE_NAME, holder, TELEGRAM_LEASE_SECONDS)
+                        if leader:
+                            if time.monotonic() - last_prune > 3600:
+                                last_prune = time.monotonic()
+                                _prune_telegram_outbox()
+                            claim_token, claimed = _claim_telegram_rows()
+                        if claimed:
+                            chats = _coalesce_telegram_rows(claimed)
+                            futures = [pool.submit(_deliver_telegram_chat, chat_id, messages, limiter, client_for)
+                                       for chat_id, messages in chats.items()]
+                            # Slow chats (1 msg/s, 20/min for groups) can outlast the lease: keep renewing it
+                            while wait_futures(futures, timeout=TELEGRAM_LEASE_RENEW_SECONDS).not_done:
+                                _acquire_lease(TELEGRAM_LEASE_NAME, holder, TELEGRAM_LEASE_SECONDS)
+                            _record_telegram_outcomes(claim_token, [outcome for future in futures for outcome in future.result()])
+                    except Exception as e:
+                        print(f"Telegram outbox error: {e}")
+                    finally:
+                        db.session.remove()
+                if once and not claimed:
+                    return
+                if not claimed:
+                    # Standby dispatchers only poll the lease; they take over once it expires
+                    _telegram_wakeup.wait(TELEGRAM_POLL_SECONDS if leader else TELEGRAM_LEASE_SECONDS / 2)
+                    _telegram_wakeup.clear()
+        finally:
+            if leader:
+                with app.app_context():
+                    try:
+                        _release_lease(TELEGRAM_LEASE_NAME, holder)
+                    except Exception as e:
+                        print(f"Telegram lease release error: {e}")
+                    finally:
+                        db.session.remove()
+
+def _telegram_pool_size():
+    try:
+        return max(0, int(os.environ.get('INVENTORY_TELEGRAM_WORKERS', '4')))
+    except ValueError:
+        return 4
+
+def _start_telegram_worker():
+    global _telegram_worker_started
+    if _telegram_worker_started:
+        return
+    with _telegram_worker_lock:
+        if _telegram_worker_started:
+            return
+        _telegram_worker_started = True
+        if os.environ.get('TELEGRAM_BOT_TOKEN') and _telegram_pool_size():
+            threading.Thread(target=_telegram_outbox_loop, daemon=True).start()
+
+@app.before_request
+def start_telegram_worker_once():
+    _start_telegram_worker()
+
+@app.cli.command("telegram-worker")
+@click.option('--once', is_flag=True, help='Gửi hết tin nhắn đến hạn rồi thoát.')
+def telegram_worker_command(once):
+    """Chạy tiến trình gửi tin nhắn Telegram từ hàng đợi (telegram_outbox)."""
+    with app.app_context():
+        db.create_all()
+    click.echo('Telegram worker started.' if not once else 'Sending queued Telegram messages...')
+    _telegram_outbox_loop(once=once)
+
+# --- Bulk load writer ---
+BULK_LOAD_CHUNK_SIZE = 5000
+
+def _bulk_column_default(column):
+    default = column.default
+    if default is None or not (default.is_scalar or default.is_callable):
+        return None
+    return default.arg(None) if default.is_callable else default.arg
+
+def _copy_csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (datetime, date)):
+        value = value.isoformat()
+    return '"' + str(value).replace('"', '""') + '"'
+
+def _bulk_insert_rows(model, rows):
+    """Insert dict rows for `model` in the current transaction; returns new ids in row order.
+
+    PostgreSQL reserves ids from the table's sequence and streams the rows with COPY FROM STDIN
+    (psycopg2). Other databases use chunked executemany with ordered RETURNING where available.
+    ORM flush events do not fire: search/sort keys and search tokens are filled in here, callers
+    refresh the other derived data (stats, caches, closure).
+    """
+    if not rows:
+        return []
+    if model in SEARCH_KEY_COLUMNS:
+        rows = [{**_derived_keys(model, row), **row} for row in rows]
+    db.session.flush()
+    table = model.__table__
+    pk = list(table.primary_key.columns)[0]
+    given = set().union(*(row.keys() for row in rows))
+    columns = [c for c in table.columns if c is not pk and (c.key in given or c.default is not None)]
+    defaults = {c.key: _bulk_column_default(c) for c in columns if c.key not in given or c.default is not None}
+    prepared = [
+        {c.key: row[c.key] if c.key in row else defaults.get(c.key) for c in columns}
+        for row in rows
+    ]
+    connection = db.session.connection()
+
+    if connection.dialect.name == 'postgresql' and connection.dialect.driver == 'psycopg2':
+        ids = list(connection.execute(
+            text('SELECT nextval(pg_get_serial_sequence(:table, :column)) FROM generate_series(1, :n)'),
+            {'table': table.name, 'column': pk.name, 'n': len(prepared)},
+        ).scalars())
+        preparer = connection.dialect.identifier_preparer
+        column_sql = ', '.join(preparer.quote(c.name) for c in [pk, *columns])
+        copy_sql = f'COPY {preparer.format_table(table)} ({column_sql}) FROM STDIN WITH (FORMAT csv)'
+        cursor = connection.connection.dbapi_connection.cursor()
+        try:
+            for start in range(0, len(prepared), BULK_LOAD_CHUNK_SIZE):
+                buffer = io.StringIO()
+                for new_id, row in zip(ids[start:start + BULK_LOAD_CHUNK_SIZE], prepared[start:start + BULK_LOAD_CHUNK_SIZE]):
+                    buffer.write(','.join([str(new_id), *(_copy_csv_value(row[c.key]) for c in columns)]) + '\n')
+                buffer.seek(0)
+                cursor.copy_expert(copy_sql, buffer)
+        finally:
+            cursor.close()
+    elif connection.dialect.insert_executemany_returning_sort_by_parameter_order:
+        ids = []
+        statement = table.insert().returning(pk, sort_by_parameter_order=True)
+        for chunk in _chunked(prepared, BULK_LOAD_CHUNK_SIZE):
+            ids.extend(connection.execute(statement, chunk).scalars())
+    else:
+        ids = [connection.execute(table.insert(), row).inserted_primary_key[0] for row in prepared]
+    if model in SEARCH_TOKEN_ENTITIES:
+        _write_search_tokens(connection, model, zip(ids, (row['search_key'] for row in rows)))
+    return ids
+
+def _after_bulk_device_load(device_ids):
+    """Refresh what the after_flush hooks would have maintained for bulk-inserted devices."""
+    connection = db.session.connection()
+    deltas = {}
+    for chunk in _chunked(device_ids):
+        _add_device_stats_deltas(deltas, _device_stats_counts_for(connection, chunk))
+    _apply_device_stats_deltas(connection, deltas)
+    _invalidate_filter_options('device_types')
+
+IMPORT_ERROR_PREVIEW = 50
+
+def _none_column(df):
+    return pd.Series([None] * len(df), index=df.index, dtype=object)
+
+def _text_column(df, name):
+    """Column as stripped strings ('' for blanks); all blank when the column is missing."""
+    if name not in df.columns:
+        return pd.Series('', index=df.index, dtype=object)
+    column = df[name]
+    return column.where(column.notna(), '').astype(str).str.strip()
+
+def _optional_text_column(df, name):
+    """Like the old per-cell str(v): None for blanks, text otherwise."""
+    if name not in df.columns:
+        return _none_column(df)
+    column = df[name]
+    return column.astype(object).where(column.notna(), None).map(lambda v: v if v is None else str(v))
+
+def _date_column(df, name):
+    """Parse a whole date column (dd-mm-yyyy or Excel dates); returns (dates, invalid_mask)."""
+    if name not in df.columns:
+        return _none_column(df), pd.Series(False, index=df.index)
+    raw = df[name]
+    present = raw.notna() & (raw.astype(str).str.strip() != '')
+    parsed = pd.to_datetime(raw.where(present), errors='coerce', dayfirst=True, format='mixed')
+    dates = parsed.dt.date.astype(object).where(parsed.notna(), None)
+    return dates, present & parsed.isna()
+
+def _price_column(df, name):
+    """Numbers stay as-is; text like '15.000.000 đ' is stripped of separators. Invalid -> None."""
+    if name not in df.columns:
+        return _none_column(df)
+    raw = df[name]
+    is_text = raw.map(lambda v: isinstance(v, str))
+    numeric = pd.to_numeric(raw.where(~is_text), errors='coerce')
+    cleaned = raw.where(is_text, '').astype(str).str.replace(r'[.,₫đ]', '', regex=True).str.strip()
+    numeric = numeric.where(~is_text, pd.to_numeric(cleaned.where(cleaned != ''), errors='coerce'))
+    return numeric.astype(object).where(numeric.notna(), None)
+
+def _device_pc_spec_columns(df):
+    """Vectorized _device_pc_specs_from_row: explicit columns win, the parsed 'Cấu hình' fills gaps."""
+    configs = _text_column(df, 'Cấu hình')
+    parsed = {text: _device_pc_specs_from_config_text(text) for text in configs.unique()}
+    from_config = lambda key: configs.map(lambda text: parsed[text].get(key))
+
+    def pick(*names, key):
+        result = pd.Series('', index=df.index, dtype=object)
+        for name in names:
+            result = result.where(result != '', _text_column(df, name))
+        result = result.where(result != '', from_config(key))
+        return result.where(result.notna() & (result != ''), None)
+
+    ram_raw = df['RAM (GB)'] if 'RAM (GB)' in df.columns else _none_column(df)
+    ram = pd.to_numeric(ram_raw.astype(str).str.extract(r'(\d+)', expand=False), errors='coerce')
+    ram = ram.where(ram > 0)
+    ram = ram.astype(object).where(ram.notna(), from_config('ram_gb'))
+    ram = pd.Series([None if v is None or pd.isna(v) else int(v) for v in ram], index=df.index, dtype=object)
+    return {
+        'cpu': pick('CPU', key='cpu'),
+        'mainboard': pick('Main', 'Mainboard', key='mainboard'),
+        'ram_gb': ram,
+        'ssd': pick('SSD', key='ssd'),
+        'hdd': pick('HDD', key='hdd'),
+        'vga': pick('VGA', key='vga'),
+        'wifi_card': _none_column(df),
+        'network_card': pick('Card mạng', 'Card Wi-Fi', key='network_card'),
+    }
+
+def _user_lookup_map():
+    """full name and username -> user id in one query (full name wins, lowest id on ties)."""
+    by_username, by_full_name = {}, {}
+    for user_id, username, full_name in db.session.query(User.id, User.username, User.full_name).order_by(User.id):
+        if username:
+            by_username.setdefault(username.strip(), user_id)
+        if full_name:
+            by_full_name.setdefault(full_name.strip(), user_id)
+    return {**by_username, **by_full_name}
+
+def _write_import_error_report(columns, chunks, row_errors, directory):
+    """Save the uploaded rows with a leading 'Lỗi' column (error rows highlighted); returns the file name.
+
+    `chunks` yields the rows again as DataFrames; `row_errors` maps a row's index to its messages.
+    """
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, PatternFill
+
+    filename = 'loi_nhap_lieu.xlsx'
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Lỗi nhập')
+    bold, error_fill = Font(bold=True), PatternFill('solid', fgColor='F8D7DA')
+    header = []
+    for name in ['Dòng', 'Lỗi', *[str(c) for c in columns]]:
+        cell = WriteOnlyCell(sheet, value=name)
+        cell.font = bold
+        header.append(cell)
+    sheet.append(header)
+    for df in chunks:
+        clean = df.astype(object).where(df.notna(), None)
+        for index, values in zip(df.index, clean.itertuples(index=False, name=None)):
+            messages = row_errors.get(index, [])
+            row = [index + 2, '; '.join(messages), *values]
+            if messages:
+                cells = []
+                for value in row:
+                    cell = WriteOnlyCell(sheet, value=value)
+                    cell.fill = error_fill
+                    cells.append(cell)
+                row = cells
+            sheet.append(row)
+    workbook.save(os.path.join(directory, filename))
+    return filename
+
+def _import_error_result(message, errors, artifact=None):
+    """Job result for a rejected import: a preview of the row errors plus the annotated file."""
+    return {
+        'failed': True,
+        'message': message,
+        'errors': errors[:IMPORT_ERROR_PREVIEW],
+        'error_total': len(errors),
+        'artifact': artifact,
+    }
+
+def _import_devices_job(job, reporter):
+    reporter.update(progress=5, message='Đang đọc file Excel...')
+    with ExcelChunks(job.input_path) as sheet:
+        required_columns = ['Mã thiết bị', 'Tên thiết bị', 'Loại thiết bị', 'Tình trạng', 'Trạng thái']
+        missing_columns = [col for col in required_columns if col not in sheet.columns]
+        if missing_columns:
+            return {'failed': True, 'message': f'File Excel thiếu cột bắt buộc: {", ".join(missing_columns)}.'}
+        reporter.update(progress=10, rows_total=sheet.rows_estimate, message='Đang kiểm tra và ghi dữ liệu...')
+
+        # Prefetch everything the validation needs: one query each
+        existing_codes = {code for (code,) in db.session.query(Device.device_code)}
+        valid_device_types = {name for (name,) in db.session.query(DeviceType.name)}
+        user_ids = _user_lookup_map()
+        seen_codes = set()
+        row_errors = {}
+        rows_done = 0
+
+        # Chunks are validated and written as they stream in; after the first error the rest is
+        # only validated, and the whole import is rolled back at the end.
+        for df in sheet:
+            chunk_errors = _validate_device_import_chunk(df, existing_codes, seen_codes, valid_device_types, user_ids)
+            row_errors.update(chunk_errors)
+            if not row_errors:
+                device_ids = _bulk_insert_rows(Device, _device_import_rows(df, user_ids))
+                _after_bulk_device_load(device_ids)
+            rows_done += len(df)
+            reporter.row(rows_done)
+
+    if row_errors:
+        db.session.rollback()
+        errors = [f'Dòng {i + 2}: {" ".join(messages)}' for i, messages in sorted(row_errors.items())]
+        reporter.update(progress=95, rows_total=rows_done, message='Đang tạo file lỗi...')
+        with ExcelChunks(job.input_path) as sheet:
+            artifact = _write_import_error_report(sheet.columns, sheet, row_errors, _job_dir(job.id))
+        return _import_error_result(
+            f'Có {len(errors)} dòng lỗi, chưa nhập thiết bị nào. Tải file lỗi để sửa và nhập lại.',
+            errors, artifact,
+        )
+    reporter.update(progress=100, rows_total=rows_done, rows_done=rows_done)
+    return {'message': 'Nhập thiết bị từ Excel thành công!', 'next': 'device_list'}
+
+def _validate_device_import_chunk(df, existing_codes, seen_codes, valid_device_types, user_ids):
+    """Column-wise checks for one chunk; returns {row index: [messages]} and records its codes in seen_codes."""
+    codes = _text_column(df, 'Mã thiết bị')
+    names = _text_column(df, 'Tên thiết bị')
+    device_types = _text_column(df, 'Loại thiết bị')
+    conditions = _text_column(df, 'Tình trạng')
+    statuses = _text_column(df, 'Trạng thái')
+    managers = _text_column(df, 'Người quản lý')
+    manager_ids = managers.map(user_ids)
+    purchase_dates, bad_purchase_date = _date_column(df, 'Ngày mua')
+    _, bad_assign_date = _date_column(df, 'Ngày cấp phát')
+
+    missing_required = (codes == '') | (names == '') | (device_types == '') | (conditions == '') | (statuses == '')
+    repeated = codes.duplicated(keep='first') | codes.isin(seen_codes)
+    checks = [
+        (missing_required, lambda i: 'Thiếu thông tin ở các cột bắt buộc.'),
+        (~missing_required & codes.isin(existing_codes), lambda i: f'Mã thiết bị {codes[i]} đã tồn tại.'),
+        (~missing_required & repeated, lambda i: f'Mã thiết bị {codes[i]} bị trùng trong file.'),
+        (~missing_required & ~device_types.isin(valid_device_types) if valid_device_types else pd.Series(False, index=df.index),
+         lambda i: f'Loại thiết bị "{device_types[i]}" không hợp lệ.'),
+        ((managers != '') & manager_ids.isna(), lambda i: f'Người quản lý {managers[i]} không tồn tại.'),
+        (bad_purchase_date | bad_assign_date, lambda i: 'Định dạng ngày không hợp lệ.'),
+        (~missing_required & ~bad_purchase_date & purchase_dates.isna(), lambda i: 'Thiếu ngày mua.'),
+    ]
+    seen_codes.update(codes[~missing_required])
+    row_errors = {}
+    for mask, message in checks:
+        for i in mask[mask].index:
+            row_errors.setdefault(i, []).append(message(i))
+    return row_errors
+
+def _device_import_rows(df, user_ids):
+    """Insert rows for a validated chunk."""
+    codes = _text_column(df, 'Mã thiết bị')
+    names = _text_column(df, 'Tên thiết bị')
+    device_types = _text_column(df, 'Loại thiết bị')
+    conditions = _text_column(df, 'Tình trạng')
+    statuses = _text_column(df, 'Trạng thái')
+    manager_ids = _text_column(df, 'Người quản lý').map(user_ids)
+    purchase_dates, _ = _date_column(df, 'Ngày mua')
+    assign_dates, _ = _date_column(df, 'Ngày cấp phát')
+    prices = _price_column(df, 'Giá mua')
+    pc_specs = _device_pc_spec_columns(df)
+    text = {field: _optional_text_column(df, column) for field, column in [
+        ('serial_number', 'Số serial'), ('configuration', 'Cấu hình'), ('notes', 'Ghi chú'),
+        ('buyer', 'Người mua'), ('brand', 'Thương hiệu'), ('supplier', 'Nhà cung cấp'), ('warranty', 'Bảo hành'),
+    ]}
+    rows = []
+    for i in df.index:
+        manager_id = manager_ids[i]
+        rows.append(dict(
+            device_code=codes[i],
+            name=names[i],
+            device_type=device_types[i],
+            purchase_date=purchase_dates[i],
+            import_date=purchase_dates[i],
+            condition=conditions[i],
+            status=statuses[i],
+            manager_id=None if pd.isna(manager_id) else int(manager_id),
+            assign_date=assign_dates[i],
+            purchase_price=prices[i],
+            **{field: column[i] for field, column in text.items()},
+            **{field: column[i] for field, column in pc_specs.items()},
+        ))
+    return rows
+
 @app.route('/import_devices', methods=['GET', 'POST'])
 def import_devices():
     if 'user_id' not in session: return redirect(url_for('login'))
@@ -5190,179 +7863,82 @@ def import_devices():
         if not file or not (file.filename.endswith('.xls') or file.filename.endswith('.xlsx')):
             flash('Vui lòng chọn một file Excel hợp lệ.', 'danger')
             return redirect(url_for('import_devices'))
-        
-        try:
-            df = pd.read_excel(file, engine='openpyxl')
-            required_columns = ['Mã thiết bị', 'Tên thiết bị', 'Loại thiết bị', 'Tình trạng', 'Trạng thái']
-            missing_columns = [col for col in required_columns if col not in df.columns]
-            if missing_columns:
-                flash(f'File Excel thiếu cột bắt buộc: {", ".join(missing_columns)}.', 'danger')
-                return redirect(url_for('import_devices'))
-            
-            valid_conditions = ['Mới', 'Sử dụng bình thường', 'Cần bảo trì', 'Hỏng']
-            valid_statuses = ['Sẵn sàng', 'Đã cấp phát', 'Bảo trì']
-            valid_device_types = {dt.name for dt in DeviceType.query.all()}
-            
-            devices_to_add = []
-            errors = []
-
-            for index, row in df.iterrows():
-                manager_id = None
-                device_code = _cell_text(row['Mã thiết bị'])
-                device_name = _cell_text(row['Tên thiết bị'])
-                device_type = _cell_text(row['Loại thiết bị'])
-                condition = _cell_text(row['Tình trạng'])
-                status = _cell_text(row['Trạng thái'])
-                
-                if not all([device_code, device_name, device_type, condition, status]):
-                    errors.append(f'Dòng {index+2}: Thiếu thông tin ở các cột bắt buộc.')
-                    continue
-                if Device.query.filter_by(device_code=device_code).first():
-                    errors.append(f'Dòng {index+2}: Mã thiết bị {device_code} đã tồn tại.')
-                    continue
-                if valid_device_types and device_type not in valid_device_types:
-                    errors.append(f'Dòng {index+2}: Loại thiết bị "{device_type}" không hợp lệ.')
-                    continue
-
-                manager_name = row.get('Người quản lý')
-                if pd.notna(manager_name) and manager_name:
-                    manager = User.query.filter_by(full_name=manager_name).first() or User.query.filter_by(username=str(manager_name).strip()).first()
-                    if not manager:
-                        errors.append(f'Dòng {index+2}: Người quản lý {manager_name} không tồn tại.')
-                        continue
-                    manager_id = manager.id
-                
-                try:
-                    purchase_date_val = row.get('Ngày mua')
-                    assign_date_val = row.get('Ngày cấp phát')
-                    purchase_date = pd.to_datetime(purchase_date_val).date() if pd.notna(purchase_date_val) else None
-                    assign_date = pd.to_datetime(assign_date_val).date() if pd.notna(assign_date_val) else None
-                except ValueError:
-                    errors.append(f'Dòng {index+2}: Định dạng ngày không hợp lệ.'); continue
-                
-                # Robust numeric parsing for purchase_price
-                raw_price = row.get('Giá mua')
-                price = None
-                try:
-                    if pd.notna(raw_price):
-                        if isinstance(raw_price, str):
-                            # Remove thousand separators and non-numeric symbols
-                            cleaned = raw_price.replace('.', '').replace(',', '').replace('₫', '').replace('đ', '').strip()
-                            price = float(cleaned) if cleaned else None
-                        else:
-                            price = float(raw_price)
-                except Exception:
-                    price = None
-
-                # Coerce text fields to str to avoid numeric miscasts in PG
-                def _s(v):
-                    if pd.isna(v):
-                        return None
-                    return str(v)
-
-                device = Device(
-                    device_code=device_code,
-                    name=device_name,
-                    device_type=device_type,
-                    serial_number=_s(row.get('Số serial')),
-                    purchase_date=purchase_date,
-                    import_date=purchase_date,
-                    condition=condition,
-                    status=status,
-                    manager_id=manager_id,
-                    assign_date=assign_date,
-                    configuration=_s(row.get('Cấu hình')),
-                    notes=_s(row.get('Ghi chú')),
-                    buyer=_s(row.get('Người mua')),
-                    brand=_s(row.get('Thương hiệu')),
-                    supplier=_s(row.get('Nhà cung cấp')),
-                    warranty=_s(row.get('Bảo hành')),
-                    purchase_price=price,
-                    **_device_pc_specs_from_row(row)
-                )
-                # Insert row-by-row to avoid large executemany translation issues on PG
-                db.session.add(device)
-            
-            if errors:
-                for error in errors:
-                    flash(error, 'danger')
-                db.session.rollback()
-            else:
-                db.session.commit()
-                flash('Nhập thiết bị từ Excel thành công!', 'success')
-                return redirect(url_for('device_list'))
-
-        except Exception as e:
-            db.session.rollback()
-            flash(f'Đã xảy ra lỗi không xác định khi xử lý file: {str(e)}', 'danger')
+        job = _enqueue_job('import_devices', upload=file)
+        return redirect(url_for('job_status', job_id=job.id))
             
     return render_template('import_devices.html')
 
 @app.route('/export_devices_excel')
 def export_devices_excel():
     if 'user_id' not in session: return redirect(url_for('login'))
-    devices = Device.query.order_by(Device.device_code).all()
-    data = []
-    for device in devices:
-        data.append({
-            'Mã thiết bị': device.device_code, 'Tên thiết bị': device.name, 'Loại thiết bị': device.device_type,
-            'Số serial': device.serial_number or '', 
-            'Ngày mua': device.purchase_date.strftime('%d-%m-%Y') if device.purchase_date else '',
-            'Giá mua': device.purchase_price,
-            'Người mua': device.buyer or '',
-            'Ngày nhập': device.import_date.strftime('%d-%m-%Y') if device.import_date else '', 'Tình trạng': device.condition,
-            'Trạng thái': device.status, 'Người quản lý': device.manager.full_name if device.manager else '',
-            'Ngày cấp phát': device.assign_date.strftime('%d-%m-%Y') if device.assign_date else '',
-            'Cấu hình': device.configuration or '', 'Ghi chú': device.notes or '',
-            'CPU': device.cpu or '', 'Main': device.mainboard or '', 'RAM (GB)': device.ram_gb or '', 'SSD': device.ssd or '',
-            'HDD': device.hdd or '', 'VGA': device.vga or '',
-            'Card mạng': device.network_card or device.wifi_card or '',
-            'Người nhập': device.importer or '', 'Thương hiệu': device.brand or '', 'Nhà cung cấp': device.supplier or '',
-            'Bảo hành': device.warranty or ''
-        })
-    df = pd.DataFrame(data)
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Devices')
-    output.seek(0)
-    return send_file(output, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', as_attachment=True, download_name=f'devices_list_{datetime.now(VIETNAM_TZ).strftime("%Y%m%d")}.xlsx')
+    return _stream_export('devices')
+
+def _load_principal(user_id):
+    """Load user and RBAC version in one query; permissions come from the process cache."""
+    row = (
+        db.session.query(User, CacheVersion.version)
+        .outerjoin(CacheVersion, CacheVersion.name == RBAC_CACHE_KEY)
+        .filter(User.id == user_id)
+        .first()
+    )
+    if not row:
+        return None
+    user, version = row
+    _rbac_cache_sync(version or 0)
+    with _rbac_cache_lock:
+        is_admin_role, perm_codes = _cached_user_permissions(user.id)
+        # Admin always has full permissions
+        if user.role == 'admin':
+            perm_codes = _cached_all_permissions()
+    return {
+        'user_id': user.id,
+        'user': user,
+        'permissions': perm_codes,
+        'is_admin': (user.role or '').lower() == 'admin' or is_admin_role,
+        'managed_department_ids': None,
+    }
+
+def _current_principal():
+    """Request-scoped principal of the logged in user, built once per request (or None)."""
+    user_id = session.get('user_id')
+    if not user_id:
+        return None
+    principal = g.get('_principal')
+    if principal is None or principal['user_id'] != user_id:
+        principal = _load_principal(user_id)
+        g._principal = principal
+    return principal
+
+def _principal_for(user=None):
+    """Return the request principal when `user` is the current user (or omitted)."""
+    try:
+        principal = _current_principal()
+    except Exception:
+        return None
+    if principal is None:
+        return None
+    if user is None or getattr(user, 'id', None) == principal['user_id']:
+        return principal
+    return None
 
 @app.route('/download/maintenance/<int:log_id>/<path:filename>')
 def _get_current_permissions():
     """Utility: return a set of permission codes for the current user."""
-    try:
-        if 'user_id' not in session:
-            return set()
-        user = User.query.get(session['user_id'])
-        # Admin always has full permissions
-        if user and user.role == 'admin':
-            return {p.code for p in Permission.query.all()}
-        role_ids = [ur.role_id for ur in UserRole.query.filter_by(user_id=user.id).all()] if user else []
-        perm_codes = set()
-        if role_ids:
-            for rp in RolePermission.query.filter(RolePermission.role_id.in_(role_ids)).all():
-                perm = Permission.query.get(rp.permission_id)
-                if perm:
-                    perm_codes.add(perm.code)
-        return perm_codes
-    except Exception:
-        return set()
+    principal = _principal_for()
+    return set(principal['permissions']) if principal else set()
 
 def _get_current_user():
     """Return currently logged in user object (or None)."""
-    try:
-        if 'user_id' not in session:
-            return None
-        return User.query.get(session['user_id'])
-    except Exception:
-        return None
+    principal = _principal_for()
+    return principal['user'] if principal else None
 
 def _is_admin_user(user=None):
     """Return True for legacy admin users or users assigned to the Admin role."""
     try:
+        principal = _principal_for(user)
+        if principal is not None:
+            return principal['is_admin']
         if user is None:
-            user = _get_current_user()
-        if not user:
             return False
         if (user.role or '').lower() == 'admin':
             return True
@@ -5373,23 +7949,52 @@ def _is_admin_user(user=None):
     except Exception:
         return False
 
+def _compute_managed_department_ids(user_id):
+    rows = (
+        db.session.query(DepartmentClosure.descendant_id)
+        .join(Department, Department.id == DepartmentClosure.ancestor_id)
+        .filter(Department.manager_id == user_id)
+        .distinct()
+        .all()
+    )
+    return sorted(row[0] for row in rows)
+
 def _managed_department_ids(user=None):
     """Departments directly managed by user, including nested child departments."""
     try:
-        if user is None:
-            user = _get_current_user()
+        principal = _principal_for(user)
+        if principal is not None:
+            if principal['managed_department_ids'] is None:
+                principal['managed_department_ids'] = _compute_managed_department_ids(principal['user_id'])
+            return list(principal['managed_department_ids'])
         if not user:
             return []
-        ids = []
-        for dept in Department.query.filter_by(manager_id=user.id).all():
-            ids.extend(get_subordinate_department_ids(dept.id))
-        return sorted(set(ids))
+        return _compute_managed_department_ids(user.id)
     except Exception:
         return []
 
 def _is_manager_user(user=None):
     return bool(_managed_department_ids(user))
 
+def _visible_user_condition(user):
+    """SQL condition on User rows visible to a non-admin user: self plus managed departments."""
+    managed_depts = (
+        select(DepartmentClosure.descendant_id)
+        .join(Department, Department.id == DepartmentClosure.ancestor_id)
+        .where(Department.manager_id == user.id)
+    )
+    return or_(User.id == user.id, User.department_id.in_(managed_depts))
+
+def _visible_user_ids_select(user=None):
+    """SELECT of visible user ids for use in IN/EXISTS filters; None means unrestricted (admin)."""
+    if user is None:
+        user = _get_current_user()
+    if _is_admin_user(user):
+        return None
+    if not user:
+        return select(User.id).where(False)
+    return select(User.id).where(_visible_user_condition(user))
+
 def _visible_user_ids_for(user=None):
     """Admin: all users. Manager: users in managed departments. User: self only."""
     try:
@@ -5397,33 +8002,37 @@ def _visible_user_ids_for(user=None):
             user = _get_current_user()
         if not user:
             return []
-        if _is_admin_user(user):
+        visible = _visible_user_ids_select(user)
+        if visible is None:
             return [row[0] for row in db.session.query(User.id).all()]
-        dept_ids = _managed_department_ids(user)
-        if dept_ids:
-            ids = [row[0] for row in db.session.query(User.id).filter(User.department_id.in_(dept_ids)).all()]
-            ids.append(user.id)
-            return sorted(set(ids))
-        return [user.id]
+        return sorted(row[0] for row in db.session.execute(visible).all())
     except Exception:
         return [user.id] if user else []
 
 def _visible_users_query_for(user=None):
     if user is None:
         user = _get_current_user()
-    ids = _visible_user_ids_for(user)
-    return User.query.filter(User.id.in_(ids)).order_by(func.lower(User.last_name_token), func.lower(User.full_name), func.lower(User.username))
+    query = User.query
+    if not _is_admin_user(user):
+        query = query.filter(_visible_user_condition(user)) if user else query.filter(False)
+    return query.order_by(User.sort_key, User.id)
 
 def _visible_devices_query_for(user=None):
-    if user is None:
-        user = _get_current_user()
-    if _is_admin_user(user):
+    visible = _visible_user_ids_select(user)
+    if visible is None:
         return Device.query
-    return Device.query.filter(Device.manager_id.in_(_visible_user_ids_for(user)))
+    return Device.query.filter(Device.manager_id.in_(visible))
 
 def _can_access_user(target_user_id, user=None):
     try:
-        return int(target_user_id) in set(_visible_user_ids_for(user))
+        target_user_id = int(target_user_id)
+        if user is None:
+            user = _get_current_user()
+        if not user:
+            return False
+        if _is_admin_user(user):
+            return db.session.query(exists().where(User.id == target_user_id)).scalar()
+        return db.session.query(exists().where(User.id == target_user_id, _visible_user_condition(user))).scalar()
     except Exception:
         return False
 
@@ -5439,13 +8048,13 @@ def _managed_department_names(user=None):
 def _apply_config_proposal_scope(query, user=None):
     if user is None:
         user = _get_current_user()
-    if _is_admin_user(user):
+    visible = _visible_user_ids_select(user)
+    if visible is None:
         return query
-    visible_user_ids = _visible_user_ids_for(user)
     own_names = [user.full_name, user.username] if user else []
     own_names = [name for name in own_names if name]
     dept_names = _managed_department_names(user)
-    conditions = [ConfigProposal.created_by.in_(visible_user_ids)]
+    conditions = [ConfigProposal.created_by.in_(visible)]
     if own_names:
         conditions.append(ConfigProposal.proposer_name.in_(own_names))
     if dept_names:
@@ -5459,19 +8068,17 @@ def _can_access_config_proposal(proposal, user=None):
         return False
     if _is_admin_user(user):
         return True
-    if proposal.created_by in _visible_user_ids_for(user):
-        return True
     if proposal.proposer_name in [user.full_name, user.username]:
         return True
+    if proposal.created_by and _can_access_user(proposal.created_by, user):
+        return True
     return bool(proposal.proposer_unit and proposal.proposer_unit in _managed_department_names(user))
 
 def _apply_bug_report_scope(query, user=None):
-    if user is None:
-        user = _get_current_user()
-    if _is_admin_user(user):
+    visible = _visible_user_ids_select(user)
+    if visible is None:
         return query
-    visible_user_ids = _visible_user_ids_for(user)
-    return query.filter(or_(BugReport.created_by.in_(visible_user_ids), BugReport.assigned_to.in_(visible_user_ids)))
+    return query.filter(or_(BugReport.created_by.in_(visible), BugReport.assigned_to.in_(visible)))
 
 def _can_access_bug_report(report, user=None):
     if user is None:
@@ -5480,8 +8087,10 @@ def _can_access_bug_report(report, user=None):
         return False
     if _is_admin_user(user):
         return True
-    visible_user_ids = set(_visible_user_ids_for(user))
-    return report.created_by in visible_user_ids or report.assigned_to in visible_user_ids
+    related_ids = [uid for uid in (report.created_by, report.assigned_to) if uid]
+    if not related_ids:
+        return False
+    return db.session.query(exists().where(User.id.in_(related_ids), _visible_user_condition(user))).scalar()
 
 def _has_dashboard_access(current_permissions=None, current_user=None):
     """Check if current user can access dashboard."""
@@ -5516,23 +8125,230 @@ def _to_vietnam_time(dt):
     except Exception:
         return dt
 
-def _normalize_excel_columns(df, aliases):
-    """Rename known Excel column aliases to canonical import names."""
+def _excel_column_renames(columns, aliases):
     rename_map = {}
     for canonical, alternatives in aliases.items():
-        if canonical in df.columns:
+        if canonical in columns:
             continue
         for alternative in alternatives:
-            if alternative in df.columns:
+            if alternative in columns:
                 rename_map[alternative] = canonical
                 break
-    return df.rename(columns=rename_map)
+    return rename_map
+
+def _normalize_excel_columns(df, aliases):
+    """Rename known Excel column aliases to canonical import names."""
+    return df.rename(columns=_excel_column_renames(list(df.columns), aliases))
 
 def _cell_text(value):
     if pd.isna(value):
         return ''
     return str(value).strip()
 
+# --- Streaming Excel reader ---
+IMPORT_CHUNK_ROWS = int(os.environ.get('INVENTORY_IMPORT_CHUNK_ROWS', '2000'))
+
+def _excel_cell_value(value):
+    # Same coercions pandas' openpyxl reader applies: blanks -> None, 15.0 -> 15
+    if value is None or (isinstance(value, str) and value == ''):
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+class ExcelChunks:
+    """Streams the first sheet of an .xlsx as DataFrames of at most chunk_size rows.
+
+    The workbook is opened read-only, so memory is bounded by the chunk size rather than
+    the file. Header aliases are normalized like _normalize_excel_columns, fully empty
+    rows are skipped, and each chunk is indexed by sheet row - 2 so `index + 2` still
+    names the Excel row in error messages.
+    """
+
+    def __init__(self, source, aliases=None, chunk_size=None):
+        from openpyxl import load_workbook
+
+        self.chunk_size = chunk_size or IMPORT_CHUNK_ROWS
+        self._workbook = load_workbook(source, read_only=True, data_only=True)
+        sheet = self._workbook.worksheets[0]
+        # Dimensions recorded in the file are only an estimate (formatting inflates them)
+        self.rows_estimate = max((sheet.max_row or 1) - 1, 0)
+        sheet.reset_dimensions()
+        self._rows = sheet.iter_rows(values_only=True)
+        header = next(self._rows, None) or ()
+        columns, seen = [], {}
+        for position, name in enumerate(header):
+            name = f'Unnamed: {position}' if name is None else name
+            if name in seen:
+                seen[name] += 1
+                name = f'{name}.{seen[name]}'
+            else:
+                seen[name] = 0
+            columns.append(name)
+        renames = _excel_column_renames(columns, aliases or {})
+        self.columns = [renames.get(name, name) for name in columns]
+
+    def __iter__(self):
+        width = len(self.columns)
+        rows, index = [], []
+        try:
+            for sheet_row, values in enumerate(self._rows, start=2):
+                values = [_excel_cell_value(v) for v in values[:width]]
+                if not any(v is not None for v in values):
+                    continue
+                values.extend([None] * (width - len(values)))
+                rows.append(values)
+                index.append(sheet_row - 2)
+                if len(rows) >= self.chunk_size:
+                    yield pd.DataFrame(rows, columns=self.columns, index=index)
+                    rows, index = [], []
+            if rows:
+                yield pd.DataFrame(rows, columns=self.columns, index=index)
+        finally:
+            self.close()
+
+    def close(self):
+        self._workbook.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# --- Keyset pagination ---
+KEYSET_TOTAL_CAP = 1000
+
+class KeysetPagination:
+    """One page of a keyset (seek) listing; exposes the attributes _pagination.html reads."""
+    keyset = True
+    page = None
+
+    def __init__(self, items, per_page, next_cursor=None, prev_cursor=None, total=None, total_capped=False, first=1):
+        self.items = items
+        self.per_page = per_page
+        self.first = first
+        self.last = first + len(items) - 1
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.has_next = next_cursor is not None
+        self.has_prev = prev_cursor is not None
+        self.total = total
+        self.total_capped = total_capped
+
+def _encode_cursor(values, position):
+    """Encode sort-key values (and 1-based position) of a row into an opaque URL-safe token."""
+    keys = []
+    for value in values:
+        if isinstance(value, datetime):
+            keys.append({'dt': value.isoformat()})
+        elif isinstance(value, date):
+            keys.append({'d': value.isoformat()})
+        else:
+            keys.append(value)
+    raw = json.dumps({'k': keys, 'n': position}, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def _decode_cursor(token):
+    """Decode a token from _encode_cursor into (values, position); raises ValueError when malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        payload = json.loads(raw.decode('utf-8'))
+        values = []
+        for value in payload['k']:
+            if isinstance(value, dict) and 'dt' in value:
+                values.append(datetime.fromisoformat(value['dt']))
+            elif isinstance(value, dict) and 'd' in value:
+                values.append(date.fromisoformat(value['d']))
+            else:
+                values.append(value)
+        return values, max(1, int(payload.get('n') or 1))
+    except Exception as exc:
+        raise ValueError('invalid cursor') from exc
+
+def _keyset_condition(order_keys, values, backwards=False):
+    """Rows strictly after `values` in (expr, descending) order; reversed when backwards."""
+    clauses = []
+    for index, (expr, descending) in enumerate(order_keys):
+        seek_lower = descending != backwards
+        step = expr < values[index] if seek_lower else expr > values[index]
+        equal_prefix = [order_keys[j][0] == values[j] for j in range(index)]
+        clauses.append(db.and_(*equal_prefix, step) if equal_prefix else step)
+    return or_(*clauses)
+
+def _approximate_count(query, cap=KEYSET_TOTAL_CAP):
+    """Count rows up to `cap`; returns (count, capped)."""
+    limited = query.order_by(None).limit(cap + 1).subquery()
+    total = db.session.query(func.count()).select_from(limited).scalar() or 0
+    return min(total, cap), total > cap
+
+def _keyset_paginate(query, order_keys, per_page, after=None, before=None, with_total=False):
+    """Seek pagination over `order_keys` [(expression, descending), ...] ending with a unique key.
+
+    Sort keys must be NOT NULL; the page is fetched with LIMIT per_page + 1 and no OFFSET.
+    """
+    exprs = [expr for expr, _ in order_keys]
+    backwards = bool(before)
+    cursor_values, cursor_position = None, 0
+    try:
+        if before or after:
+            cursor_values, cursor_position = _decode_cursor(before or after)
+            if len(cursor_values) != len(order_keys):
+                raise ValueError('invalid cursor')
+    except ValueError:
+        cursor_values, backwards = None, False
+
+    page_query = query.add_columns(*exprs).order_by(None)
+    if cursor_values is not None:
+        page_query = page_query.filter(_keyset_condition(order_keys, cursor_values, backwards))
+    page_query = page_query.order_by(*[
+        expr.desc() if descending != backwards else expr.asc() for expr, descending in order_keys
+    ])
+    rows = page_query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+        if not rows:
+            return _keyset_paginate(query, order_keys, per_page, with_total=with_total)
+
+    items = [row[0] for row in rows]
+    if cursor_values is None:
+        first = 1
+    elif backwards:
+        first = max(1, cursor_position - len(rows)) if has_more else 1
+    else:
+        first = cursor_position + 1
+    last = first + len(rows) - 1
+    first_key = tuple(rows[0][1:]) if rows else None
+    last_key = tuple(rows[-1][1:]) if rows else None
+    if backwards:
+        next_cursor = _encode_cursor(last_key, last)
+        prev_cursor = _encode_cursor(first_key, first) if has_more else None
+    else:
+        next_cursor = _encode_cursor(last_key, last) if has_more else None
+        prev_cursor = _encode_cursor(first_key, first) if cursor_values is not None and rows else None
+
+    total, capped = (None, False)
+    if with_total:
+        total, capped = _approximate_count(query)
+    return KeysetPagination(items, per_page, next_cursor, prev_cursor, total, capped, first=first)
+
+def _paginate_list(query, order_keys, page, per_page):
+    """Offset pagination by default; keyset mode when the request carries after=/before=."""
+    if 'after' in request.args or 'before' in request.args:
+        return _keyset_paginate(
+            query, order_keys, per_page,
+            after=request.args.get('after') or None,
+            before=request.args.get('before') or None,
+            with_total=request.args.get('total') == '1',
+        )
+    ordering = [expr.desc() if descending else expr.asc() for expr, descending in order_keys]
+    pagination = query.order_by(*ordering).paginate(page=page, per_page=per_page, error_out=False)
+    pagination.keyset = False
+    pagination.keyset_available = True
+    return pagination
+
 def download_maintenance_file(log_id, filename):
     if 'user_id' not in session: return redirect(url_for('login'))
     if 'maintenance.download' not in _get_current_permissions():
@@ -5541,44 +8357,100 @@ def download_maintenance_file(log_id, filename):
     directory = os.path.join(instance_path, 'maintenance_attachments', str(log_id))
     return send_from_directory(directory, filename, as_attachment=True)
 
-@app.route('/import_users', methods=['GET', 'POST'])
-def import_users():
-    if 'user_id' not in session: return redirect(url_for('login'))
-    
-    if request.method == 'POST':
-        file = request.files.get('file')
-        if not file or not (file.filename.endswith('.xls') or file.filename.endswith('.xlsx')):
-            flash('Vui lòng chọn một file Excel hợp lệ (.xls, .xlsx).', 'danger')
-            return redirect(url_for('import_users'))
-        
+# --- Password hashing pool ---
+# generate_password_hash is deliberately CPU-heavy; bulk user creation spreads it over a process
+# pool sized to the usable cores (INVENTORY_HASH_WORKERS overrides, 1 disables the pool).
+PASSWORD_HASH_MIN_BATCH = 8
+
+def _password_hash_workers():
+    configured = os.environ.get('INVENTORY_HASH_WORKERS')
+    if configured:
         try:
-            df = pd.read_excel(file, engine='openpyxl')
-            required_columns = ['Tên đăng nhập', 'Họ và tên', 'Email', 'Vai trò']
-            if not all(col in df.columns for col in required_columns):
-                flash(f'File Excel phải chứa các cột bắt buộc: {", ".join(required_columns)}.', 'danger')
-                return redirect(url_for('import_users'))
+            return max(1, int(configured))
+        except ValueError:
+            pass
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
 
-            errors = []
+@contextmanager
+def _password_hasher():
+    """Yield hash_many(passwords) -> hashes in the same order, backed by a process pool when useful."""
+    workers = _password_hash_workers()
+    pool = None
+    if workers > 1:
+        try:
+            # Never fork this multithreaded web process (job and Telegram threads hold locks)
+            try:
+                context = multiprocessing.get_context('forkserver')
+            except ValueError:
+                context = multiprocessing.get_context('spawn')
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        except (OSError, NotImplementedError) as e:
+            print(f"Password hash pool unavailable, hashing serially: {e}")
+
+    def hash_many(passwords):
+        passwords = list(passwords)
+        if pool is None or len(passwords) < PASSWORD_HASH_MIN_BATCH:
+            return [generate_password_hash(password) for password in passwords]
+        chunksize = max(1, len(passwords) // (workers * 4))
+        return list(pool.map(generate_password_hash, passwords, chunksize=chunksize))
+
+    try:
+        yield hash_many
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+def _write_generated_passwords(rows, directory):
+    """Save (username, full name, email, password) rows for the admin to hand out; returns the file name."""
+    from openpyxl import Workbook
+
+    filename = GENERATED_PASSWORDS_FILE
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Mật khẩu')
+    sheet.append(['Tên đăng nhập', 'Họ và tên', 'Email', 'Mật khẩu'])
+    for row in rows:
+        sheet.append(list(row))
+    workbook.save(os.path.join(directory, filename))
+    return filename
+
+def _import_users_job(job, reporter):
+    from security import generate_secure_password
+
+    reporter.update(progress=5, message='Đang đọc file Excel...')
+    generate_passwords = bool(_job_params(job).get('generate_passwords'))
+    sheet = ExcelChunks(job.input_path)
+    required_columns = ['Tên đăng nhập', 'Họ và tên', 'Email', 'Vai trò']
+    if not all(col in sheet.columns for col in required_columns):
+        sheet.close()
+        return {'failed': True, 'message': f'File Excel phải chứa các cột bắt buộc: {", ".join(required_columns)}.'}
+
+    errors = []
+    generated = []  # (username, full name, email, password) for the export
+    imported = 0
+    rows_done = 0
+    reporter.update(progress=10, rows_total=sheet.rows_estimate, message='Đang kiểm tra dữ liệu...')
+
+    with _password_hasher() as hash_many:
+        for df in sheet:
             users_to_add = []
-            
             for index, row in df.iterrows():
                 username = _cell_text(row['Tên đăng nhập'])
-                password = _cell_text(row.get('Mật khẩu'))
+                password = '' if generate_passwords else _cell_text(row.get('Mật khẩu'))
                 email = _cell_text(row['Email'])
 
                 if not username or not email:
                     errors.append(f'Dòng {index + 2}: Tên đăng nhập và Email không được để trống.')
                     continue
-                if not password:
-                    from security import generate_secure_password
-                    password = generate_secure_password()
                 if User.query.filter_by(username=username).first():
                     errors.append(f'Dòng {index + 2}: Tên đăng nhập "{username}" đã tồn tại.')
                     continue
                 if User.query.filter_by(email=email).first():
                     errors.append(f'Dòng {index + 2}: Email "{email}" đã tồn tại.')
                     continue
-                
+
                 onboard_date_val = row.get('Ngày Onboard')
                 offboard_date_val = row.get('Ngày Offboard')
 
@@ -5587,72 +8459,72 @@ def import_users():
                 if pd.notna(dept_name) and str(dept_name).strip() != '':
                     dept = Department.query.filter_by(name=str(dept_name).strip()).first()
 
-                new_user = User(
+                full_name = _cell_text(row.get('Họ và tên')) or None
+                if not password:
+                    password = generate_secure_password()
+                    generated.append((username, full_name, email, password))
+                new_user = dict(
                     username=username,
-                    password=generate_password_hash(password),
-                    full_name=row.get('Họ và tên'),
+                    password=password,  # plain text until the chunk is hashed below
+                    full_name=full_name,
                     email=email,
-                    role=row.get('Vai trò', 'user'),
+                    role=_cell_text(row.get('Vai trò')) or 'user',
                     department_id=(dept.id if dept else None),
-                    position=row.get('Chức vụ'),
+                    position=_cell_text(row.get('Chức vụ')) or None,
                     phone_number=str(row.get('SĐT', '')) if pd.notna(row.get('SĐT')) else None,
-                    notes=row.get('Ghi chú'),
-                    status=row.get('Trạng thái', 'Đang làm'),
+                    notes=_cell_text(row.get('Ghi chú')) or None,
+                    status=_cell_text(row.get('Trạng thái')) or 'Đang làm',
                     onboard_date=pd.to_datetime(onboard_date_val).date() if pd.notna(onboard_date_val) else None,
-                    offboard_date=pd.to_datetime(offboard_date_val).date() if pd.notna(offboard_date_val) else None
+                    offboard_date=pd.to_datetime(offboard_date_val).date() if pd.notna(offboard_date_val) else None,
+                    last_name_token=(full_name.split()[-1].lower() if full_name else None),
                 )
-                if new_user.full_name:
-                    try:
-                        new_user.last_name_token = (str(new_user.full_name).strip().split()[-1] or '').lower()
-                    except Exception:
-                        new_user.last_name_token = None
                 users_to_add.append(new_user)
 
-            if errors:
-                for error in errors:
-                    flash(error, 'danger')
-            else:
-                db.session.add_all(users_to_add)
-                db.session.commit()
-                flash(f'Đã nhập thành công {len(users_to_add)} người dùng mới!', 'success')
-                return redirect(url_for('user_list'))
+            # Hash and write each clean chunk in one batch; once a row fails nothing is hashed
+            # any more and everything is rolled back below.
+            if not errors and users_to_add:
+                reporter.update(message='Đang mã hóa mật khẩu...', force=False)
+                for new_user, hashed in zip(users_to_add, hash_many(u['password'] for u in users_to_add)):
+                    new_user['password'] = hashed
+                _bulk_insert_rows(User, users_to_add)
+                imported += len(users_to_add)
+            rows_done += len(df)
+            reporter.row(rows_done)
+
+    if errors:
+        db.session.rollback()
+        return _import_error_result(f'Có {len(errors)} dòng lỗi, chưa nhập người dùng nào.', errors)
+    _invalidate_filter_options('users')
+    result = {'message': f'Đã nhập thành công {imported} người dùng mới!', 'next': 'user_list'}
+    if generated:
+        result['message'] += f' Đã tạo mật khẩu ngẫu nhiên cho {len(generated)} người dùng.'
+        result['message'] += ' Danh sách mật khẩu chỉ tải được một lần.'
+        result['downloads'] = [(GENERATED_PASSWORDS_FILE, 'Tải danh sách mật khẩu')]
+        # Written once the users are committed, so a superseded run cannot publish passwords
+        directory = _job_dir(job.id)
+        result['after_commit'] = lambda: _write_generated_passwords(generated, directory)
+    return result
 
-        except Exception as e:
-            db.session.rollback()
-            flash(f'Đã xảy ra lỗi trong quá trình xử lý file: {str(e)}', 'danger')
+@app.route('/import_users', methods=['GET', 'POST'])
+def import_users():
+    if 'user_id' not in session: return redirect(url_for('login'))
+    
+    if request.method == 'POST':
+        file = request.files.get('file')
+        if not file or not (file.filename.endswith('.xls') or file.filename.endswith('.xlsx')):
+            flash('Vui lòng chọn một file Excel hợp lệ (.xls, .xlsx).', 'danger')
+            return redirect(url_for('import_users'))
+        job = _enqueue_job('import_users', upload=file, params={
+            'generate_passwords': request.form.get('generate_passwords') == '1',
+        })
+        return redirect(url_for('job_status', job_id=job.id))
 
     return render_template('import_users.html')
 
 @app.route('/export_users_excel')
 def export_users_excel():
     if 'user_id' not in session: return redirect(url_for('login'))
-    users = User.query.order_by(func.lower(User.last_name_token), func.lower(User.full_name), func.lower(User.username)).all()
-    data = []
-    for user in users:
-        created_at_local = _to_vietnam_time(user.created_at)
-        last_login_local = _to_vietnam_time(user.last_login)
-        data.append({
-            'ID': user.id,
-            'Tên đăng nhập': user.username,
-            'Mật khẩu': '',
-            'Họ và tên': user.full_name,
-            'Email': user.email,
-            'Phòng ban': user.department_info.name if user.department_info else None,
-            'Chức vụ': user.position,
-            'Trạng thái': user.status,
-            'Ngày Onboard': user.onboard_date.strftime('%d-%m-%Y') if user.onboard_date else '',
-            'Ngày Offboard': user.offboard_date.strftime('%d-%m-%Y') if user.offboard_date else '',
-            'SĐT': user.phone_number,
-            'Ngày sinh': user.date_of_birth.strftime('%d-%m-%Y') if user.date_of_birth else '',
-            'Vai trò': user.role,
-            'Ngày tạo': created_at_local.strftime('%d-%m-%Y %H:%M:%S') if created_at_local else '',
-            'Đăng nhập lần cuối': last_login_local.strftime('%d-%m-%Y %H:%M:%S') if last_login_local else ''
-        })
-    df = pd.DataFrame(data)
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer: df.to_excel(writer, index=False, sheet_name='Users')
-    output.seek(0)
-    return send_file(output, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', as_attachment=True, download_name=f'users_list_{datetime.now(VIETNAM_TZ).strftime("%Y%m%d")}.xlsx')
+    return _stream_export('users')
 
 @app.route('/maintenance_logs')
 def maintenance_logs():
@@ -5697,9 +8569,9 @@ def maintenance_logs():
         except ValueError:
             pass
 
-    logs = query.order_by(DeviceMaintenanceLog.log_date.desc(), DeviceMaintenanceLog.id.desc()).paginate(page=page, per_page=per_page, error_out=False)
+    logs = _paginate_list(query, [(DeviceMaintenanceLog.log_date, True), (DeviceMaintenanceLog.id, True)], page, per_page)
 
-    device_types = sorted([item[0] for item in db.session.query(Device.device_type).distinct().all()])
+    device_types = _device_type_options()
     return render_template(
         'maintenance_logs/list.html',
         logs=logs,
@@ -5959,25 +8831,19 @@ def bug_reports():
     if device_code_filter:
         q = q.filter(BugReport.device_code.ilike(f'%{device_code_filter}%'))
     
-    reports = q.order_by(BugReport.created_at.desc()).paginate(page=page, per_page=per_page, error_out=False)
+    # created_at is nullable, so it cannot be a seek key; ids follow creation order anyway
+    reports = _paginate_list(q, [(BugReport.id, True)], page, per_page)
     
-    visible_user_ids = _visible_user_ids_for(current_user)
-    creator_ids = [
-        row[0] for row in _apply_bug_report_scope(
-            db.session.query(BugReport.created_by).filter(BugReport.created_by != None),
-            current_user
-        ).distinct().all()
-    ]
-    assignee_ids = [
-        row[0] for row in _apply_bug_report_scope(
-            db.session.query(BugReport.assigned_to).filter(BugReport.assigned_to != None),
-            current_user
-        ).distinct().all()
-    ]
-    creator_ids = [uid for uid in creator_ids if uid in visible_user_ids]
-    assignee_ids = [uid for uid in assignee_ids if uid in visible_user_ids]
-    creators = User.query.filter(User.id.in_(creator_ids)).order_by(func.lower(User.last_name_token), func.lower(User.full_name), func.lower(User.username)).all() if creator_ids else []
-    assignees = User.query.filter(User.id.in_(assignee_ids)).order_by(func.lower(User.last_name_token), func.lower(User.full_name), func.lower(User.username)).all() if assignee_ids else []
+    creator_ids = _apply_bug_report_scope(
+        db.session.query(BugReport.created_by).filter(BugReport.created_by != None),
+        current_user
+    ).distinct()
+    assignee_ids = _apply_bug_report_scope(
+        db.session.query(BugReport.assigned_to).filter(BugReport.assigned_to != None),
+        current_user
+    ).distinct()
+    creators = _visible_users_query_for(current_user).filter(User.id.in_(creator_ids.scalar_subquery())).all()
+    assignees = _visible_users_query_for(current_user).filter(User.id.in_(assignee_ids.scalar_subquery())).all()
 
     # Get list of distinct device codes in reports (simple parsing or just rough list)
     # Since device_code is text and can be comma separated, getting distinct values is tricky. 
@@ -6128,11 +8994,10 @@ def create_bug_report():
                             file_path=dest
                         ))
             
-            db.session.commit()
-            
             # Notifications
             notify_user(created_by_id, f"Báo lỗi '{title}' đã được tạo thành công.", url_for('bug_report_detail', report_id=bug_report.id, _external=True))
             notify_group(f"Báo lỗi mới: '{title}'", url_for('bug_report_detail', report_id=bug_report.id, _external=True))
+            db.session.commit()
 
             flash('Đã tạo báo lỗi thành công! Quản trị viên sẽ xem xét và xử lý.', 'success')
             return redirect(url_for('bug_report_detail', report_id=bug_report.id))
@@ -6367,10 +9232,10 @@ def update_bug_report(report_id):
             bug_report.resolution = resolution
  
         bug_report.updated_at = datetime.utcnow()
-        db.session.commit()
         if status in ['Đã xử lý', 'Đã đóng']:
             notify_user(bug_report.created_by, f"Báo lỗi '{bug_report.title}' của bạn đã chuyển sang trạng thái: {status}", url_for('bug_report_detail', report_id=bug_report.id, _external=True))
             notify_group(f"Báo lỗi '{bug_report.title}' đã chuyển sang trạng thái: {status}.", url_for('bug_report_detail', report_id=bug_report.id, _external=True))
+        db.session.commit()
         flash('Đã cập nhật báo lỗi thành công.', 'success')
     except Exception as e:
         db.session.rollback()
@@ -6565,29 +9430,7 @@ def delete_bug_report(report_id):
 @app.route('/export_handovers_excel')
 def export_handovers_excel():
     if 'user_id' not in session: return redirect(url_for('login'))
-    handovers = DeviceHandover.query.order_by(DeviceHandover.handover_date.desc()).all()
-    data = []
-    for handover in handovers:
-        data.append({
-            'Mã thiết bị': handover.device.device_code if handover.device else '',
-            'Tên đăng nhập người giao': handover.giver.username if handover.giver else '',
-            'Tên đăng nhập người nhận': handover.receiver.username if handover.receiver else '',
-            'Ngày bàn giao': handover.handover_date.strftime('%d-%m-%Y') if handover.handover_date else '',
-            'Tình trạng thiết bị': handover.device_condition,
-            'Lý do bàn giao': handover.reason,
-            'Nơi đặt thiết bị': handover.location,
-            'Ghi chú': handover.notes,
-            'Tên thiết bị': handover.device.name if handover.device else '',
-            'Loại thiết bị': handover.device.device_type if handover.device else '',
-            'Người giao': handover.giver.full_name if handover.giver else '',
-            'Người nhận': handover.receiver.full_name if handover.receiver else '',
-            'Phòng ban người nhận': (handover.receiver.department_info.name if handover.receiver and handover.receiver.department_info else '')
-        })
-    df = pd.DataFrame(data)
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer: df.to_excel(writer, index=False, sheet_name='Handovers')
-    output.seek(0)
-    return send_file(output, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', as_attachment=True, download_name=f'handover_history_{datetime.now(VIETNAM_TZ).strftime("%Y%m%d")}.xlsx')
+    return _stream_export('handovers')
 
 # --- Configuration Proposal Routes ---
 @app.route('/config_proposals')
@@ -6629,10 +9472,19 @@ def config_proposals():
     proposals_pagination = q.order_by(ConfigProposal.id.desc()).paginate(page=page, per_page=per_page, error_out=False)
 
     # Fetch distinct values for dropdowns
-    scoped_for_filters = _apply_config_proposal_scope(ConfigProposal.query, current_user).subquery()
-    proposers = [r[0] for r in db.session.query(scoped_for_filters.c.proposer_name).distinct().filter(scoped_for_filters.c.proposer_name != None).order_by(scoped_for_filters.c.proposer_name).all()]
-    units = [r[0] for r in db.session.query(scoped_for_filters.c.proposer_unit).distinct().filter(scoped_for_filters.c.proposer_unit != None).order_by(scoped_for_filters.c.proposer_unit).all()]
-    statuses = [r[0] for r in db.session.query(scoped_for_filters.c.status).distinct().filter(scoped_for_filters.c.status != None).order_by(scoped_for_filters.c.status).all()]
+    def _load_proposal_facets():
+        scoped_for_filters = _apply_config_proposal_scope(ConfigProposal.query, current_user).subquery()
+        return {
+            column: [r[0] for r in db.session.query(scoped_for_filters.c[column]).distinct().filter(scoped_for_filters.c[column] != None).order_by(scoped_for_filters.c[column]).all()]
+            for column in ('proposer_name', 'proposer_unit', 'status')
+        }
+    if _is_admin_user(current_user):
+        facets = _cached_filter_options('config_proposals', _load_proposal_facets, key='all')
+    else:
+        # The scope follows roles and the departments of every visible user, which the
+        # config_proposals cache group does not track: load scoped facets per request
+        facets = _load_proposal_facets()
+    proposers, units, statuses = facets['proposer_name'], facets['proposer_unit'], facets['status']
 
     return render_template('config_proposals.html', 
                            proposals=proposals_pagination, 
@@ -6739,11 +9591,11 @@ def add_config_proposal():
             grand_subtotal = subtotal * proposal.quantity
             proposal.vat_amount = round(grand_subtotal * (vat_percent / 100.0), 2)
             proposal.total_amount = round(grand_subtotal + proposal.vat_amount, 2)
-            db.session.commit()
-            
+
             # Notifications
             notify_user(session['user_id'], f"Đề xuất thiết bị '{name}' đã được tạo.", url_for('config_proposal_detail', proposal_id=proposal.id, _external=True))
             notify_group(f"Đề xuất thiết bị mới: '{name}'", url_for('config_proposal_detail', proposal_id=proposal.id, _external=True))
+            db.session.commit()
             
             flash('Tạo đề xuất thiết bị thành công.', 'success')
             return redirect(url_for('config_proposals'))
@@ -6772,6 +9624,14 @@ def download_proposal_attachment(attachment_id):
         download_name=attachment.file_name
     )
 
+# Proposal status -> permissions of the people who act next
+PROPOSAL_NEXT_STEP_PERMISSIONS = {
+    'new': ('config_proposals.approve_team',),
+    'team_approved': ('config_proposals.consult_it',),
+    'it_consulted': ('config_proposals.approve_director',),
+    'approved': ('config_proposals.execute_purchase', 'config_proposals.execute_accounting', 'config_proposals.confirm_delivery'),
+}
+
 @app.route('/config_proposals/<int:proposal_id>/action', methods=['POST'])
 
 def proposal_action(proposal_id):
@@ -6949,7 +9809,6 @@ def proposal_action(proposal_id):
                 p.invoice_received_at = datetime.utcnow()
                 # Assuming _log_audit is defined elsewhere for logging changes
                 # _log_audit('config_proposal', p.id, {'invoice_received_at': None}, {'invoice_received_at': str(p.invoice_received_at)})
-                db.session.commit() # Commit here to ensure invoice_received_at is saved before checking for completion
                 flash('Đã xác nhận nhận hóa đơn.', 'success')
                 
                 # Auto-complete when all checklist items are done
@@ -7019,9 +9878,7 @@ def proposal_action(proposal_id):
             db.session.add(log)
             flash('Đã gửi duyệt lại thành công.', 'success')
 
-        db.session.commit()
-        
-        # Notifications for Proposal Actions
+        # Notifications for Proposal Actions, written by the single commit below
         action_names = {
             'approve_team': 'Duyệt (Bộ phận)',
             'consult_it': 'IT đã lập phương án',
@@ -7038,7 +9895,12 @@ def proposal_action(proposal_id):
             msg_group = f"Đề xuất '{p.name}' vừa được {action_names[action]}."
             notify_user(p.created_by, msg_user, url_for('config_proposal_detail', proposal_id=p.id))
             notify_group(msg_group, url_for('config_proposal_detail', proposal_id=p.id))
-            
+        # Whoever acts on the next step
+        if p.status in PROPOSAL_NEXT_STEP_PERMISSIONS and action in ('approve_team', 'consult_it', 'approve_director', 'resubmit'):
+            notify_permission(PROPOSAL_NEXT_STEP_PERMISSIONS[p.status], f"Đề xuất '{p.name}' đang chờ bạn xử lý.",
+                              url_for('config_proposal_detail', proposal_id=p.id), exclude=[current_user.id])
+        db.session.commit()
+
     except Exception as e:
         db.session.rollback()
         flash(f'Lỗi xử lý: {str(e)}', 'danger')
@@ -7357,6 +10219,46 @@ def init_db_command():
     db.create_all()
     click.echo("Đã khởi tạo cơ sở dữ liệu.")
 
+@app.cli.command("rebuild-department-closure")
+def rebuild_department_closure_command():
+    """Dựng lại bảng cây phòng ban (department_closure) từ quan hệ cha - con."""
+    _rebuild_department_closure()
+    db.session.commit()
+    click.echo(f"Đã dựng lại cây phòng ban: {DepartmentClosure.query.count()} dòng.")
+
+@app.cli.command("rebuild-stats")
+def rebuild_stats_command():
+    """Tính lại bảng thống kê thiết bị (device_stats) cho Dashboard."""
+    _rebuild_device_stats()
+    db.session.commit()
+    click.echo(f"Đã tính lại thống kê thiết bị: {DeviceStats.query.count()} dòng.")
+
+@app.cli.command("backfill-handover-batches")
+def backfill_handover_batches_command():
+    """Dựng lại bảng tiêu đề phiếu bàn giao (handover_batch) từ lịch sử bàn giao."""
+    _rebuild_handover_batches()
+    db.session.commit()
+    click.echo(f"Đã dựng lại tiêu đề phiếu bàn giao: {HandoverBatch.query.count()} phiếu.")
+
+@app.cli.command("backfill-user-keys")
+@click.option('--missing-only', is_flag=True, help='Chỉ điền các dòng chưa có khóa.')
+def backfill_user_keys_command(missing_only):
+    """Tính lại khóa sắp xếp (sort_key) và khóa tìm kiếm (search_key) của người dùng và thiết bị."""
+    written = _backfill_derived_keys(only_missing=missing_only)
+    db.session.commit()
+    click.echo(f"Đã cập nhật khóa sắp xếp/tìm kiếm cho {written} dòng.")
+
+@app.cli.command("index-report")
+@click.option('--apply', is_flag=True, help='Tạo các index còn thiếu trước khi in báo cáo.')
+def index_report_command(apply):
+    """Liệt kê các index trong registry, trạng thái và các route sử dụng."""
+    if apply:
+        ensure_model_indexes()
+    for name, table_name, columns, present, routes in model_index_report():
+        status = 'OK' if present else 'THIẾU'
+        click.echo(f"[{status}] {name} ON {table_name} ({', '.join(columns)})")
+        click.echo(f"       routes: {', '.join(routes)}")
+
 @app.cli.command("create-admin")
 def create_admin_command():
     """Tạo tài khoản admin mặc định."""
@@ -7478,40 +10380,38 @@ def backup_import():
         flash('File backup phải có định dạng .bak hoặc .zip backup cũ.', 'danger')
         return redirect(url_for('backup_page'))
     
-    try:
-        # Lưu file tạm
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.bak')
-        temp_path = temp_file.name
-        temp_file.close()
-        
-        file.save(temp_path)
-        
-        # Use shared backup logic for restore
-        with _exclusive_file_lock('backup_task', stale_after_seconds=7200) as lock_acquired:
-            if not lock_acquired:
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
-                flash('Đang có tiến trình backup/restore khác chạy. Vui lòng chờ hoàn tất rồi thử lại.', 'warning')
-                return redirect(url_for('backup_page'))
-            backup = DatabaseBackup()
-            db.session.remove()
-            db.engine.dispose()
-            success = backup.restore_backup(temp_path)
-        
-        # Cleanup
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-            
+    job = _enqueue_job('backup_import', upload=file)
+    return redirect(url_for('job_status', job_id=job.id))
+
+def _reset_restored_jobs(job_id):
+    """Cancel the jobs a restore brought back as queued/running, so their old inputs never run again.
+
+    A restored row with this job's id belongs to an older job; it is dropped and the restore's own
+    outcome is inserted in its place.
+    """
+    jobs = BackgroundJob.__table__
+    with db.engine.begin() as connection:
+        connection.execute(jobs.delete().where(jobs.c.id == job_id))
+        connection.execute(jobs.update().where(jobs.c.status.in_(('queued', 'running'))).values(
+            status='failed', claimed_by=None, claim_token=None, finished_at=datetime.utcnow(),
+            message='Công việc đã bị hủy do dữ liệu được khôi phục từ backup.',
+        ))
+
+def _backup_import_job(job, reporter):
+    reporter.update(progress=10, message='Đang khôi phục dữ liệu...')
+    # Use shared backup logic for restore
+    with _exclusive_file_lock('backup_task', stale_after_seconds=7200) as lock_acquired:
+        if not lock_acquired:
+            return {'failed': True, 'message': 'Đang có tiến trình backup/restore khác chạy. Vui lòng chờ hoàn tất rồi thử lại.', 'next': 'backup_page'}
+        backup = DatabaseBackup()
+        db.session.remove()
+        db.engine.dispose()
+        success = backup.restore_backup(job.input_path)
         if success:
-            flash('Import backup thành công!', 'success')
-        else:
-            flash('Lỗi khi import backup. Vui lòng kiểm tra log.', 'danger')
-            
-        return redirect(url_for('backup_page'))
-        
-    except Exception as e:
-        flash(f'Lỗi khi import backup: {str(e)}', 'danger')
-        return redirect(url_for('backup_page'))
+            _reset_restored_jobs(job.id)
+    if success:
+        return {'message': 'Import backup thành công!', 'next': 'backup_page'}
+    return {'failed': True, 'message': 'Lỗi khi import backup. Vui lòng kiểm tra log.', 'next': 'backup_page'}
 
 @app.route('/backup/config', methods=['GET', 'POST'])
 def backup_config():
@@ -7829,10 +10729,9 @@ def resources():
     # Order by ID desc
     query = query.order_by(Resource.id.desc())
     
-    pagination = query.paginate(page=page, per_page=20, error_out=False)
-    devices = Device.query.all()
-    
-    return render_template('resources/index.html', resources=pagination, devices=devices, search=search_query)
+    pagination = query.options(joinedload(Resource.device)).paginate(page=page, per_page=20, error_out=False)
+
+    return render_template('resources/index.html', resources=pagination, search=search_query)
 
 @app.route('/resources/add', methods=['POST'])
 def add_resource():
@@ -8554,28 +11453,34 @@ def _normalize_consumable_category(category):
 
 def _generate_consumable_code(category, name):
     prefix = _consumable_prefix_from_text(category or name)
-    rows = db.session.query(ConsumableItem.code).filter(ConsumableItem.code.ilike(f'{prefix}-%')).all()
-    max_number = 0
-    pattern = re.compile(rf'^{re.escape(prefix)}-(\d+)$', re.IGNORECASE)
-    for row in rows:
-        match = pattern.match(row[0] or '')
-        if match:
-            max_number = max(max_number, int(match.group(1)))
-    for number in range(max_number + 1, max_number + 10000):
-        code = f'{prefix}-{number:03d}'
-        if not ConsumableItem.query.filter(func.upper(ConsumableItem.code) == code.upper()).first():
-            return code
-    return _unique_consumable_code(prefix)
+    return _allocate_codes(
+        'consumable', prefix, 1, lambda number: f'{prefix}-{number:03d}', ConsumableItem.code,
+        seed=lambda: _max_code_number(ConsumableItem.code, prefix),
+    )[0]
 
 def _unique_consumable_code(base_code):
     base_code = (base_code or 'TH').strip().upper()[:20]
-    code = base_code
-    counter = 1
-    while ConsumableItem.query.filter(func.upper(ConsumableItem.code) == code).first():
+
+    def render(counter):
+        if not counter:
+            return base_code
         suffix = str(counter)
-        code = f"{base_code[:20-len(suffix)]}{suffix}"
-        counter += 1
-    return code
+        return f"{base_code[:20-len(suffix)]}{suffix}"
+
+    def seed():
+        # Continue after the highest BASE / BASE<n> already in use, or start at BASE itself
+        highest = -1
+        rows = db.session.query(ConsumableItem.code).filter(ConsumableItem.code.ilike(f'{base_code[:16]}%')).all()
+        for (code,) in rows:
+            code = (code or '').upper()
+            if code == base_code:
+                highest = max(highest, 0)
+            match = re.match(r'^.*?(\d+)$', code)
+            if match and render(int(match.group(1))) == code:
+                highest = max(highest, int(match.group(1)))
+        return highest
+
+    return _allocate_codes('consumable_base', base_code, 1, render, ConsumableItem.code, seed=seed)[0]
 
 def _record_consumable_transaction(item, transaction_type, quantity, *, issued_to_id=None, reason='', notes='', batch_id=None, location=None):
     before_quantity = item.current_quantity or 0
@@ -8611,6 +11516,9 @@ def _record_consumable_transaction(item, transaction_type, quantity, *, issued_t
     return transaction
 
 def _consumable_categories():
+    return _cached_filter_options('consumables', _load_consumable_categories, key='categories')
+
+def _load_consumable_categories():
     rows = db.session.query(ConsumableItem.category).filter(ConsumableItem.category != None).distinct().all()
     defaults = [
         'Dây mạng', 'Dây nhảy quang', 'Dây HDMI', 'Dây VGA', 'Dây DisplayPort',
@@ -8622,6 +11530,9 @@ def _consumable_categories():
     return sorted(categories)
 
 def _consumable_groups():
+    return _cached_filter_options('consumables', _load_consumable_groups, key='groups')
+
+def _load_consumable_groups():
     rows = db.session.query(ConsumableItem.group_name).filter(ConsumableItem.group_name != None).distinct().all()
     defaults = [
         'Cáp mạng', 'Cáp quang', 'Module quang', 'Dây màn hình',
@@ -8681,11 +11592,9 @@ def consumable_list():
     if low_stock:
         query = query.filter(ConsumableItem.current_quantity <= ConsumableItem.min_quantity)
 
-    items = query.order_by(func.lower(ConsumableItem.name)).paginate(page=page, per_page=per_page, error_out=False)
+    items = _paginate_list(query, [(func.lower(ConsumableItem.name), False), (ConsumableItem.id, False)], page, per_page)
     transactions = ConsumableTransaction.query.order_by(ConsumableTransaction.transaction_date.desc())\
         .paginate(page=tx_page, per_page=tx_per_page, error_out=False)
-    users = User.query.filter(User.status.notin_(['Nghỉ việc', 'Nghỉ không lương']))\
-        .order_by(func.lower(User.last_name_token), func.lower(User.full_name), func.lower(User.username)).all()
     stats = {
         'total_items': ConsumableItem.query.count(),
         'total_quantity': db.session.query(func.coalesce(func.sum(ConsumableItem.current_quantity), 0)).scalar() or 0,
@@ -8701,7 +11610,6 @@ def consumable_list():
         'consumables.html',
         items=items,
         transactions=transactions,
-        users=users,
         categories=_consumable_categories(),
         groups=_consumable_groups(),
         stats=stats,
@@ -9007,40 +11915,7 @@ def export_consumables_excel():
     if not _require_device_permission('devices.view'):
         flash('Bạn không có quyền xuất dữ liệu thiết bị tiêu hao.', 'danger')
         return redirect(url_for('consumable_list'))
-    items = ConsumableItem.query.order_by(ConsumableItem.name).all()
-    transactions = ConsumableTransaction.query.order_by(ConsumableTransaction.transaction_date.desc()).all()
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        pd.DataFrame([{
-            'Mã': item.code,
-            'Tên thiết bị tiêu hao': item.name,
-            'Loại vật tư': item.category,
-            'Đơn vị': item.unit,
-            'Tồn kho': item.current_quantity,
-            'Tồn tối thiểu': item.min_quantity,
-            'Vị trí': item.location or '',
-            'Ghi chú': item.notes or ''
-        } for item in items]).to_excel(writer, index=False, sheet_name='Ton_kho')
-        pd.DataFrame([{
-            'Thời gian': _format_vietnam_datetime(tx.transaction_date),
-            'Mã': tx.item.code if tx.item else '',
-            'Tên thiết bị tiêu hao': tx.item.name if tx.item else '',
-            'Loại giao dịch': tx.transaction_type,
-            'Số lượng': tx.quantity,
-            'Tồn trước': tx.before_quantity,
-            'Tồn sau': tx.after_quantity,
-            'Người nhận': tx.issued_to.full_name if tx.issued_to else '',
-            'Người thao tác': tx.actor.full_name if tx.actor else '',
-            'Lý do': tx.reason or '',
-            'Ghi chú': tx.notes or ''
-        } for tx in transactions]).to_excel(writer, index=False, sheet_name='Nhat_ky')
-    output.seek(0)
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name=f'consumables_{datetime.now(VIETNAM_TZ).strftime("%Y%m%d")}.xlsx'
-    )
+    return _stream_export('consumables')
 
 
 # --- Stock accessories and supplies (separate from the consumable-device warehouse) ---
@@ -9087,8 +11962,11 @@ def stock_item_list():
         query = query.filter(StockItem.category_id == category_id)
     if low_stock:
         query = query.filter(StockItem.current_quantity <= StockItem.min_quantity)
-    items = query.order_by(StockItem.is_active.desc(), func.lower(StockItem.name)).paginate(
-        page=page, per_page=per_page if per_page in (10, 20, 50, 100) else 20, error_out=False)
+    items = _paginate_list(
+        query,
+        [(StockItem.is_active, True), (func.lower(StockItem.name), False), (StockItem.id, False)],
+        page, per_page if per_page in (10, 20, 50, 100) else 20,
+    )
     movement_stats = db.session.query(
         StockItemMovement.item_id,
         func.coalesce(func.sum(case((StockItemMovement.movement_type == 'Nhập', StockItemMovement.quantity), else_=0)), 0).label('total_imported'),
@@ -9106,9 +11984,6 @@ def stock_item_list():
     movements = StockItemMovement.query.order_by(
         StockItemMovement.movement_date.desc(), StockItemMovement.id.desc()
     ).paginate(page=movement_page, per_page=15, error_out=False)
-    users = User.query.filter(User.status.notin_(['Nghỉ việc', 'Nghỉ không lương'])).order_by(
-        func.lower(User.last_name_token), func.lower(User.full_name), func.lower(User.username)
-    ).all()
     stats = {
         'total_items': StockItem.query.filter_by(is_active=True).count(),
         'total_quantity': db.session.query(func.coalesce(func.sum(StockItem.current_quantity), 0)).scalar() or 0,
@@ -9130,7 +12005,6 @@ def stock_item_list():
         'stock_items.html',
         items=items,
         movements=movements,
-        users=users,
         categories=categories,
         category_payload=_stock_category_payload(categories),
         stats=stats,
@@ -9629,6 +12503,8 @@ def edit_device_type(id):
                         {'device_type': name},
                         synchronize_session=False,
                     )
+                    _rebuild_device_stats()
+                    _invalidate_filter_options('device_types')
                 dt.name = name
                 dt.category = category
                 dt.code_prefix = code_prefix
@@ -9683,6 +12559,7 @@ def rename_device_type_category():
             {'category': new_name},
             synchronize_session=False,
         )
+        _invalidate_filter_options('device_type_hierarchy')
         db.session.commit()
         flash(f'Đã đổi tên nhóm "{old_name}" thành "{new_name}" cho {updated} loại thiết bị.', 'success')
     except Exception as exc: